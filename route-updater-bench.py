@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""Synthetic scale benchmark for route-updater.
+
+Streams generated TrafficDirector ADDED/MODIFIED/DELETED events from a fake
+API server through the real watch, work queue and reconcile workers into an
+in-memory (or any other) route backend, then reports events/sec, event-to-route latency
+and peak RSS. With the default dry-run backend it needs neither a cluster
+nor root.
+
+    ./route-updater-bench.py --tds 1000 --gateways 100 --events 20000 --rate 2000
+    ./route-updater-bench.py --backend ip-batch --netns bench --interface bench0
+    ./route-updater-bench.py --replay events.jsonl --speed 1 --dump-routes routes.json
+    ./route-updater-bench.py --memory --tds 10000 --gateways 10 --max-bytes-per-vip 250
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import threading
+import array
+import gc
+import tracemalloc
+import importlib.util
+
+# route-updater.py is a script, not a package, load it as a module
+_spec = importlib.util.spec_from_file_location("route_updater", os.path.join(os.path.dirname(os.path.abspath(__file__)), "route-updater.py"))
+ru = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ru)
+
+VIP_BASE = ru.ip_to_int("10.0.0.0")
+
+# Share of the churn events by kind, the rest are status-only updates
+CHURN_MIX = (
+    ('move', 0.3),
+    ('add_gateway', 0.2),
+    ('remove_gateway', 0.2),
+    ('delete', 0.1),
+)
+
+class RecordingBackend:
+    """Route backend wrapper timing every route written, with optional simulated kernel latency.
+
+    Every route written settles the oldest unserved event that asked for it,
+    see expect(). Everything else goes straight to the wrapped backend.
+    """
+
+    def __init__(self, backend, op_latency=0.0):
+        self.backend = backend
+        self.op_latency = op_latency
+        self.ops = 0
+        # VIP -> monotonic time of the oldest event the route has not caught up with yet
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.latencies = array.array('d')
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def expect(self, vips, stamp):
+        """Record that an event emitted at stamp changes the routes of vips"""
+        with self.pending_lock:
+            for vip in vips:
+                self.pending.setdefault(vip, stamp)
+
+    def _written(self, vips):
+        now = time.monotonic()
+        with self.pending_lock:
+            for vip in vips:
+                self.ops += 1
+                stamp = self.pending.pop(vip, None)
+                if stamp is not None:
+                    self.latencies.append(now - stamp)
+
+    def _simulate(self, count):
+        if self.op_latency:
+            time.sleep(self.op_latency * count)
+
+    def add_route(self, vip, node_ips, table=ru.RT_TABLE_MAIN):
+        self._simulate(1)
+        self.backend.add_route(vip, node_ips, table)
+        self._written((vip,))
+
+    def replace_route(self, vip, node_ips, table=ru.RT_TABLE_MAIN):
+        self._simulate(1)
+        self.backend.replace_route(vip, node_ips, table)
+        self._written((vip,))
+
+    def delete_route(self, vip, table=ru.RT_TABLE_MAIN):
+        self._simulate(1)
+        self.backend.delete_route(vip, table)
+        self._written((vip,))
+
+    def apply(self, ops):
+        self._simulate(len(ops))
+        results = self.backend.apply(ops)
+        self._written([vip for (_, dst, _, _), error in zip(ops, results) if error is None for vip in ru.dst_vips(dst)])
+        return results
+
+    def flush_table(self, table):
+        # Through apply() above, so the flushed VIPs are accounted
+        return ru.RouteBackend.flush_table(self, table)
+
+class DiscardingBackend(ru.DryRunRouteBackend):
+    """Dry-run backend that keeps none of the routes it is given, only route-updater's own state takes memory"""
+
+    def apply(self, ops):
+        return [None] * len(ops)
+
+class EventStream:
+    """Watch response streaming generated events, in the shape the kubernetes client reads"""
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def stream(self, amt=None, decode_content=False):
+        for event in self.generator:
+            yield (json.dumps(event) + "\n").encode()
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+class FakeCustomObjectsApi:
+    """Fake API server listing and watching the TrafficDirectors of an event source.
+
+    A watch with nothing left to stream blocks forever, the benchmark ends
+    once the source is drained and the reconcile workers are idle.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def list_namespaced_custom_object(self, **kwargs):
+        """List or watch TrafficDirectors
+
+        :return: object
+        """
+        if not kwargs.get('watch'):
+            items, resource_version = self.source.list()
+            return {'items': items, 'metadata': {'resourceVersion': resource_version}}
+        events = self.source.watch()
+        if events is None:
+            threading.Event().wait()
+        return EventStream(events)
+
+class EventGenerator:
+    """Generate TrafficDirector events: an ADDED per TrafficDirector, then random churn.
+
+    Every event that must change routes tells the backend which VIPs it
+    touches just before it is streamed.
+    """
+
+    def __init__(self, backend, args):
+        self.backend = backend
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.next_vip = 0
+        self.resource_version = 1
+        self.objects = {}
+        self.names = []
+        self.deleted = []
+        self.emitted = 0
+        self.finished = threading.Event()
+        self.started = None
+        self.watched = False
+
+    def list(self):
+        return [], "1"
+
+    def watch(self):
+        if self.watched:
+            return None
+        self.watched = True
+        return self.events()
+
+    def _vip(self):
+        self.next_vip += 1
+        return ru.int_to_ip(VIP_BASE + self.next_vip)
+
+    def _node(self):
+        return ru.int_to_ip(ru.ip_to_int(self.args.node_base) + self.random.randrange(self.args.nodes))
+
+    def _new(self, name):
+        return {
+            'apiVersion': f"{ru.CRD_GROUP}/{ru.CRD_VERSION}",
+            'kind': "TrafficDirector",
+            'metadata': {'namespace': ru.NAMESPACE, 'name': name, 'generation': 1},
+            'spec': {'gateways': [{'namespace': f"tenant-{index % 50}", 'vip': self._vip()} for index in range(self.args.gateways)]},
+            'status': {'nodeIp': self._node()},
+        }
+
+    def _add(self, name):
+        obj = self._new(name)
+        self.objects[name] = obj
+        self.names.append(name)
+        return obj
+
+    def _event(self, event_type, obj, vips):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        if vips:
+            self.backend.expect([ru.ip_to_int(vip) for vip in vips], time.monotonic())
+        self.emitted += 1
+        return {'type': event_type, 'object': obj}
+
+    def _churn(self):
+        """Pick and apply one random change, returns its event"""
+        kind = 'status'
+        roll = self.random.random()
+        for candidate, share in CHURN_MIX:
+            if roll < share:
+                kind = candidate
+                break
+            roll -= share
+
+        if self.deleted and (kind == 'delete' or not self.names):
+            # Bring a deleted TrafficDirector back with fresh VIPs
+            obj = self._add(self.deleted.pop(self.random.randrange(len(self.deleted))))
+            return self._event('ADDED', obj, [g['vip'] for g in obj['spec']['gateways']])
+
+        index = self.random.randrange(len(self.names))
+        obj = self.objects[self.names[index]]
+        gateways = obj['spec']['gateways']
+
+        if kind == 'delete':
+            name = self.names[index]
+            self.names[index] = self.names[-1]
+            self.names.pop()
+            del self.objects[name]
+            self.deleted.append(name)
+            return self._event('DELETED', obj, [g['vip'] for g in gateways])
+        if kind == 'move':
+            node_ip = self._node()
+            if node_ip == obj['status']['nodeIp']:
+                return self._event('MODIFIED', obj, [])
+            obj['status']['nodeIp'] = node_ip
+            return self._event('MODIFIED', obj, [g['vip'] for g in gateways])
+        if kind == 'add_gateway':
+            gateway = {'namespace': f"tenant-{self.random.randrange(50)}", 'vip': self._vip()}
+            gateways.append(gateway)
+            obj['metadata']['generation'] += 1
+            return self._event('MODIFIED', obj, [gateway['vip']])
+        if kind == 'remove_gateway' and len(gateways) > 1:
+            gateway = gateways.pop(self.random.randrange(len(gateways)))
+            obj['metadata']['generation'] += 1
+            return self._event('MODIFIED', obj, [gateway['vip']])
+        # Status-only update, the routes stay as they are
+        obj['status']['observedAt'] = self.resource_version
+        return self._event('MODIFIED', obj, [])
+
+    def events(self):
+        interval = 1.0 / self.args.rate if self.args.rate else 0
+        self.started = time.monotonic()
+        try:
+            for index in range(self.args.tds + self.args.events):
+                if interval:
+                    delay = self.started + index * interval - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                if index < self.args.tds:
+                    obj = self._add(f"td-{index}")
+                    yield self._event('ADDED', obj, [g['vip'] for g in obj['spec']['gateways']])
+                else:
+                    yield self._churn()
+        finally:
+            self.finished.set()
+
+class EventReplay:
+    """Replay a recording of route-updater (ROUTE_UPDATER_RECORD) as lists and watch events.
+
+    Recorded lists are served to the list calls, the events between them are
+    streamed by one watch that ends with a 410 Gone where the recording has
+    the next list, as route-updater relisted there. speed 1 keeps the recorded
+    pace, 0 streams as fast as possible. Every route change is expected from
+    the backend, see RecordingBackend.expect().
+    """
+
+    def __init__(self, backend, path, speed):
+        self.backend = backend
+        self.speed = speed
+        self.file = open(path, encoding="utf-8")
+        self.next_entry = self._read()
+        self.objects = {}
+        self.resource_version = "0"
+        self.emitted = 0
+        self.finished = threading.Event()
+        self.started = None
+        self.first_ts = None
+
+    def _read(self):
+        for line in self.file:
+            if line.strip():
+                return json.loads(line)
+        return None
+
+    def _take(self):
+        """Consume the next entry, waiting for its recorded time"""
+        entry, self.next_entry = self.next_entry, self._read()
+        if self.started is None:
+            self.started, self.first_ts = time.monotonic(), entry['ts']
+        if self.speed:
+            delay = self.started + (entry['ts'] - self.first_ts) / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return entry
+
+    def _update(self, name, obj):
+        """Replace the object of name (None to delete) and expect the routes it changes"""
+        old, new = route_vips(self.objects.get(name)), route_vips(obj)
+        changed = [vip for vip in old.keys() | new.keys() if old.get(vip) != new.get(vip)]
+        if changed:
+            self.backend.expect(changed, time.monotonic())
+        if obj is None:
+            self.objects.pop(name, None)
+        else:
+            self.objects[name] = obj
+
+    def list(self):
+        if self.next_entry is None or self.next_entry['type'] != 'LIST':
+            # Listed where the recording has none, the state so far is what the API server holds
+            return list(self.objects.values()), self.resource_version
+        entry = self._take()
+        listed = {object_name(item): item for item in entry['items']}
+        for name in set(self.objects) | set(listed):
+            self._update(name, listed.get(name))
+        self.resource_version = entry['resourceVersion']
+        return entry['items'], entry['resourceVersion']
+
+    def watch(self):
+        if self.next_entry is None:
+            self.finished.set()
+            return None
+        return self.events()
+
+    def events(self):
+        while self.next_entry is not None:
+            if self.next_entry['type'] == 'LIST':
+                raise ru.ApiException(status=410, reason="Gone")
+            entry = self._take()
+            obj = entry['object']
+            self.resource_version = obj['metadata']['resourceVersion']
+            if entry['type'] in ('ADDED', 'MODIFIED'):
+                self._update(object_name(obj), obj)
+            elif entry['type'] == 'DELETED':
+                self._update(object_name(obj), None)
+            self.emitted += 1
+            yield {'type': entry['type'], 'object': obj}
+
+def object_name(obj):
+    return f"{obj['metadata']['namespace']}/{obj['metadata']['name']}"
+
+def route_vips(obj):
+    """Return {vip: nodeIp} as route-updater routes a TrafficDirector object, empty for None"""
+    node_ip = (obj or {}).get('status', {}).get('nodeIp')
+    if not node_ip:
+        return {}
+    vips = {}
+    for gateway in obj.get('spec', {}).get('gateways', []):
+        try:
+            vips.setdefault(ru.ip_to_int(gateway.get('vip') or ''), node_ip)
+        except OSError:
+            continue
+    return vips
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def idle(shard):
+    with shard.work_queue.lock:
+        return not (shard.work_queue.queue or shard.work_queue.processing or shard.work_queue.delayed)
+
+async def run(args, logger):
+    """Run the watch and the workers against the fake API server until everything is routed, returns the report"""
+    ru.RECONCILE_WORKERS = args.workers
+    shard = ru.RouterShard(args.netns, args.interface)
+    ru.ROUTE_BACKEND = args.backend
+    ru.TD_TABLES = args.td_tables
+    ru.AGGREGATE_PREFIX_LEN = args.aggregate_prefix
+    shard.open(logger)
+    backend = shard.backend = RecordingBackend(shard.backend, args.op_latency / 1000.0)
+    ru.shards.append(shard)
+
+    if args.replay:
+        source = EventReplay(backend, args.replay, args.speed)
+    else:
+        source = EventGenerator(backend, args)
+    custom_api = FakeCustomObjectsApi(source)
+    resource_version = ru.sync_traffic_directors(custom_api, logger)
+    workers = ru.start_workers(shard, logger)
+    ru.run_in_thread(ru.watch_traffic_directors, custom_api, resource_version, logger)
+
+    while not (source.finished.is_set() and idle(shard)):
+        await asyncio.sleep(0.01)
+    # An empty recording never starts
+    elapsed = time.monotonic() - (source.started or time.monotonic())
+
+    shard.work_queue.shutdown()
+    await asyncio.gather(*workers)
+    shard.executor.shutdown()
+
+    # With ROUTE_UPDATER_TD_TABLES the routes are spread over the TrafficDirector tables, aggregates are listed VIP by VIP
+    kernel = backend.dump_route_tables()
+    routes = {vip: node_ips for table in kernel.values() for dst, node_ips in table.items() for vip in ru.dst_vips(dst)}
+    if args.dump_routes:
+        with open(args.dump_routes, "w", encoding="utf-8") as f:
+            json.dump({ru.int_to_ip(vip): [ru.int_to_ip(node_ip) for node_ip in node_ips] for vip, node_ips in sorted(routes.items())}, f, indent=1)
+            f.write("\n")
+
+    latencies = sorted(backend.latencies)
+    if args.replay:
+        workload = {'replay': args.replay}
+    else:
+        workload = {'traffic_directors': args.tds, 'gateways_per_traffic_director': args.gateways}
+    return {
+        **workload,
+        'events': source.emitted,
+        'events_per_second': round(source.emitted / elapsed, 1) if elapsed else 0.0,
+        'elapsed_seconds': round(elapsed, 3),
+        'backend': args.backend,
+        'td_tables': args.td_tables,
+        'aggregate_prefix': args.aggregate_prefix,
+        'route_ops': backend.ops,
+        'routes_installed': len(routes),
+        'kernel_routes': sum(map(len, kernel.values())),
+        'latency_samples': len(latencies),
+        # Changes undone by a later event before a worker got to them never reach the backend
+        'coalesced_away': len(backend.pending),
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'latency_max_ms': round(latencies[-1] * 1000 if latencies else 0.0, 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def measure_memory(args, logger):
+    """Sync --tds TrafficDirectors of --gateways VIPs into a shard and measure its route state with tracemalloc, returns the report"""
+    ru.TD_TABLES = args.td_tables
+    ru.AGGREGATE_PREFIX_LEN = args.aggregate_prefix
+    generator = EventGenerator(None, args)
+    for index in range(args.tds):
+        obj = generator._add(f"td-{index}")
+        ru.traffic_director_objects[object_name(obj)] = obj
+
+    # One untraced sync for the time, tracing slows it down several times
+    shard = ru.RouterShard(args.netns, args.interface)
+    shard.backend = DiscardingBackend(args.netns, args.interface, logger)
+    start = time.monotonic()
+    ru.sync_shard(shard, logger)
+    elapsed = time.monotonic() - start
+
+    # The API objects are in the cache before tracing starts, only what the sync builds from them is counted
+    shard = ru.RouterShard(args.netns, args.interface)
+    shard.backend = DiscardingBackend(args.netns, args.interface, logger)
+    gc.collect()
+    tracemalloc.start()
+    ru.sync_shard(shard, logger)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    vips = len(shard.vip_nexthops)
+    return {
+        'traffic_directors': args.tds,
+        'gateways_per_traffic_director': args.gateways,
+        'vips': vips,
+        'td_tables': args.td_tables,
+        'aggregate_prefix': args.aggregate_prefix,
+        'routes_installed': len(shard.installed_routes),
+        'sync_seconds': round(elapsed, 3),
+        'route_state_mb': round(current / 1e6, 1),
+        'route_state_peak_mb': round(peak / 1e6, 1),
+        'bytes_per_vip': round(current / vips) if vips else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark route-updater against a fake API server and an in-memory route backend")
+    parser.add_argument("--tds", type=int, default=1000, help="TrafficDirectors ADDED before the churn starts (default: %(default)s)")
+    parser.add_argument("--gateways", type=int, default=10, help="gateways (VIPs) per TrafficDirector (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=10000, help="MODIFIED/DELETED/re-ADDED churn events after the initial ADDED ones (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=0, help="events per second streamed by the fake API server, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--nodes", type=int, default=16, help="distinct nodeIps TrafficDirectors move between (default: %(default)s)")
+    parser.add_argument("--node-base", default="192.168.0.1", help="first of the nodeIps, they must be on-link on --interface for the kernel backends (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=ru.RECONCILE_WORKERS, help="reconcile workers (default: %(default)s)")
+    parser.add_argument("--backend", choices=list(ru.ROUTE_BACKENDS), default="dry-run", help="route backend, all but dry-run program the kernel (default: %(default)s)")
+    parser.add_argument("--td-tables", action="store_true", default=ru.TD_TABLES, help="route every TrafficDirector through its own table, like ROUTE_UPDATER_TD_TABLES")
+    parser.add_argument("--aggregate-prefix", type=int, default=ru.AGGREGATE_PREFIX_LEN, help="aggregate VIP routes up to this prefix length, like ROUTE_UPDATER_AGGREGATE_PREFIX (default: %(default)s)")
+    parser.add_argument("--netns", default="bench", help="router namespace of the kernel backends, better a scratch one (default: %(default)s)")
+    parser.add_argument("--interface", default="bench0", help="egress interface in --netns (default: %(default)s)")
+    parser.add_argument("--op-latency", type=float, default=0, help="simulated kernel time per route op in ms, on top of the backend's own (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the churn (default: %(default)s)")
+    parser.add_argument("--replay", metavar="FILE", help="replay a ROUTE_UPDATER_RECORD recording instead of generating events")
+    parser.add_argument("--speed", type=float, default=0, help="replay pace relative to the recording, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--dump-routes", metavar="FILE", help="write the routes installed at the end as JSON, to diff runs")
+    parser.add_argument("--memory", action="store_true", help="measure the memory of the route state after a startup sync of --tds TrafficDirectors instead of streaming events")
+    parser.add_argument("--max-bytes-per-vip", type=float, help="with --memory, exit with status 1 if the route state takes more bytes per VIP")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger("route-updater-bench")
+
+    report = measure_memory(args, logger) if args.memory else asyncio.run(run(args, logger))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:32} {value}")
+    if args.memory and args.max_bytes_per_vip is not None and report['bytes_per_vip'] > args.max_bytes_per_vip:
+        print(f"Route state takes {report['bytes_per_vip']} bytes per VIP, more than {args.max_bytes_per_vip:g}", file=sys.stderr)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
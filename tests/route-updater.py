@@ -3,9 +3,26 @@
 import os
 import json
 import time
+import errno
+import socket
+import struct
+import ctypes
 import logging
+import threading
+import collections
+import heapq
+import atexit
+import queue
+import subprocess
 import sys
-from logging.handlers import RotatingFileHandler
+import asyncio
+import array
+import bisect
+import random
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Add debug output immediately
 print("Route updater starting...", flush=True)
@@ -20,23 +37,1237 @@ except ImportError as e:
 
 # Configuration
 LOG_FILE = "/var/log/route-updater/route-updater.log"
+LOG_LEVEL = os.environ.get("ROUTE_UPDATER_LOG_LEVEL", "INFO").upper()
 NAMESPACE = "opsramp-sdn"
 CRD_GROUP = "gateway.sdn.opsramp.com"
 CRD_VERSION = "v1"
 CRD_PLURAL = "trafficdirectors"
 ROUTER_NS = "n1"
 EGRESS_INTERFACE = "lana_1"
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_RETRY_DELAY = 1
+WATCH_MAX_RETRY_DELAY = 30
+RECONCILE_WORKERS = 4
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 60
+METRICS_PORT = int(os.environ.get("ROUTE_UPDATER_METRICS_PORT", "9102"))
+NEXTHOP_OBJECTS = os.environ.get("ROUTE_UPDATER_NEXTHOP_OBJECTS", "").lower() in ['true', '1', 'yes']
+NEXTHOP_ID_BASE = 0x10000
+# Seconds to wait for the CRD to become Established, 0 waits forever
+CRD_WAIT_TIMEOUT = float(os.environ.get("ROUTE_UPDATER_CRD_TIMEOUT", "0"))
+LEADER_ELECTION = os.environ.get("ROUTE_UPDATER_LEADER_ELECTION", "").lower() in ['true', '1', 'yes']
+LEASE_NAME = os.environ.get("ROUTE_UPDATER_LEASE_NAME", "route-updater")
+LEASE_IDENTITY = os.environ.get("POD_NAME") or f"{socket.gethostname()}_{os.getpid()}"
+LEASE_DURATION_SECONDS = 15
+LEASE_RENEW_DEADLINE = 10
+LEASE_RETRY_PERIOD = 2
+# "netns:interface[:label selector]" shards separated by ";", empty drives ROUTER_NS/EGRESS_INTERFACE only
+SHARDS = os.environ.get("ROUTE_UPDATER_SHARDS", "")
+ROUTE_BACKEND = os.environ.get("ROUTE_UPDATER_BACKEND", "netlink").lower()
+RECORD_FILE = os.environ.get("ROUTE_UPDATER_RECORD", "")
+TD_TABLES = os.environ.get("ROUTE_UPDATER_TD_TABLES", "").lower() in ['true', '1', 'yes']
+TD_TABLE_BASE = 0x10000
+TD_RULE_PRIORITY = 30000
+# Every table costs a policy rule walked on each lookup, TrafficDirectors past the limit stay in the main table
+TD_TABLES_MAX = int(os.environ.get("ROUTE_UPDATER_TD_TABLES_MAX", "256"))
+NODE_WATCH = os.environ.get("ROUTE_UPDATER_NODE_WATCH", "").lower() in ['true', '1', 'yes']
+# Liveness probing of the nodeIps from the router namespaces: "icmp", "udp:<echo port>" or empty for none
+PROBE_PROTOCOL, _, PROBE_PORT = os.environ.get("ROUTE_UPDATER_PROBE", "").lower().partition(":")
+PROBE_INTERVAL = float(os.environ.get("ROUTE_UPDATER_PROBE_INTERVAL", "100")) / 1000
+# Probes in a row a nodeIp misses before it is withdrawn, and seconds it must answer before it is restored
+PROBE_MULTIPLIER = int(os.environ.get("ROUTE_UPDATER_PROBE_MULTIPLIER", "3"))
+PROBE_HOLD_DOWN = float(os.environ.get("ROUTE_UPDATER_PROBE_HOLD_DOWN", "5"))
+# Delete the conntrack entries of VIPs whose nexthops changed
+CONNTRACK_FLUSH = os.environ.get("ROUTE_UPDATER_CONNTRACK_FLUSH", "").lower() in ['true', '1', 'yes']
+# Shortest prefix VIP routes are aggregated into, 0 keeps one /32 route per VIP
+AGGREGATE_PREFIX_LEN = int(os.environ.get("ROUTE_UPDATER_AGGREGATE_PREFIX", "0") or 0)
 
-# Global map to store VIPs by TrafficDirector name
-traffic_director_vips = {}
+# Netlink constants (linux/netlink.h, linux/rtnetlink.h)
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLA_F_NESTED = 0x8000
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+RTA_NH_ID = 30
+RTM_NEWNEXTHOP = 104
+RTM_DELNEXTHOP = 105
+RTM_GETNEXTHOP = 106
+NHA_ID = 1
+NHA_GROUP = 2
+NHA_GROUP_TYPE = 3
+NHA_OIF = 5
+NHA_GATEWAY = 6
+NEXTHOP_GRP_TYPE_MPATH = 0
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV4_RULE = 0x80
+RTNLGRP_NEXTHOP = 32
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+NETLINK_GET_STRICT_CHK = 12
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+RTM_GETRULE = 34
+FRA_PRIORITY = 6
+FRA_TABLE = 15
+FRA_PROTOCOL = 21
+FR_ACT_TO_TBL = 1
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RTPROT_STATIC = 4
+# Unassigned protocol numbers marking the aggregate routes, and the /32 routes, nexthop objects and rules, as ours
+RTPROT_AGGREGATE = 245
+RTPROT_ROUTE_UPDATER = 246
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+CLONE_NEWNET = 0x40000000
+NETLINK_RCVBUF = 1024 * 1024
+NETLINK_BATCH_WINDOW = 256
+TARGET_CACHE_SIZE = 65536
+
+# Only routes carrying these are ever taken for ours, whatever their table, interface or destination
+MANAGED_ROUTE_PROTOCOLS = (RTPROT_ROUTE_UPDATER, RTPROT_AGGREGATE)
+
+# Route protocol names printed by `ip -json route show`
+IP_ROUTE_PROTOCOLS = {'redirect': 1, 'kernel': 2, 'boot': RTPROT_BOOT, 'static': RTPROT_STATIC}
+
+# errno by the message ip prints for it after "RTNETLINK answers: "
+IP_ERRNOS = {os.strerror(code): code for code in errno.errorcode}
+
+# Always rejected by the kernel, its error report tells that ip -batch is done with the lines before it
+IP_BATCH_SENTINEL = "nexthop del id 0"
+
+# Conntrack netlink constants (linux/netfilter/nfnetlink.h, linux/netfilter/nfnetlink_conntrack.h)
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_CTNETLINK = 1
+IPCTNL_MSG_CT_GET = 1
+IPCTNL_MSG_CT_DELETE = 2
+CTA_TUPLE_ORIG = 1
+CTA_ZONE = 18
+CTA_FILTER = 25
+CTA_TUPLE_IP = 1
+CTA_IP_V4_DST = 2
+CTA_FILTER_ORIG_FLAGS = 1
+CTA_FILTER_FLAG_CTA_IP_DST = 1 << 1
+# Up to this many VIPs get a dump each filtered by the kernel, more share one dump of the whole table
+CONNTRACK_FILTERED_DUMPS = 16
+
+# ICMP message types (RFC 792) of the liveness probes
+ICMP_ECHOREPLY = 0
+ICMP_ECHO = 8
+
+# Latest TrafficDirector objects by name, written by the watch and read by the workers
+traffic_director_objects = {}
+
+# (generation, nodeIp, labels, route fingerprint) of the latest object of every TrafficDirector
+traffic_director_fingerprints = {}
+
+# Router shards, created once in main()
+shards = []
+
+# Reconcile worker tasks, referenced here so they are never garbage collected
+route_workers = []
+
+# Lease leader elector when ROUTE_UPDATER_LEADER_ELECTION is on
+elector = None
+
+# Recorder of the TrafficDirector lists and watch events when ROUTE_UPDATER_RECORD is set
+recorder = None
+
+# InternalIPs by Node name, and the nodeIps of Nodes that are not Ready, with ROUTE_UPDATER_NODE_WATCH.
+# Only the Node watch thread uses them, each shard is handed every new down_nodes under its routes_lock, see update_down_nodes()
+node_addresses = {}
+down_nodes = frozenset()
+
+class RouteError(OSError):
+    """Route operation rejected by the kernel, errno carries the netlink error code"""
+
+def _setns(fd):
+    """Switch the calling thread into the network namespace referred to by fd"""
+    if hasattr(os, 'setns'):
+        os.setns(fd, CLONE_NEWNET)
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def _rtattr(attr_type, payload):
+    """Encode a single rtnetlink attribute, padded to 4 bytes"""
+    length = 4 + len(payload)
+    return struct.pack("=HH", length, attr_type) + payload + b"\0" * ((-length) % 4)
+
+def _parse_rtattrs(data, offset, end):
+    """Decode the rtnetlink attributes in data[offset:end] into a {type: payload} dict"""
+    attrs = {}
+    while offset + 4 <= end:
+        length, attr_type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        attrs[attr_type & 0x3fff] = data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+def ip_to_int(ip):
+    """Pack a dotted IPv4 address into an int, raises OSError if it is not one"""
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+def dst_prefix(dst):
+    """(network, prefix length) of a route destination, a VIP for its /32 or a (network, length) aggregate"""
+    return dst if isinstance(dst, tuple) else (dst, 32)
+
+def dst_to_str(dst):
+    network, length = dst_prefix(dst)
+    return f"{int_to_ip(network)}/{length}"
+
+def dst_vips(dst):
+    """The VIPs routed by a route destination"""
+    if not isinstance(dst, tuple):
+        return (dst,)
+    network, length = dst
+    return range(network, network + (1 << (32 - length)))
+
+def _in_netns(netns, function):
+    """Run function with the calling thread inside netns, returns its result"""
+    own_ns = os.open("/proc/self/ns/net", os.O_RDONLY)
+    target_ns = os.open(f"/var/run/netns/{netns}", os.O_RDONLY)
+    try:
+        _setns(target_ns)
+        try:
+            return function()
+        finally:
+            _setns(own_ns)
+    finally:
+        os.close(target_ns)
+        os.close(own_ns)
+
+def _netlink_socket(groups=0, protocol=NETLINK_ROUTE):
+    """Open an rtnetlink (or other protocol) socket in the current namespace, subscribed to the multicast groups bitmask"""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NETLINK_RCVBUF)
+    sock.bind((0, groups))
+    return sock
+
+def _split_messages(data):
+    """Split a netlink datagram, returns (type, seq, data, payload offset, end) per message"""
+    messages = []
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type, _, seq, _ = struct.unpack_from("=LHHLL", data, offset)
+        if length < 16:
+            break
+        messages.append((msg_type, seq, data, offset + 16, offset + length))
+        offset += (length + 3) & ~3
+    return messages
+
+def managed_table(table):
+    """Return True for the routing tables route-updater programs VIP routes in"""
+    return table == RT_TABLE_MAIN or table >= TD_TABLE_BASE
+
+class RouteBackend:
+    """Interface of the route backends, one per router shard, selected by ROUTE_UPDATER_BACKEND.
+
+    VIPs and gateways are IPv4 addresses packed into ints, see ip_to_int().
+    Where a route takes a vip, an aggregate (network, length) tuple stands for
+    the route to that prefix, see dst_prefix(). Failures raise RouteError
+    carrying the kernel errno.
+    """
+
+    # Kernel route notifications of the shard's namespace reflect what this backend programs, see RouteMonitor
+    monitored = True
+
+    def close(self):
+        pass
+
+    def add_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        """Add <vip>/32 via node_ips, raises RouteError(EEXIST) if the route is already present"""
+        raise NotImplementedError
+
+    def replace_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        """Add <vip>/32 via node_ips (or a nexthop object id), atomically replacing any existing route and its nexthop set"""
+        raise NotImplementedError
+
+    def delete_route(self, vip, table=RT_TABLE_MAIN):
+        """Delete the <vip>/32 route, raises RouteError(ESRCH) if there is no such route"""
+        raise NotImplementedError
+
+    def apply(self, ops):
+        """Apply (action, vip, node_ips, table) operations as one transaction, returns a RouteError or None per op"""
+        results = []
+        for action, vip, node_ips, table in ops:
+            try:
+                if action == 'delete':
+                    self.delete_route(vip, table)
+                elif action == 'replace':
+                    self.replace_route(vip, node_ips, table)
+                else:
+                    self.add_route(vip, node_ips, table)
+                results.append(None)
+            except RouteError as e:
+                results.append(e)
+        return results
+
+    def flush_table(self, table):
+        """Delete every route we may own in table, whether we know about it or not, returns how many there were"""
+        routes = self.dump_routes(table)
+        for error in self.apply([('delete', vip, (), table) for vip in routes]):
+            if error and error.errno != errno.ESRCH:
+                raise error
+        return len(routes)
+
+    def add_rule(self, table):
+        """Add the policy rule looking up table at TD_RULE_PRIORITY, raises RouteError(EEXIST) if it is already present"""
+        raise NotImplementedError
+
+    def delete_rule(self, table):
+        """Delete the policy rule looking up table, raises RouteError(ENOENT) if there is no such rule"""
+        raise NotImplementedError
+
+    def dump_rules(self):
+        """Return the TrafficDirector tables looked up by a policy rule at TD_RULE_PRIORITY"""
+        raise NotImplementedError
+
+    def replace_nexthop(self, nhid, node_ip):
+        """Create or update nexthop object nhid via node_ip, routes using it follow without being touched"""
+        raise NotImplementedError
+
+    def replace_nexthop_group(self, nhid, member_ids):
+        """Create or update multipath group nhid over the nexthop objects member_ids"""
+        raise NotImplementedError
+
+    def delete_nexthop(self, nhid):
+        """Delete nexthop object nhid, raises RouteError(ENOENT) if it does not exist"""
+        raise NotImplementedError
+
+    def dump_nexthops(self):
+        """Return {id: gateway, or sorted member id tuple of a group} of the nexthop objects we created, on any previous run"""
+        raise NotImplementedError
+
+    def dump_routes(self, table=RT_TABLE_MAIN):
+        """Return {vip: sorted gateway tuple} for the /32 and aggregate routes we may own on the egress interface of table"""
+        return self.dump_route_tables(table).get(table, {})
+
+    def dump_route_tables(self, table=None):
+        """Return {table: {vip: sorted gateway tuple}} like dump_routes() for the main and TrafficDirector tables, or just table"""
+        raise NotImplementedError
+
+    def dump_route_nexthops(self):
+        """Return {table: {vip: nexthop id}} of the routes dump_route_tables() returns that go through a nexthop object"""
+        raise NotImplementedError
+
+    def parse_route(self, data, offset, end):
+        """Decode an rtmsg into (dst, protocol, gateways, table), None unless it is a /32 or one of our aggregates in the main or a TrafficDirector table.
+
+        gateways is None when the route does not leave through the egress interface.
+        """
+        family, dst_len, _, _, table, protocol, _, route_type, _ = struct.unpack_from("=BBBBBBBBI", data, offset)
+        if family != socket.AF_INET or route_type != RTN_UNICAST or (dst_len != 32 and protocol != RTPROT_AGGREGATE):
+            return None
+        attrs = _parse_rtattrs(data, offset + 12, end)
+        if RTA_TABLE in attrs:
+            table = struct.unpack("=I", attrs[RTA_TABLE])[0]
+        if not managed_table(table) or RTA_DST not in attrs:
+            return None
+        network = struct.unpack("!I", attrs[RTA_DST])[0]
+        return network if dst_len == 32 else (network, dst_len), protocol, self._parse_nexthops(attrs), table
+
+    def parse_rule(self, data, offset, end):
+        """Decode a fib_rule_hdr, returns the table of a TrafficDirector table rule or None"""
+        table = struct.unpack_from("=BBBBBBBBI", data, offset)[4]
+        attrs = _parse_rtattrs(data, offset + 12, end)
+        if FRA_TABLE in attrs:
+            table = struct.unpack("=I", attrs[FRA_TABLE])[0]
+        priority = struct.unpack("=I", attrs[FRA_PRIORITY])[0] if FRA_PRIORITY in attrs else 0
+        if priority != TD_RULE_PRIORITY or table < TD_TABLE_BASE or attrs.get(FRA_PROTOCOL) != bytes([RTPROT_ROUTE_UPDATER]):
+            return None
+        return table
+
+    def _parse_nexthops(self, attrs):
+        """Return the sorted distinct gateways of a route on the egress interface, None for routes elsewhere"""
+        if RTA_MULTIPATH not in attrs:
+            if RTA_OIF not in attrs or struct.unpack("=i", attrs[RTA_OIF])[0] != self.ifindex:
+                return None
+            return tuple(struct.unpack("!I", attrs[RTA_GATEWAY])) if RTA_GATEWAY in attrs else ()
+
+        payload = attrs[RTA_MULTIPATH]
+        gateways = []
+        offset = 0
+        while offset + 8 <= len(payload):
+            length, _, _, ifindex = struct.unpack_from("=HBBi", payload, offset)
+            if length < 8:
+                break
+            if ifindex != self.ifindex:
+                return None
+            nexthop_attrs = _parse_rtattrs(payload, offset + 8, offset + length)
+            if RTA_GATEWAY in nexthop_attrs:
+                gateways.append(struct.unpack("!I", nexthop_attrs[RTA_GATEWAY])[0])
+            offset += (length + 3) & ~3
+        # A group over the objects of two TrafficDirectors on the same node lists that node twice
+        return tuple(sorted(set(gateways)))
+
+class NetlinkRouteBackend(RouteBackend):
+    """Program routes through a long-lived rtnetlink socket opened inside the router namespace"""
+
+    def __init__(self, netns, interface, logger):
+        self.netns = netns
+        self.interface = interface
+        self.logger = logger
+        self.seq = 0
+        # Reconcile workers share the socket, a request and its ack must not interleave
+        self.lock = threading.Lock()
+
+        # Only the socket needs to live in the router namespace, the egress
+        # interface is resolved there too
+        self.sock, self.ifindex = _in_netns(netns, lambda: (_netlink_socket(), socket.if_nametoindex(interface)))
+        try:
+            # Lets the kernel filter table dumps, older kernels dump everything and we filter
+            self.sock.setsockopt(SOL_NETLINK, NETLINK_GET_STRICT_CHK, 1)
+        except OSError as e:
+            logger.debug("No strict netlink dump checking: %s", e)
+
+        logger.info(f"Opened rtnetlink socket in netns {netns} (dev {interface} ifindex {self.ifindex})")
+
+    def close(self):
+        self.sock.close()
+
+    def add_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        """Add <vip>/32 via node_ips, raises RouteError(EEXIST) if the route is already present"""
+        self._request(*self._route_message('add', vip, node_ips, table))
+
+    def replace_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        """Add <vip>/32 via node_ips (or a nexthop object id), atomically replacing any existing route and its nexthop set"""
+        self._request(*self._route_message('replace', vip, node_ips, table))
+
+    def delete_route(self, vip, table=RT_TABLE_MAIN):
+        """Delete the <vip>/32 route, raises RouteError(ESRCH) if there is no such route"""
+        self._request(*self._route_message('delete', vip, (), table))
+
+    def apply(self, ops):
+        """Pipeline (action, vip, node_ips, table) operations on the socket, returns a RouteError or None per op"""
+        results = [None] * len(ops)
+        pending = {}
+        with self.lock:
+            for index, (action, vip, node_ips, table) in enumerate(ops):
+                pending[self._send(*self._route_message(action, vip, node_ips, table))] = index
+                # Bound the requests in flight so the acks never overrun the receive buffer
+                if len(pending) >= NETLINK_BATCH_WINDOW:
+                    self._collect_acks(pending, results, NETLINK_BATCH_WINDOW // 2)
+            self._collect_acks(pending, results, 0)
+        return results
+
+    def replace_nexthop(self, nhid, node_ip):
+        """Create or update nexthop object nhid via node_ip, routes using it follow without being touched"""
+        nhmsg = struct.pack("=BBBBI", socket.AF_INET, RT_SCOPE_UNIVERSE, RTPROT_ROUTE_UPDATER, 0, 0)
+        attrs = (
+            _rtattr(NHA_ID, struct.pack("=I", nhid))
+            + _rtattr(NHA_OIF, struct.pack("=I", self.ifindex))
+            + _rtattr(NHA_GATEWAY, struct.pack("!I", node_ip))
+        )
+        with self.lock:
+            self._ack(self._send(RTM_NEWNEXTHOP, NLM_F_CREATE | NLM_F_REPLACE, nhmsg + attrs))
+
+    def replace_nexthop_group(self, nhid, member_ids):
+        """Create or update multipath group nhid over the nexthop objects member_ids"""
+        nhmsg = struct.pack("=BBBBI", socket.AF_UNSPEC, RT_SCOPE_UNIVERSE, RTPROT_ROUTE_UPDATER, 0, 0)
+        members = b"".join(struct.pack("=IBBH", member_id, 0, 0, 0) for member_id in member_ids)
+        attrs = (
+            _rtattr(NHA_ID, struct.pack("=I", nhid))
+            + _rtattr(NHA_GROUP, members)
+            + _rtattr(NHA_GROUP_TYPE, struct.pack("=H", NEXTHOP_GRP_TYPE_MPATH))
+        )
+        with self.lock:
+            self._ack(self._send(RTM_NEWNEXTHOP, NLM_F_CREATE | NLM_F_REPLACE, nhmsg + attrs))
+
+    def delete_nexthop(self, nhid):
+        """Delete nexthop object nhid, raises RouteError(ENOENT) if it does not exist"""
+        nhmsg = struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0)
+        with self.lock:
+            self._ack(self._send(RTM_DELNEXTHOP, 0, nhmsg + _rtattr(NHA_ID, struct.pack("=I", nhid))))
+
+    def dump_nexthops(self):
+        nhmsg = struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0)
+        nexthops = {}
+        with self.lock:
+            seq = self._send(RTM_GETNEXTHOP, NLM_F_DUMP, nhmsg, ack=False)
+            while True:
+                for msg_type, reply_seq, data, offset, end in self._receive():
+                    if reply_seq != seq:
+                        continue
+                    if msg_type == NLMSG_DONE:
+                        return nexthops
+                    if msg_type == NLMSG_ERROR:
+                        error = -struct.unpack_from("=i", data, offset)[0]
+                        raise RouteError(error, os.strerror(error))
+                    if msg_type != RTM_NEWNEXTHOP:
+                        continue
+                    protocol = struct.unpack_from("=BBBBI", data, offset)[2]
+                    attrs = _parse_rtattrs(data, offset + 8, end)
+                    nhid = struct.unpack("=I", attrs[NHA_ID])[0] if NHA_ID in attrs else 0
+                    if protocol != RTPROT_ROUTE_UPDATER or nhid < NEXTHOP_ID_BASE:
+                        continue
+                    if NHA_GROUP in attrs:
+                        # struct nexthop_grp: id, weight and padding
+                        group = attrs[NHA_GROUP]
+                        nexthops[nhid] = tuple(sorted(struct.unpack_from("=I", group, index)[0] for index in range(0, len(group) - 7, 8)))
+                    else:
+                        nexthops[nhid] = struct.unpack("!I", attrs[NHA_GATEWAY])[0] if NHA_GATEWAY in attrs else None
+
+    def dump_route_tables(self, table=None):
+        """Return {table: {vip: sorted gateway tuple}} like dump_routes() for the main and TrafficDirector tables, or just table"""
+        rtmsg = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        attrs = _rtattr(RTA_TABLE, struct.pack("=I", table)) if table else b""
+        with self.lock:
+            return self._dump_routes(self._send(RTM_GETROUTE, NLM_F_DUMP, rtmsg + attrs, ack=False), table)
+
+    def dump_route_nexthops(self):
+        rtmsg = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        with self.lock:
+            return self._dump_routes(self._send(RTM_GETROUTE, NLM_F_DUMP, rtmsg, ack=False), None, nexthop_ids=True)
+
+    def _dump_routes(self, seq, only_table, nexthop_ids=False):
+        tables = {}
+        while True:
+            for msg_type, reply_seq, data, offset, end in self._receive():
+                if reply_seq != seq:
+                    continue
+                if msg_type == NLMSG_DONE:
+                    # A filtered dump of a table that does not exist fails with ENOENT
+                    error = -struct.unpack_from("=i", data, offset)[0] if end - offset >= 4 else 0
+                    if error and error != errno.ENOENT:
+                        raise RouteError(error, os.strerror(error))
+                    return tables
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", data, offset)[0]
+                    if error == errno.ENOENT and only_table:
+                        return tables
+                    raise RouteError(error, os.strerror(error))
+                if msg_type != RTM_NEWROUTE:
+                    continue
+
+                route = self.parse_route(data, offset, end)
+                if not route or route[1] not in MANAGED_ROUTE_PROTOCOLS or route[2] is None or only_table not in (None, route[3]):
+                    continue
+                if not nexthop_ids:
+                    tables.setdefault(route[3], {})[route[0]] = route[2]
+                    continue
+                attrs = _parse_rtattrs(data, offset + 12, end)
+                if RTA_NH_ID in attrs:
+                    tables.setdefault(route[3], {})[route[0]] = struct.unpack("=I", attrs[RTA_NH_ID])[0]
+
+    def add_rule(self, table):
+        """Add the policy rule looking up table at TD_RULE_PRIORITY, raises RouteError(EEXIST) if it is already present"""
+        with self.lock:
+            self._ack(self._send(RTM_NEWRULE, NLM_F_CREATE | NLM_F_EXCL, self._rule_message(table)))
+
+    def delete_rule(self, table):
+        """Delete the policy rule looking up table, raises RouteError(ENOENT) if there is no such rule"""
+        with self.lock:
+            self._ack(self._send(RTM_DELRULE, 0, self._rule_message(table)))
+
+    def dump_rules(self):
+        """Return the TrafficDirector tables looked up by a policy rule at TD_RULE_PRIORITY"""
+        header = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        tables = set()
+        with self.lock:
+            seq = self._send(RTM_GETRULE, NLM_F_DUMP, header, ack=False)
+            while True:
+                for msg_type, reply_seq, data, offset, end in self._receive():
+                    if reply_seq != seq:
+                        continue
+                    if msg_type == NLMSG_DONE:
+                        return tables
+                    if msg_type == NLMSG_ERROR:
+                        error = -struct.unpack_from("=i", data, offset)[0]
+                        raise RouteError(error, os.strerror(error))
+                    if msg_type != RTM_NEWRULE:
+                        continue
+                    rule = self.parse_rule(data, offset, end)
+                    if rule:
+                        tables.add(rule)
+
+    def _rule_message(self, table):
+        # Tables above 255 only fit the FRA_TABLE attribute
+        header = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 0, 0, 0, FR_ACT_TO_TBL, 0)
+        return (
+            header
+            + _rtattr(FRA_PRIORITY, struct.pack("=I", TD_RULE_PRIORITY))
+            + _rtattr(FRA_TABLE, struct.pack("=I", table))
+            + _rtattr(FRA_PROTOCOL, bytes([RTPROT_ROUTE_UPDATER]))
+        )
+
+    def _route_message(self, action, dst, node_ips, table=RT_TABLE_MAIN):
+        """Build (msg_type, flags, payload) for an add, replace or delete of the route to dst in table"""
+        network, length = dst_prefix(dst)
+        protocol = RTPROT_ROUTE_UPDATER if length == 32 else RTPROT_AGGREGATE
+        if action == 'delete':
+            # Unspecified protocol matches routes added by older releases too
+            msg_type, flags, protocol = RTM_DELROUTE, 0, 0
+        elif action == 'replace':
+            msg_type, flags = RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE
+        else:
+            msg_type, flags = RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL
+
+        rtmsg = struct.pack(
+            "=BBBBBBBBI",
+            socket.AF_INET, length, 0, 0,
+            table if table < 256 else 0, protocol, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0
+        )
+        attrs = _rtattr(RTA_DST, struct.pack("!I", network)) + _rtattr(RTA_TABLE, struct.pack("=I", table))
+        if isinstance(node_ips, int):
+            # Route through a nexthop object, the object holds the gateways
+            attrs += _rtattr(RTA_NH_ID, struct.pack("=I", node_ips))
+        elif len(node_ips) > 1:
+            # One route spreading flows over every node announcing the VIP
+            nexthops = b""
+            for node_ip in node_ips:
+                gateway = _rtattr(RTA_GATEWAY, struct.pack("!I", node_ip))
+                nexthops += struct.pack("=HBBi", 8 + len(gateway), 0, 0, self.ifindex) + gateway
+            attrs += _rtattr(RTA_MULTIPATH, nexthops)
+        elif node_ips:
+            attrs += _rtattr(RTA_OIF, struct.pack("=i", self.ifindex))
+            attrs += _rtattr(RTA_GATEWAY, struct.pack("!I", node_ips[0]))
+        # A delete names only the destination so it matches inline and nexthop object routes alike
+        return msg_type, flags, rtmsg + attrs
+
+    def _send(self, msg_type, flags, payload, ack=True):
+        """Send one request, returns its sequence number"""
+        self.seq += 1
+        if ack:
+            flags |= NLM_F_ACK
+        header = struct.pack("=LHHLL", 16 + len(payload), msg_type, flags | NLM_F_REQUEST, self.seq, 0)
+        self.sock.send(header + payload)
+        return self.seq
+
+    def _receive(self):
+        """Read one datagram, returns (type, seq, data, payload offset, end) per netlink message"""
+        return _split_messages(self.sock.recv(NETLINK_RCVBUF))
+
+    def _collect_acks(self, pending, results, until):
+        """Read acks for pending {seq: index} until at most `until` are outstanding"""
+        while len(pending) > until:
+            for msg_type, seq, data, offset, _ in self._receive():
+                if msg_type == NLMSG_ERROR and seq in pending:
+                    index = pending.pop(seq)
+                    error = -struct.unpack_from("=i", data, offset)[0]
+                    if error:
+                        results[index] = RouteError(error, os.strerror(error))
+
+    def _ack(self, seq):
+        """Wait for the ack of seq, raising the RouteError it carries"""
+        results = [None]
+        self._collect_acks({seq: 0}, results, 0)
+        if results[0]:
+            raise results[0]
+
+    def _request(self, msg_type, flags, payload):
+        """Send one request and wait for its ack"""
+        with self.lock:
+            self._ack(self._send(msg_type, flags, payload))
+
+class IpRouteBackend(RouteBackend):
+    """Program routes by running the iproute2 `ip` command in the router namespace, one process per operation"""
+
+    def __init__(self, netns, interface, logger):
+        self.netns = netns
+        self.interface = interface
+        self.logger = logger
+        # Route notifications name the interface by index, see RouteMonitor
+        self.lock = threading.Lock()
+        self.ifindex = _in_netns(netns, lambda: socket.if_nametoindex(interface))
+        logger.info(f"Programming routes with ip in netns {netns} (dev {interface})")
+
+    def add_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        self._change(self._route_command('add', vip, node_ips, table))
+
+    def replace_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        self._change(self._route_command('replace', vip, node_ips, table))
+
+    def delete_route(self, vip, table=RT_TABLE_MAIN):
+        self._change(self._route_command('delete', vip, (), table))
+
+    def replace_nexthop(self, nhid, node_ip):
+        self._change(['nexthop', 'replace', 'id', str(nhid), 'via', int_to_ip(node_ip), 'dev', self.interface, 'proto', str(RTPROT_ROUTE_UPDATER)])
+
+    def replace_nexthop_group(self, nhid, member_ids):
+        self._change(['nexthop', 'replace', 'id', str(nhid), 'group', '/'.join(map(str, member_ids)), 'proto', str(RTPROT_ROUTE_UPDATER)])
+
+    def delete_nexthop(self, nhid):
+        self._change(['nexthop', 'del', 'id', str(nhid)])
+
+    def dump_nexthops(self):
+        nexthops = json.loads(self._run(['-json', 'nexthop', 'show']) or "[]")
+        return {
+            nh['id']: tuple(sorted(member['id'] for member in nh['group'])) if 'group' in nh else ip_to_int(nh['gateway']) if 'gateway' in nh else None
+            for nh in nexthops if str(nh.get('protocol')) == str(RTPROT_ROUTE_UPDATER) and nh.get('id', 0) >= NEXTHOP_ID_BASE
+        }
+
+    def dump_route_tables(self, table=None):
+        tables = {}
+        try:
+            output = self._run(['-json', 'route', 'show', 'table', str(table or 'all')])
+        except RouteError as e:
+            if table and e.errno == errno.ENOENT:
+                return tables
+            raise
+        for entry in json.loads(output or "[]"):
+            route = self._parse_route_entry(entry, table or RT_TABLE_MAIN)
+            if route and route[1] in MANAGED_ROUTE_PROTOCOLS and route[2] is not None:
+                tables.setdefault(route[3], {})[route[0]] = route[2]
+        return tables
+
+    def dump_route_nexthops(self):
+        tables = {}
+        for entry in json.loads(self._run(['-json', 'route', 'show', 'table', 'all']) or "[]"):
+            route = self._parse_route_entry(entry)
+            if route and route[1] in MANAGED_ROUTE_PROTOCOLS and route[2] is not None and 'nhid' in entry:
+                tables.setdefault(route[3], {})[route[0]] = entry['nhid']
+        return tables
+
+    def add_rule(self, table):
+        self._change(['rule', 'add', 'pref', str(TD_RULE_PRIORITY), 'table', str(table), 'protocol', str(RTPROT_ROUTE_UPDATER)])
+
+    def delete_rule(self, table):
+        self._change(['rule', 'del', 'pref', str(TD_RULE_PRIORITY), 'table', str(table), 'protocol', str(RTPROT_ROUTE_UPDATER)])
+
+    def dump_rules(self):
+        rules = json.loads(self._run(['-json', 'rule', 'show']) or "[]")
+        return {
+            int(rule['table']) for rule in rules
+            if rule.get('priority') == TD_RULE_PRIORITY and str(rule.get('protocol')) == str(RTPROT_ROUTE_UPDATER)
+            and str(rule.get('table')).isdigit() and int(rule['table']) >= TD_TABLE_BASE
+        }
+
+    def _parse_route_entry(self, entry, default_table=RT_TABLE_MAIN):
+        """Decode a route of `ip -json route show` like parse_route(), None unless it is a unicast /32 or aggregate of a managed table"""
+        dst = entry.get('dst', '')
+        if entry.get('type', 'unicast') != 'unicast' or dst == 'default':
+            return None
+        # Routes of the main table, or of the one table shown, do not name theirs
+        table = str(entry.get('table', default_table))
+        table = RT_TABLE_MAIN if table == 'main' else int(table) if table.isdigit() else 0
+        if not managed_table(table):
+            return None
+        # ip leaves out the default proto boot and prints unnamed protocols as numbers
+        protocol = str(entry.get('protocol', 'boot'))
+        protocol = IP_ROUTE_PROTOCOLS.get(protocol, int(protocol) if protocol.isdigit() else -1)
+        address, _, length = dst.partition('/')
+        length = int(length or 32)
+        if length != 32 and protocol != RTPROT_AGGREGATE:
+            return None
+        try:
+            network = ip_to_int(address)
+        except OSError:
+            return None
+        dst = network if length == 32 else (network, length)
+        nexthops = entry.get('nexthops') or [entry]
+        if any(nexthop.get('dev') != self.interface for nexthop in nexthops):
+            return dst, protocol, None, table
+        return dst, protocol, tuple(sorted({ip_to_int(nexthop['gateway']) for nexthop in nexthops if 'gateway' in nexthop})), table
+
+    def _route_command(self, action, dst, node_ips, table=RT_TABLE_MAIN):
+        """Build the ip arguments of an add, replace or delete of the route to dst in table"""
+        if action == 'delete':
+            # Only the destination, so it matches inline and nexthop object routes of any protocol alike
+            return ['route', 'del', dst_to_str(dst), 'table', str(table)]
+        protocol = str(RTPROT_ROUTE_UPDATER if dst_prefix(dst)[1] == 32 else RTPROT_AGGREGATE)
+        command = ['route', action, dst_to_str(dst), 'table', str(table), 'proto', protocol]
+        if isinstance(node_ips, int):
+            return command + ['nhid', str(node_ips)]
+        if len(node_ips) > 1:
+            for node_ip in node_ips:
+                command += ['nexthop', 'via', int_to_ip(node_ip), 'dev', self.interface]
+            return command
+        return command + ['via', int_to_ip(node_ips[0]), 'dev', self.interface]
+
+    def _change(self, args):
+        """Apply one route or nexthop change, raises the RouteError ip reports"""
+        self._run(args)
+
+    def _run(self, args):
+        """Run ip with args in the router namespace, returns its output or raises the RouteError it reports"""
+        result = subprocess.run(['ip', '-netns', self.netns] + args, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise _ip_error(result.stderr)
+        return result.stdout
+
+class IpBatchRouteBackend(IpRouteBackend):
+    """Program routes through one long-lived `ip -force -batch -` process in the router namespace.
+
+    A whole transaction is written to the process at once instead of running
+    ip per route. -force carries on past failed lines and reports each one as
+    its error message followed by "Command failed -:<line number>", which
+    attributes the errors to the ops.
+    """
+
+    def __init__(self, netns, interface, logger):
+        super().__init__(netns, interface, logger)
+        self.process = None
+        # Lines written to the current process, ip numbers its error reports by them
+        self.lines = 0
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+    def apply(self, ops):
+        """Write the operations to the ip process as one batch, returns a RouteError or None per op"""
+        return self._batch([self._route_command(action, vip, node_ips, table) for action, vip, node_ips, table in ops])
+
+    def _change(self, args):
+        error = self._batch([args])[0]
+        if error:
+            raise error
+
+    def _batch(self, commands):
+        results = []
+        with self.lock:
+            for start in range(0, len(commands), NETLINK_BATCH_WINDOW):
+                results += self._write_window(commands[start:start + NETLINK_BATCH_WINDOW])
+        return results
+
+    def _write_window(self, commands):
+        """Write commands followed by IP_BATCH_SENTINEL, whose error report marks the end of their results"""
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(
+                ['ip', '-netns', self.netns, '-force', '-batch', '-'],
+                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+            )
+            self.lines = 0
+            self.logger.info(f"Started ip -batch process {self.process.pid} in netns {self.netns}")
+        
+        first = self.lines + 1
+        self.lines += len(commands) + 1
+        results = [None] * len(commands)
+        message = []
+        try:
+            # A window stays far below the pipe buffer, ip never blocks on stderr while we write
+            self.process.stdin.write("".join(' '.join(command) + "\n" for command in commands) + IP_BATCH_SENTINEL + "\n")
+            self.process.stdin.flush()
+            for line in self.process.stderr:
+                if not line.startswith("Command failed -:"):
+                    if line.strip():
+                        message.append(line)
+                    continue
+                number = int(line.rsplit(':', 1)[1])
+                if number == self.lines:
+                    return results
+                if first <= number < self.lines:
+                    results[number - first] = _ip_error("".join(message))
+                message = []
+        except OSError as e:
+            self.logger.error(f"Lost ip -batch process in netns {self.netns}: {e}")
+        
+        # ip exited before reporting on the whole window, whatever it did not get to is retried
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+        error = RouteError(errno.EIO, "ip -batch exited")
+        return [result or error for result in results]
+
+def _ip_error(message):
+    """Build the RouteError of an ip error message, extended ack messages carry no errno and map to EINVAL"""
+    lines = message.strip().splitlines() or ["ip failed without an error message"]
+    prefix = "RTNETLINK answers: "
+    code = IP_ERRNOS.get(lines[-1][len(prefix):], errno.EINVAL) if lines[-1].startswith(prefix) else errno.EINVAL
+    if any(line.endswith("FIB table does not exist.") for line in lines):
+        # The kernel's ENOENT for a dump of a missing table
+        return RouteError(errno.ENOENT, lines[0])
+    return RouteError(code, lines[-1])
+
+class DryRunRouteBackend(RouteBackend):
+    """Keep the routes in memory instead of programming them, to see what route-updater would do"""
+
+    monitored = False
+
+    def __init__(self, netns, interface, logger):
+        self.netns = netns
+        self.interface = interface
+        self.lock = threading.Lock()
+        self.ifindex = 0
+        self.routes = {}
+        self.nexthops = {}
+        self.rules = set()
+        logger.warning(f"Dry run, routes of netns {netns} (dev {interface}) are only kept in memory")
+
+    def add_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        with self.lock:
+            routes = self.routes.setdefault(table, {})
+            if vip in routes:
+                raise RouteError(errno.EEXIST, os.strerror(errno.EEXIST))
+            routes[vip] = node_ips
+
+    def replace_route(self, vip, node_ips, table=RT_TABLE_MAIN):
+        with self.lock:
+            self.routes.setdefault(table, {})[vip] = node_ips
+
+    def delete_route(self, vip, table=RT_TABLE_MAIN):
+        with self.lock:
+            if self.routes.get(table, {}).pop(vip, None) is None:
+                raise RouteError(errno.ESRCH, os.strerror(errno.ESRCH))
+            if not self.routes[table]:
+                del self.routes[table]
+
+    def add_rule(self, table):
+        with self.lock:
+            if table in self.rules:
+                raise RouteError(errno.EEXIST, os.strerror(errno.EEXIST))
+            self.rules.add(table)
+
+    def delete_rule(self, table):
+        with self.lock:
+            if table not in self.rules:
+                raise RouteError(errno.ENOENT, os.strerror(errno.ENOENT))
+            self.rules.discard(table)
+
+    def dump_rules(self):
+        with self.lock:
+            return set(self.rules)
+
+    def replace_nexthop(self, nhid, node_ip):
+        with self.lock:
+            self.nexthops[nhid] = node_ip
+
+    def replace_nexthop_group(self, nhid, member_ids):
+        with self.lock:
+            self.nexthops[nhid] = tuple(member_ids)
+
+    def delete_nexthop(self, nhid):
+        with self.lock:
+            if self.nexthops.pop(nhid, None) is None:
+                raise RouteError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+    def dump_nexthops(self):
+        with self.lock:
+            return dict(self.nexthops)
+
+    def dump_route_tables(self, table=None):
+        with self.lock:
+            return {
+                number: {vip: self._gateways(node_ips) if isinstance(node_ips, int) else node_ips for vip, node_ips in routes.items()}
+                for number, routes in self.routes.items() if table in (None, number)
+            }
+
+    def dump_route_nexthops(self):
+        with self.lock:
+            return {
+                number: {vip: node_ips for vip, node_ips in routes.items() if isinstance(node_ips, int)}
+                for number, routes in self.routes.items() if any(isinstance(node_ips, int) for node_ips in routes.values())
+            }
+
+    def _gateways(self, nhid):
+        """Resolve a nexthop object or group into the gateways the kernel would dump for its routes"""
+        target = self.nexthops.get(nhid, ())
+        if isinstance(target, tuple):
+            return tuple(sorted({self.nexthops[member] for member in target if member in self.nexthops}))
+        return (target,)
+
+ROUTE_BACKENDS = {
+    'netlink': NetlinkRouteBackend,
+    'ip': IpRouteBackend,
+    'ip-batch': IpBatchRouteBackend,
+    'dry-run': DryRunRouteBackend,
+}
+
+class ConntrackFlusher:
+    """Delete the conntrack entries of VIPs through a ctnetlink socket opened inside the router namespace.
+
+    A flow keeps the conntrack entry it got before the route of its VIP
+    changed, and with it whatever was decided along the old route. Deleting
+    the entries makes the next packet of each flow start over. The kernel
+    only dumps the entries of each VIP (CTA_FILTER, 5.8+), older kernels
+    ignore the filter and the VIPs are picked from a dump of every entry.
+    """
+
+    def __init__(self, netns, logger):
+        self.netns = netns
+        self.logger = logger
+        self.seq = 0
+        # Reconciles of the shard share the socket, a dump and its deletes must not interleave
+        self.lock = threading.Lock()
+        self.sock = _in_netns(netns, lambda: _netlink_socket(protocol=NETLINK_NETFILTER))
+        logger.info(f"Opened ctnetlink socket in netns {netns}")
+
+    def close(self):
+        self.sock.close()
+
+    def flush(self, vips):
+        """Delete every IPv4 conntrack entry whose original destination is one of vips, returns how many there were"""
+        with self.lock:
+            if len(vips) <= CONNTRACK_FILTERED_DUMPS:
+                entries = [entry for vip in sorted(vips) for entry in self._dump(vips, self._filter(vip))]
+            else:
+                entries = self._dump(vips, b"")
+            deleted, errors = 0, []
+            pending = set()
+            for entry in entries:
+                pending.add(self._send(IPCTNL_MSG_CT_DELETE, NLM_F_ACK, entry))
+                # Bound the requests in flight so the acks never overrun the receive buffer
+                if len(pending) >= NETLINK_BATCH_WINDOW:
+                    deleted += self._collect_acks(pending, errors, NETLINK_BATCH_WINDOW // 2)
+            deleted += self._collect_acks(pending, errors, 0)
+        if errors:
+            raise errors[0]
+        return deleted
+
+    def _send(self, msg_type, flags, attrs):
+        """Send one conntrack request for the IPv4 table, returns its sequence number"""
+        self.seq += 1
+        nfgenmsg = struct.pack("=BBH", socket.AF_INET, 0, 0)
+        header = struct.pack("=LHHLL", 20 + len(attrs), (NFNL_SUBSYS_CTNETLINK << 8) | msg_type, flags | NLM_F_REQUEST, self.seq, 0)
+        self.sock.send(header + nfgenmsg + attrs)
+        return self.seq
+
+    def _filter(self, vip):
+        """Dump attributes asking the kernel for the entries whose original destination is vip only"""
+        # The kernel parses filters strictly, nested attributes must say so
+        tuple_ip = _rtattr(CTA_TUPLE_IP | NLA_F_NESTED, _rtattr(CTA_IP_V4_DST, struct.pack("!I", vip)))
+        flags = _rtattr(CTA_FILTER_ORIG_FLAGS, struct.pack("=I", CTA_FILTER_FLAG_CTA_IP_DST))
+        return _rtattr(CTA_TUPLE_ORIG | NLA_F_NESTED, tuple_ip) + _rtattr(CTA_FILTER | NLA_F_NESTED, flags)
+
+    def _dump(self, vips, attrs):
+        """Return the delete request attributes of the entries destined to vips, from a dump with attrs"""
+        seq = self._send(IPCTNL_MSG_CT_GET, NLM_F_DUMP, attrs)
+        entries = []
+        while True:
+            for msg_type, msg_seq, data, offset, end in _split_messages(self.sock.recv(NETLINK_RCVBUF)):
+                if msg_seq != seq:
+                    continue
+                if msg_type == NLMSG_DONE:
+                    return entries
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", data, offset)[0]
+                    raise RouteError(error, os.strerror(error))
+                attrs = _parse_rtattrs(data, offset + 4, end)
+                orig = attrs.get(CTA_TUPLE_ORIG, b"")
+                ip = _parse_rtattrs(orig, 0, len(orig)).get(CTA_TUPLE_IP, b"")
+                dst = _parse_rtattrs(ip, 0, len(ip)).get(CTA_IP_V4_DST)
+                if dst and struct.unpack("!I", dst)[0] in vips:
+                    # The original tuple names the entry, within its zone
+                    entry = _rtattr(CTA_TUPLE_ORIG, orig)
+                    if CTA_ZONE in attrs:
+                        entry += _rtattr(CTA_ZONE, attrs[CTA_ZONE])
+                    entries.append(entry)
+
+    def _collect_acks(self, pending, errors, until):
+        """Read acks for the pending sequence numbers until at most `until` are outstanding, returns how many succeeded"""
+        succeeded = 0
+        while len(pending) > until:
+            for msg_type, seq, data, offset, _ in _split_messages(self.sock.recv(NETLINK_RCVBUF)):
+                if msg_type != NLMSG_ERROR or seq not in pending:
+                    continue
+                pending.discard(seq)
+                error = -struct.unpack_from("=i", data, offset)[0]
+                if not error:
+                    succeeded += 1
+                elif error != errno.ENOENT:
+                    # Timed out or deleted by the kernel in the meantime is fine, anything else is reported
+                    errors.append(RouteError(error, os.strerror(error)))
+        return succeeded
+
+class Metric:
+    """Labelled Prometheus metric rendered in the text exposition format"""
+
+    def __init__(self, name, help_text, metric_type, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, "counter", labels)
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """Gauge set explicitly or, for unlabelled gauges, read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, "gauge", labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if self.function:
+            self.set(self.function())
+        return super().render()
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, labels=(), buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)):
+        super().__init__(name, help_text, "histogram", labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            # Buckets are cumulative, every bucket at or above the value counts it
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), **kwargs):
+        return self._register(Histogram(name, help_text, labels, **kwargs))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+events_received = metrics.counter("route_updater_events_total", "Watch events received by type", ["type"])
+events_skipped = metrics.counter("route_updater_events_skipped_total", "Watch events skipped because no route relevant field changed")
+reconcile_duration = metrics.histogram("route_updater_reconcile_duration_seconds", "Duration of TrafficDirector reconciles", ["result"])
+route_op_duration = metrics.histogram("route_updater_route_op_duration_seconds", "Duration of single route operations", ["op"])
+route_op_failures = metrics.counter("route_updater_route_op_failures_total", "Failed route operations by operation and errno", ["op", "error"])
+sync_duration = metrics.gauge("route_updater_sync_duration_seconds", "Duration of the last full kernel/API sync")
+workqueue_depth = metrics.gauge("route_updater_workqueue_depth", "TrafficDirectors waiting to be reconciled")
+workqueue_latency = metrics.histogram(
+    "route_updater_workqueue_latency_seconds", "Time a TrafficDirector waits in the queue before its reconcile starts",
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+workqueue_retries = metrics.counter("route_updater_workqueue_retries_total", "Reconciles requeued with backoff after a failure")
+managed_traffic_directors = metrics.gauge("route_updater_managed_traffic_directors", "TrafficDirectors with installed VIPs")
+managed_vips = metrics.gauge("route_updater_managed_vips", "Distinct VIPs routed by route-updater")
+watch_reconnects = metrics.counter("route_updater_watch_reconnects_total", "Watch restarts by reason", ["reason"])
+leader = metrics.gauge("route_updater_leader", "1 while this instance holds the leader Lease and writes routes")
+route_repairs = metrics.counter("route_updater_route_repairs_total", "Routes reinstalled after changes made outside route-updater, by cause", ["reason"])
+conntrack_flushed = metrics.counter("route_updater_conntrack_flushed_total", "Conntrack entries deleted after the nexthops of their VIP changed")
+nexthops_unreachable = metrics.gauge("route_updater_nexthops_unreachable", "nodeIps withdrawn from the nexthop sets for not answering liveness probes")
+probe_transitions = metrics.counter("route_updater_probe_transitions_total", "nodeIps withdrawn or restored by the liveness prober", ["action"])
+nodes_down = metrics.gauge("route_updater_nodes_down", "nodeIps of Nodes that are not Ready, withdrawn from the nexthop sets")
+node_failover_latency = metrics.histogram(
+    "route_updater_node_failover_seconds", "Time from a Node's Ready condition changing to its nodeIps being withdrawn from or restored to the routes",
+    ["action"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+)
+
+managed_traffic_directors.set_function(lambda: sum(len(shard.traffic_director_vips) for shard in shards))
+managed_vips.set_function(lambda: sum(len(shard.installed_routes) for shard in shards))
+workqueue_depth.set_function(lambda: sum(len(shard.work_queue) for shard in shards))
+nodes_down.set_function(lambda: len(down_nodes))
+nexthops_unreachable.set_function(lambda: sum(len(shard.unreachable_nodes) for shard in shards))
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request with the registry on /metrics"""
+    try:
+        request = await reader.readline()
+        # Headers are not needed, only read past them
+        while (await reader.readline()).strip():
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            body = metrics.render().encode()
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port, logger):
+    """Serve /metrics on the event loop, port 0 disables the endpoint"""
+    if not port:
+        return None
+    server = await asyncio.start_server(serve_metrics, port=port)
+    logger.info(f"Serving metrics on :{port}/metrics")
+    return server
 
 def setup_logging():
-    """Setup logging with rotation"""
+    """Setup logging with rotation, file I/O happens on a background listener thread"""
     os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
     
     # Create logger
     logger = logging.getLogger('route-updater')
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
     
     # Create rotating file handler (10MB max, 1 backup)
     handler = RotatingFileHandler(
@@ -49,177 +1280,2217 @@ def setup_logging():
     formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
     handler.setFormatter(formatter)
     
+    # Callers only enqueue records, the listener writes them to the file
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
     # Add handler to logger
-    logger.addHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
     
     return logger
 
-def wait_for_crd(api_client, logger):
-    """Wait for the CRD to exist"""
-    logger.info(f"Waiting for CRD '{CRD_PLURAL}.{CRD_GROUP}' to be created...")
+def record_route_op(shard, logger, action, vip, node_ips, error=None, duration=None, table=RT_TABLE_MAIN):
+    """Account one route operation in the metrics and log it as a single key=value record"""
+    if duration is not None:
+        route_op_duration.observe(duration, op=action)
+    if error is None:
+        level, result = logging.INFO, "ok"
+    else:
+        result = errno.errorcode.get(error.errno, error.errno)
+        route_op_failures.inc(op=action, error=result)
+        # A delete of a route that is already gone is harmless
+        level = logging.WARNING if action == 'delete' and error.errno == errno.ESRCH else logging.ERROR
+    logger.log(level, "route op=%s vip=%s via=%s dev=%s table=%d netns=%s result=%s", action, dst_to_str(vip), ",".join(map(int_to_ip, node_ips)) or "-", shard.interface, table, shard.netns, result)
+
+def crd_established(crd):
+    """Return True once the API server serves the CRD"""
+    conditions = (crd.status.conditions if crd.status else None) or []
+    return any(c.type == 'Established' and c.status == 'True' for c in conditions)
+
+def wait_for_crd(api_client, logger, timeout=CRD_WAIT_TIMEOUT):
+    """Wait for the CRD to be Established, watching it so we proceed the moment it is"""
+    crd_name = f"{CRD_PLURAL}.{CRD_GROUP}"
+    deadline = time.monotonic() + timeout if timeout else None
+    logger.info(f"Waiting for CRD '{crd_name}' to be created...")
     
     while True:
+        crds = api_client.list_custom_resource_definition(field_selector=f"metadata.name={crd_name}")
+        if any(crd_established(crd) for crd in crds.items):
+            logger.info(f"CRD '{crd_name}' found!")
+            return
+        
+        resource_version = crds.metadata.resource_version
+        w = watch.Watch()
         try:
-            api_client.read_custom_resource_definition(f"{CRD_PLURAL}.{CRD_GROUP}")
-            logger.info(f"CRD '{CRD_PLURAL}.{CRD_GROUP}' found!")
-            break
+            while True:
+                remaining = deadline - time.monotonic() if deadline else WATCH_TIMEOUT_SECONDS
+                if remaining <= 0:
+                    raise TimeoutError(f"CRD '{crd_name}' not Established after {timeout:g}s")
+                for event in w.stream(
+                    api_client.list_custom_resource_definition,
+                    field_selector=f"metadata.name={crd_name}",
+                    resource_version=resource_version,
+                    timeout_seconds=max(1, int(min(remaining, WATCH_TIMEOUT_SECONDS)))
+                ):
+                    resource_version = event['object'].metadata.resource_version
+                    if event['type'] in ('ADDED', 'MODIFIED') and crd_established(event['object']):
+                        logger.info(f"CRD '{crd_name}' found!")
+                        return
         except ApiException as e:
-            if e.status == 404:
-                time.sleep(5)
-                continue
-            else:
+            if e.status != 410:
                 logger.error(f"Error checking for CRD: {e}")
                 raise
+            # Too old to resume, list again
+        finally:
+            w.stop()
+
+class WorkQueue:
+    """Keyed work queue in the style of client-go: pending keys are coalesced, a key is
+    never handed to two workers at once and failed keys come back with exponential backoff.
+
+    Keys may be added from any thread, workers are asyncio tasks awaiting get().
+    """
+
+    def __init__(self, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.dirty = set()
+        self.processing = set()
+        self.delayed = []
+        self.failures = {}
+        self.added_at = {}
+        self.shutting_down = False
+        # Event loop of the workers and the event waking them, bound by the first get()
+        self.loop = None
+        self.wakeup = None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
+
+    def _wake(self):
+        """Wake the waiting workers, callable from any thread"""
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            # Loop already closed on shutdown
+            pass
+
+    def add(self, key):
+        """Queue key unless it is already pending, keys being processed are requeued on done()"""
+        with self.lock:
+            if self.shutting_down or key in self.dirty:
+                return
+            self.dirty.add(key)
+            self.added_at.setdefault(key, time.monotonic())
+            if key in self.processing:
+                return
+            self.queue.append(key)
+        self._wake()
+
+    def add_rate_limited(self, key):
+        """Queue key again after a backoff that doubles with every consecutive failure, returns the delay"""
+        with self.lock:
+            failures = self.failures.get(key, 0)
+            self.failures[key] = failures + 1
+            delay = min(self.base_delay * (2 ** failures), self.max_delay)
+            heapq.heappush(self.delayed, (time.monotonic() + delay, key))
+        self._wake()
+        return delay
+
+    def forget(self, key):
+        """Reset the backoff of key after a successful reconcile"""
+        with self.lock:
+            self.failures.pop(key, None)
+
+    def _pop(self):
+        """Move due delayed keys to the queue and take the next key, returns (key, seconds until the next delayed key)"""
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, key = heapq.heappop(self.delayed)
+            if key not in self.dirty:
+                self.dirty.add(key)
+                self.added_at.setdefault(key, now)
+                if key not in self.processing:
+                    self.queue.append(key)
+        if self.queue:
+            key = self.queue.popleft()
+            self.processing.add(key)
+            self.dirty.discard(key)
+            workqueue_latency.observe(now - self.added_at.pop(key, now))
+            return key, None
+        return None, self.delayed[0][0] - now if self.delayed else None
+
+    async def get(self):
+        """Wait until a key is ready and mark it as processing, returns None on shutdown"""
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+        while True:
+            # Cleared before looking, a key added meanwhile sets it again
+            self.wakeup.clear()
+            with self.lock:
+                if self.shutting_down:
+                    return None
+                key, timeout = self._pop()
+            if key is not None:
+                return key
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, key):
+        """Finish processing key, requeueing it if it was added again meanwhile"""
+        with self.lock:
+            self.processing.discard(key)
+            if key not in self.dirty:
+                return
+            self.queue.append(key)
+        self._wake()
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+        self._wake()
+
+def route_fingerprint(resource_obj):
+    """Return (generation, nodeIp, labels, fingerprint) where fingerprint covers everything routes depend on"""
+    generation = resource_obj.get('metadata', {}).get('generation')
+    node_ip = resource_obj.get('status', {}).get('nodeIp')
+    # Labels pick the shards routing the TrafficDirector
+    labels = resource_obj.get('metadata', {}).get('labels') or {}
+    vips = frozenset(g.get('vip') for g in resource_obj.get('spec', {}).get('gateways', []) if g.get('vip'))
+    return generation, node_ip, labels, (node_ip, vips, frozenset(labels.items()))
+
+def fingerprint_changed(td_name, resource_obj):
+    """Update the stored fingerprint of a TrafficDirector, returns False if its routes are unaffected"""
+    previous = traffic_director_fingerprints.get(td_name)
+    generation = resource_obj.get('metadata', {}).get('generation')
+    node_ip = resource_obj.get('status', {}).get('nodeIp')
+    labels = resource_obj.get('metadata', {}).get('labels') or {}
+    
+    # Same spec generation and nodeIp means the gateways cannot have changed either
+    if previous and generation is not None and previous[0] == generation and previous[1] == node_ip and previous[2] == labels:
+        return False
+    
+    current = route_fingerprint(resource_obj)
+    traffic_director_fingerprints[td_name] = current
+    return previous is None or previous[3] != current[3]
+
+def queue_traffic_director(td_name):
+    """Queue td_name on every shard, each one works out whether the TrafficDirector is or was its own"""
+    for shard in shards:
+        shard.work_queue.add(td_name)
 
 def process_event(event, logger):
-    """Process a watch event"""
+    """Record the latest state of a watched TrafficDirector and queue it for reconciliation"""
     event_type = event['type']
     namespace = event['object']['metadata']['namespace']
     td_name = f"{namespace}/{event['object']['metadata']['name']}"
+    events_received.inc(type=event_type)
     
     if event_type in ['ADDED', 'MODIFIED']:
+        traffic_director_objects[td_name] = event['object']
+        if not fingerprint_changed(td_name, event['object']):
+            # Status or metadata only churn, the routes stay as they are
+            events_skipped.inc()
+            logger.debug("Resource %s was %s without route changes, skipped (%d skipped so far)", td_name, event_type, events_skipped.value())
+            return
         logger.info(f"Resource {td_name} was {event_type}")
-        # Extract the spec from the resource for route updates
-        call_custom_action(td_name, event['object'], logger)
-    
-    if event_type == 'DELETED':
+    elif event_type == 'DELETED':
         logger.info(f"Resource {td_name} was deleted")
-        # Clean up routes for deleted TrafficDirector
-        delete_routes_for_vips(td_name, logger)
+        traffic_director_objects.pop(td_name, None)
+        traffic_director_fingerprints.pop(td_name, None)
+    else:
+        return
+    
+    # Events for a key that is still pending collapse into one reconcile of the latest state
+    queue_traffic_director(td_name)
+
+def reconcile_traffic_director(shard, td_name, logger):
+    """Reconcile the routes of a TrafficDirector on shard with its latest known state, returns False on failure"""
+    resource_obj = traffic_director_objects.get(td_name)
+    if resource_obj is None or not shard.selects(resource_obj):
+        leftover = (shard.table_manager and td_name in shard.table_manager.tables) or (shard.nexthop_manager and td_name in shard.nexthop_manager.td_ids)
+        if td_name in shard.traffic_director_vips:
+            # Clean up routes for deleted TrafficDirector, or one moved to another shard
+            succeeded = delete_routes_for_vips(shard, td_name, logger)
+        elif leftover:
+            # Its routes are gone from the index, its table or nexthop object could not be removed yet
+            succeeded = reconcile_routes_for_vips(shard, td_name, None, logger)
+        elif shard.failed_vips:
+            # Routed by other shards only, the VIPs that failed here are retried meanwhile
+            succeeded = retry_failed_vips(shard, logger)
+        else:
+            return True
+    else:
+        succeeded = call_custom_action(shard, td_name, resource_obj, logger)
+    flush_conntrack(shard, logger)
+    return succeeded
+
+async def run_worker(shard, logger):
+    """Reconcile TrafficDirectors queued on shard until its queue shuts down"""
+    loop = asyncio.get_running_loop()
+    work_queue = shard.work_queue
+    while True:
+        td_name = await work_queue.get()
+        if td_name is None:
+            return
+        start = time.monotonic()
+        try:
+            # Route programming blocks on netlink, it runs on the shard's threads so the loop never waits for the kernel
+            succeeded = await loop.run_in_executor(shard.executor, reconcile_traffic_director, shard, td_name, logger)
+        except Exception as e:
+            logger.error(f"Error reconciling {td_name}: {e}")
+            succeeded = False
+        reconcile_duration.observe(time.monotonic() - start, result="success" if succeeded else "failure")
+        
+        if succeeded:
+            work_queue.forget(td_name)
+        else:
+            workqueue_retries.inc()
+            delay = work_queue.add_rate_limited(td_name)
+            logger.warning(f"Reconcile of {td_name} failed, retrying in {delay:.1f}s")
+        work_queue.done(td_name)
+
+def start_workers(shard, logger):
+    """Start the reconcile worker tasks of shard, returns them"""
+    shard.executor = ThreadPoolExecutor(RECONCILE_WORKERS, thread_name_prefix=f"reconcile-{shard.netns}")
+    tasks = [asyncio.create_task(run_worker(shard, logger), name=f"reconcile-{shard.netns}-{index}") for index in range(RECONCILE_WORKERS)]
+    logger.info(f"Started {RECONCILE_WORKERS} reconcile workers for netns {shard.netns}")
+    return tasks
+
+def run_in_thread(function, *args):
+    """Run a blocking call on a daemon thread, returns a future of its result.
+
+    Unlike the loop's default executor, a daemon thread stuck in a blocking
+    API call never holds up the process exit.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def settle(result, error):
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    
+    def target():
+        try:
+            result, error = function(*args), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            # Loop already closed on shutdown
+            pass
+    
+    threading.Thread(target=target, name=function.__name__, daemon=True).start()
+    return future
 
-def call_custom_action(td_name, resource_obj, logger):
-    """Custom action to perform when resource changes"""
+def call_custom_action(shard, td_name, resource_obj, logger):
+    """Custom action to perform when resource changes, returns False if any route failed"""
     try:
-        # First clean up any existing routes for this TrafficDirector
-        delete_routes_for_vips(td_name, logger)
         # Extract traffic director spec
-        spec = resource_obj.get('spec', {})
-        status = resource_obj.get('status', {})
-        logger.info(f"Processing TrafficDirector {td_name} with spec: {json.dumps(spec, indent=2)}")
-        
-        # Extract nodeIp from status
-        node_ip = status.get('nodeIp')
-        if not node_ip:
-            logger.warning(f"No nodeIp found in status for TrafficDirector {td_name}")
-            return
-            
-        # Extract VIPs from gateways
-        gateways = spec.get('gateways', [])
-        vips = []
-        
-        for gateway in gateways:
-            namespace = gateway.get('namespace')
-            vip = gateway.get('vip')
-            if vip:
-                vips.append({
-                    'namespace': namespace,
-                    'vip': vip,
-                    'nodeIp': node_ip
-                })
-                logger.info(f"Found VIP {vip} for namespace {namespace} with nodeIp {node_ip}")
-        
-        # Store VIPs in the global map
-        traffic_director_vips[td_name] = vips
-        logger.info(f"Stored {len(vips)} VIPs for TrafficDirector {td_name}")
-        
-        # Log current state of all VIPs
-        logger.info(f"Current VIP map: {json.dumps(traffic_director_vips, indent=2)}")
-        
-        # Update routes in network namespaces based on VIPs
-        update_routes_for_vips(td_name, vips, logger)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing TrafficDirector %s with spec: %s", td_name, json.dumps(resource_obj.get('spec', {})))
+        routes = extract_vips(td_name, resource_obj, logger)
+        
+        # Program only the difference against what is already installed
+        succeeded = reconcile_routes_for_vips(shard, td_name, routes, logger)
+        
+        # Dumping the whole map is O(total VIPs), keep it out of normal operation
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Current VIP map: %s", json.dumps({name: r.as_dict() for name, r in shard.traffic_director_vips.items()}))
+        return succeeded
         
     except Exception as e:
         logger.error(f"Error in custom action for {td_name}: {e}")
+        return False
 
-def update_routes_for_vips(td_name, vips, logger):
-    """Update network routes based on VIPs"""
-    try:
-        for vip_config in vips:
-            vip = vip_config['vip']
-            namespace = vip_config['namespace']
-            node_ip = vip_config['nodeIp']
-            
-            # Execute route add command
-            cmd = f"ip netns exec {ROUTER_NS} ip route add {vip}/32 via {node_ip} dev {EGRESS_INTERFACE}"
-            logger.info(f"Executing: {cmd}")
-            
-            result = os.system(cmd)
-            if result == 0:
-                logger.info(f"Successfully added route for VIP {vip} via {node_ip}")
-            else:
-                logger.error(f"Failed to add route for VIP {vip} via {node_ip} (exit code: {result})")
-            
-    except Exception as e:
-        logger.error(f"Error updating routes for {td_name}: {e}")
+class TrafficDirectorRoutes:
+    """The VIPs of one TrafficDirector, all routed via its nodeIp.
 
-def delete_routes_for_vips(td_name, logger):
-    """Delete network routes for a TrafficDirector"""
-    try:
-        if td_name in traffic_director_vips:
-            vips = traffic_director_vips[td_name]
-            for vip_config in vips:
-                vip = vip_config['vip']
-                namespace = vip_config['namespace']
-                node_ip = vip_config['nodeIp']
-                
-                # Execute route delete command
-                cmd = f"ip netns exec {ROUTER_NS} ip route del {vip}/32 via {node_ip} dev {EGRESS_INTERFACE}"
-                logger.info(f"Executing: {cmd}")
-                
-                result = os.system(cmd)
-                if result == 0:
-                    logger.info(f"Successfully deleted route for VIP {vip} via {node_ip}")
-                else:
-                    logger.error(f"Failed to delete route for VIP {vip} via {node_ip} (exit code: {result})")
-                
-            del traffic_director_vips[td_name]
-            logger.info(f"Deleted routes for TrafficDirector {td_name}")
-        else:
-            logger.warning(f"No VIPs found for TrafficDirector {td_name}")
-    except Exception as e:
-        logger.error(f"Error deleting routes for {td_name}: {e}")
+    Addresses are IPv4 packed into ints and the VIPs a sorted array, so a
+    TrafficDirector costs a few bytes per VIP instead of a dict per VIP.
+    Namespaces are interned, there are only a handful of distinct ones.
+    """
 
-def main():
-    """Main function"""
-    print("Entering main function", flush=True)
-    logger = setup_logging()
-    logger.info("Route updater started")
-    print("Logger setup complete", flush=True)
+    __slots__ = ('node_ip', 'vips', 'namespaces')
+
+    def __init__(self, node_ip, vips, namespaces):
+        self.node_ip = node_ip
+        self.vips = vips
+        self.namespaces = namespaces
+
+    def __len__(self):
+        return len(self.vips)
+
+    def as_dict(self):
+        return {
+            'nodeIp': int_to_ip(self.node_ip),
+            'gateways': [{'namespace': ns, 'vip': int_to_ip(vip)} for vip, ns in zip(self.vips, self.namespaces)]
+        }
+
+def extract_vips(td_name, resource_obj, logger):
+    """Build the TrafficDirectorRoutes of a TrafficDirector from its spec gateways and status nodeIp, None without any"""
+    spec = resource_obj.get('spec', {})
+    status = resource_obj.get('status', {})
     
+    # Extract nodeIp from status
+    node_ip = status.get('nodeIp')
+    if not node_ip:
+        logger.warning(f"No nodeIp found in status for TrafficDirector {td_name}")
+        return None
     try:
-        # Load kubernetes config
+        node = ip_to_int(node_ip)
+    except OSError:
+        logger.warning(f"Invalid nodeIp {node_ip!r} in status of TrafficDirector {td_name}")
+        return None
+    
+    # Extract VIPs from gateways, the first gateway of a duplicated VIP wins
+    namespaces = {}
+    for gateway in spec.get('gateways', []):
+        vip = gateway.get('vip')
+        if not vip:
+            continue
         try:
-            config.load_incluster_config()
-            logger.info("Loaded in-cluster config")
-        except config.ConfigException:
-            config.load_kube_config()
-            logger.info("Loaded local kube config")
-        
-        # Create API clients
-        api_extensions = client.ApiextensionsV1Api()
-        custom_api = client.CustomObjectsApi()
-        
-        # Wait for CRD to exist
-        wait_for_crd(api_extensions, logger)
-        
-        # Watch for changes
-        logger.info(f"Starting watch on {CRD_PLURAL} in namespace {NAMESPACE}")
-        
-        w = watch.Watch()
-        for event in w.stream(
-            custom_api.list_namespaced_custom_object,
-            group=CRD_GROUP,
-            version=CRD_VERSION,
-            namespace=NAMESPACE,
-            plural=CRD_PLURAL
-        ):
-            try:
-                process_event(event, logger)
-            except Exception as e:
-                logger.error(f"Error processing event: {e}")
+            namespaces.setdefault(ip_to_int(vip), sys.intern(gateway.get('namespace') or ''))
+        except OSError:
+            logger.warning(f"Invalid VIP {vip!r} in TrafficDirector {td_name}")
+            continue
+        logger.debug("Found VIP %s for namespace %s with nodeIp %s", vip, gateway.get('namespace'), node_ip)
+    
+    if not namespaces:
+        return None
+    vips = array.array('I', sorted(namespaces))
+    return TrafficDirectorRoutes(node, vips, tuple(namespaces[vip] for vip in vips))
+
+def diff_vips(old, new):
+    """Compare the routes of a TrafficDirector, returns the (added, removed, changed) VIP sets, either side may be None"""
+    old_vips = set(old.vips) if old else set()
+    new_vips = set(new.vips) if new else set()
+    if old and new and old.node_ip != new.node_ip:
+        return new_vips - old_vips, old_vips - new_vips, old_vips & new_vips
+    return new_vips - old_vips, old_vips - new_vips, set()
+
+# Label keys, an optional DNS subdomain prefix and a name, and label values (Kubernetes label syntax)
+LABEL_KEY = re.compile(r"([a-z0-9]([-a-z0-9.]*[a-z0-9])?/)?[A-Za-z0-9]([-A-Za-z0-9_.]*[A-Za-z0-9])?")
+LABEL_VALUE = re.compile(r"([A-Za-z0-9]([-A-Za-z0-9_.]*[A-Za-z0-9])?)?")
+
+def parse_selector(text):
+    """Parse a label selector ("a=b,c!=d,e,!f") into (key, operator, value) requirements, raises ValueError for anything else"""
+    requirements = []
+    for term in filter(None, (t.strip() for t in text.split(','))):
+        if '!=' in term:
+            key, value = term.split('!=', 1)
+            requirement = (key.strip(), '!=', value.strip())
+        elif '=' in term:
+            key, value = term.split('==', 1) if '==' in term else term.split('=', 1)
+            requirement = (key.strip(), '=', value.strip())
+        elif term.startswith('!'):
+            requirement = (term[1:].strip(), '!', None)
+        else:
+            requirement = (term, 'exists', None)
+        # Set-based terms like "env in (a,b)" would otherwise become keys that no label ever has
+        key, _, value = requirement
+        if not LABEL_KEY.fullmatch(key) or not LABEL_VALUE.fullmatch(value or ""):
+            raise ValueError(f"Invalid label selector term {term!r}, expected key=value, key==value, key!=value, key or !key")
+        requirements.append(requirement)
+    return requirements
+
+def parse_shards(text):
+    """Build the RouterShards of a "netns:interface[:selector];..." spec, a single default shard if empty"""
+    if not text.strip():
+        return [RouterShard(ROUTER_NS, EGRESS_INTERFACE)]
+    
+    result = []
+    for spec in filter(None, (s.strip() for s in text.split(';'))):
+        parts = spec.split(':', 2)
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            raise ValueError(f"Invalid shard {spec!r}, expected netns:interface[:selector]")
+        if any((shard.netns, shard.interface) == (parts[0], parts[1]) for shard in result):
+            raise ValueError(f"Shard {parts[0]}:{parts[1]} is configured twice")
+        result.append(RouterShard(parts[0], parts[1], parts[2] if len(parts) == 3 else ""))
+    return result
+
+class RouterShard:
+    """One router namespace and egress interface, routing the TrafficDirectors its label selector matches.
+
+    Every shard has its own route state, netlink socket, work queue and
+    workers, only the TrafficDirector watch is shared.
+    """
+
+    def __init__(self, netns, interface, selector=""):
+        self.netns = netns
+        self.interface = interface
+        self.selector = selector
+        self.requirements = parse_selector(selector)
+        self.work_queue = WorkQueue()
+        
+        # Route backend, opened by open(), and the threads running its blocking calls
+        self.backend = None
+        self.executor = None
+        
+        # TrafficDirectorRoutes by TrafficDirector name
+        self.traffic_director_vips = {}
+        
+        # VIP -> ((nodeIp, TrafficDirector name), ...) of everything announcing the VIP
+        self.vip_nexthops = {}
+        
+        # nodeIp -> names of the TrafficDirectors routed via that node
+        self.node_traffic_directors = {}
+        
+        # VIP -> route target last programmed successfully, see route_target()
+        self.installed_routes = {}
+        
+        # Route targets and announcer tuples are shared by many VIPs, see intern_target()
+        self.targets = {}
+        
+        # VIPs whose last programming attempt failed, retried by the next reconcile
+        self.failed_vips = set()
+        
+        # Kernel nexthop objects behind the VIP routes, created by the startup sync when NEXTHOP_OBJECTS is on
+        self.nexthop_manager = None
+        
+        # Routing tables of the TrafficDirectors, created by the startup sync when TD_TABLES is on
+        self.table_manager = None
+        
+        # VIP -> table of its installed route, for routes outside the main table
+        self.route_tables = {}
+        
+        # With AGGREGATE_PREFIX_LEN, block -> VIPs announced in it and block -> {route destination: (target, table)}
+        # of the aggregates programmed for it, a block being the VIPs sharing their first AGGREGATE_PREFIX_LEN bits
+        self.block_vips = {}
+        self.prefixes = {}
+        
+        # nodeIps the liveness prober of this namespace gets no answer from, replaced under routes_lock, see NexthopProber
+        self.unreachable_nodes = set()
+        
+        # nodeIps of Nodes that are not Ready or deleted, replaced under routes_lock, see update_down_nodes()
+        self.down_nodes = frozenset()
+        
+        # Deletes the conntrack entries of rerouted VIPs when CONNTRACK_FLUSH is on, the VIPs
+        # rerouted since the last flush_conntrack() wait in rerouted_vips
+        self.conntrack = None
+        self.rerouted_vips = set()
+        
+        # Serializes index updates and the route programming that follows them, a VIP
+        # shared by several TrafficDirectors is otherwise written by two workers at once
+        self.routes_lock = threading.Lock()
+
+    def open(self, logger):
+        backend = ROUTE_BACKENDS.get(ROUTE_BACKEND)
+        if backend is None:
+            raise ValueError(f"Unknown route backend {ROUTE_BACKEND!r}, expected one of {', '.join(ROUTE_BACKENDS)}")
+        if not 0 <= AGGREGATE_PREFIX_LEN <= 32:
+            raise ValueError(f"Invalid aggregate prefix length {AGGREGATE_PREFIX_LEN}, expected 0 to 32")
+        if PROBE_PROTOCOL not in ('', 'icmp', 'udp') or (PROBE_PROTOCOL == 'udp') != PROBE_PORT.isdigit():
+            raise ValueError(f"Invalid probe {PROBE_PROTOCOL}:{PROBE_PORT}, expected icmp or udp:<port>")
+        self.backend = backend(self.netns, self.interface, logger)
+        # A dry run leaves the flows alone like it leaves the routes
+        if CONNTRACK_FLUSH and backend is not DryRunRouteBackend:
+            self.conntrack = ConntrackFlusher(self.netns, logger)
+
+    def selects(self, resource_obj):
+        """Return True if the labels of resource_obj match the shard selector"""
+        labels = resource_obj.get('metadata', {}).get('labels') or {}
+        for key, operator, value in self.requirements:
+            if operator == '=' and labels.get(key) != value:
+                return False
+            if operator == '!=' and labels.get(key) == value:
+                return False
+            if operator == 'exists' and key not in labels:
+                return False
+            if operator == '!' and key in labels:
+                return False
+        return True
+
+def index_vip(shard, td_name, vip, node_ip):
+    """Record that td_name announces vip via node_ip"""
+    announcer = intern_target(shard, (node_ip, td_name))
+    shard.vip_nexthops[vip] = intern_target(shard, shard.vip_nexthops.get(vip, ()) + (announcer,))
+    if AGGREGATE_PREFIX_LEN:
+        shard.block_vips.setdefault(vip_block(vip), set()).add(vip)
+
+def unindex_vip(shard, td_name, vip, node_ip):
+    """Drop td_name from the announcers of vip via node_ip"""
+    announcers = tuple(a for a in shard.vip_nexthops.get(vip, ()) if a != (node_ip, td_name))
+    if announcers:
+        shard.vip_nexthops[vip] = intern_target(shard, announcers)
+        return
+    shard.vip_nexthops.pop(vip, None)
+    if AGGREGATE_PREFIX_LEN:
+        block = shard.block_vips.get(vip_block(vip), set())
+        block.discard(vip)
+        if not block:
+            shard.block_vips.pop(vip_block(vip), None)
+
+def index_traffic_director(shard, td_name, routes):
+    """Store the routes of td_name, or drop them for None, keeping the node index in step"""
+    old = shard.traffic_director_vips.get(td_name)
+    if old and (not routes or routes.node_ip != old.node_ip):
+        on_node = shard.node_traffic_directors.get(old.node_ip, set())
+        on_node.discard(td_name)
+        if not on_node:
+            shard.node_traffic_directors.pop(old.node_ip, None)
+    if routes:
+        shard.traffic_director_vips[td_name] = routes
+        shard.node_traffic_directors.setdefault(routes.node_ip, set()).add(td_name)
+    else:
+        shard.traffic_director_vips.pop(td_name, None)
+
+def live_announcers(shard, vip):
+    """(nodeIp, TrafficDirector name) announcing vip from nodes not known to be down or unreachable, all of them if every one is"""
+    announcers = shard.vip_nexthops.get(vip, ())
+    down, unreachable = shard.down_nodes, shard.unreachable_nodes
+    if not down and not unreachable:
+        return announcers
+    # With no live node left the route stays as it was, there is nothing better to send the traffic to
+    return tuple(
+        announcer for announcer in announcers if announcer[0] not in down and announcer[0] not in unreachable
+    ) or announcers
+
+def desired_nexthops(shard, vip):
+    """Sorted nodeIps that should carry vip, across all TrafficDirectors"""
+    return tuple(sorted({node_ip for node_ip, _ in live_announcers(shard, vip)}))
+
+def route_target(shard, vip):
+    """What the route of vip must point at: its nodeIps, or its announcing TrafficDirectors with nexthop objects"""
+    if shard.nexthop_manager:
+        target = tuple(sorted(td_name for _, td_name in live_announcers(shard, vip)))
+    else:
+        target = desired_nexthops(shard, vip)
+    return intern_target(shard, target)
+
+def route_table(shard, vip):
+    """Table the route of vip belongs in: its TrafficDirector's when only one announces it, else main for the multipath route"""
+    if not shard.table_manager:
+        return RT_TABLE_MAIN
+    announcers = {td_name for _, td_name in shard.vip_nexthops.get(vip, ())}
+    if len(announcers) != 1:
+        return RT_TABLE_MAIN
+    return shard.table_manager.tables.get(announcers.pop(), RT_TABLE_MAIN)
+
+def set_route_table(shard, vip, table):
+    """Record the table holding the route of vip"""
+    if table == RT_TABLE_MAIN:
+        shard.route_tables.pop(vip, None)
+    else:
+        shard.route_tables[vip] = table
+
+def intern_target(shard, target):
+    """Return the stored tuple equal to target, the VIPs of a TrafficDirector all share theirs"""
+    if len(shard.targets) >= TARGET_CACHE_SIZE:
+        # Stale tuples pile up with churn, stored ones stay valid and only stop being shared
+        shard.targets.clear()
+    return shard.targets.setdefault(target, target)
+
+def traffic_directors_of(shard, vips):
+    """Names of the TrafficDirectors announcing any of vips"""
+    return {td_name for vip in vips for _, td_name in shard.vip_nexthops.get(vip, ())}
+
+def vip_block(vip):
+    """Aggregation block of a VIP or prefix network, its first AGGREGATE_PREFIX_LEN bits"""
+    return vip >> (32 - AGGREGATE_PREFIX_LEN)
+
+def aggregate_block(shard, block):
+    """Return {route destination: (target, table)} routing exactly the VIPs of block with the fewest prefixes"""
+    members = sorted((vip, (route_target(shard, vip), route_table(shard, vip))) for vip in shard.block_vips.get(block, ()))
+    prefixes = {}
+    _aggregate(members, 0, len(members), block << (32 - AGGREGATE_PREFIX_LEN), AGGREGATE_PREFIX_LEN, prefixes)
+    return prefixes
+
+def _aggregate(members, start, end, network, length, prefixes):
+    """Cover members[start:end], all inside network/length, with whole prefixes of VIPs routed alike"""
+    if start == end:
+        return
+    route = members[start][1]
+    if end - start == 1 << (32 - length) and all(member[1] == route for member in members[start + 1:end]):
+        # Every address of the prefix is a VIP and all take the same route
+        prefixes[network if length == 32 else (network, length)] = route
+        return
+    half = network + (1 << (31 - length))
+    middle = bisect.bisect_left(members, (half,), start, end)
+    _aggregate(members, start, middle, network, length + 1, prefixes)
+    _aggregate(members, middle, end, half, length + 1, prefixes)
+
+def covering_prefix(prefixes, vip):
+    """The route destination of prefixes routing vip, None if there is none"""
+    if vip in prefixes:
+        return vip
+    for length in range(31, AGGREGATE_PREFIX_LEN - 1, -1):
+        dst = (vip & (0xffffffff << (32 - length)) & 0xffffffff, length)
+        if dst in prefixes:
+            return dst
+    return None
+
+def prefixes_overlap(dst, other):
+    """Return True if route destinations dst and other share addresses, one covering the other"""
+    (network, length), (other_network, other_length) = dst_prefix(dst), dst_prefix(other)
+    shift = 32 - min(length, other_length)
+    return network >> shift == other_network >> shift
+
+def installed_dst(shard, vip):
+    """Destination of the route programmed for vip, its aggregate with AGGREGATE_PREFIX_LEN"""
+    if AGGREGATE_PREFIX_LEN:
+        return covering_prefix(shard.prefixes.get(vip_block(vip), {}), vip)
+    return vip
+
+def desired_routes(shard):
+    """Return {route destination: (target, table)} of every route the index calls for"""
+    if AGGREGATE_PREFIX_LEN:
+        return {dst: route for block in shard.block_vips for dst, route in aggregate_block(shard, block).items()}
+    return {vip: (route_target(shard, vip), route_table(shard, vip)) for vip in shard.vip_nexthops}
+
+def install_route(shard, dst, target, table):
+    """Record the route to dst as programmed via target in table"""
+    for vip in dst_vips(dst):
+        shard.installed_routes[vip] = target
+        set_route_table(shard, vip, table)
+        shard.failed_vips.discard(vip)
+    if AGGREGATE_PREFIX_LEN:
+        shard.prefixes.setdefault(vip_block(dst_prefix(dst)[0]), {})[dst] = (target, table)
+
+def forget_vip(shard, vip):
+    """Drop the routing state of a VIP nothing announces or routes any more"""
+    shard.installed_routes.pop(vip, None)
+    shard.route_tables.pop(vip, None)
+    shard.failed_vips.discard(vip)
+
+class NexthopManager:
+    """Kernel nexthop objects backing the VIP routes.
+
+    Every TrafficDirector owns one nexthop object via its nodeIp, so moving a
+    TrafficDirector to another node is a single nexthop replace whatever the
+    number of its VIPs. A VIP announced by several TrafficDirectors points at
+    a multipath group of their objects, shared by all VIPs with the same
+    announcers.
+    """
+
+    def __init__(self, backend, first_id=NEXTHOP_ID_BASE):
+        self.backend = backend
+        self.next_id = first_id
+        self.free_ids = []
+        self.td_ids = {}
+        self.td_gateways = {}
+        self.groups = {}
+        self.group_users = {}
+        self.vip_nhids = {}
+
+    def adopt(self, td_name, nhid, node_ip):
+        """Take over nexthop object nhid via node_ip from a previous run for td_name"""
+        self.td_ids[td_name] = nhid
+        self.td_gateways[td_name] = node_ip
+
+    def adopt_group(self, nhid, member_ids):
+        """Take over group nhid over member_ids from a previous run, kept once acquire() hands it out"""
+        self.groups[frozenset(member_ids)] = nhid
+        self.group_users[nhid] = 0
+
+    def drop_unused_groups(self):
+        """Forget adopted groups no route was given, the kernel objects are left to the caller"""
+        unused = {nhid for nhid, users in self.group_users.items() if not users}
+        self.groups = {members: group_id for members, group_id in self.groups.items() if group_id not in unused}
+        for nhid in unused:
+            del self.group_users[nhid]
+
+    def _allocate(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        self.next_id += 1
+        return self.next_id - 1
+
+    def set_gateway(self, td_name, node_ip):
+        """Point the nexthop object of td_name at node_ip, returns True if the kernel had to be updated"""
+        if td_name not in self.td_ids:
+            self.td_ids[td_name] = self._allocate()
+        if self.td_gateways.get(td_name) == node_ip:
+            return False
+        self.backend.replace_nexthop(self.td_ids[td_name], node_ip)
+        self.td_gateways[td_name] = node_ip
+        return True
+
+    def acquire(self, td_names):
+        """Return the nexthop id for routes announced by td_names, creating their group if needed"""
+        members = frozenset(self.td_ids[td_name] for td_name in td_names)
+        if len(members) == 1:
+            return next(iter(members))
+        
+        group_id = self.groups.get(members)
+        if group_id is None:
+            group_id = self._allocate()
+            try:
+                self.backend.replace_nexthop_group(group_id, sorted(members))
+            except RouteError:
+                self.free_ids.append(group_id)
+                raise
+            self.groups[members] = group_id
+            self.group_users[group_id] = 0
+        self.group_users[group_id] += 1
+        return group_id
+
+    def release(self, nhid):
+        """Drop one user of nhid, deleting a group nobody routes through any more"""
+        if nhid not in self.group_users:
+            return
+        self.group_users[nhid] -= 1
+        if self.group_users[nhid] > 0:
+            return
+        del self.group_users[nhid]
+        self.groups = {members: group_id for members, group_id in self.groups.items() if group_id != nhid}
+        try:
+            self.backend.delete_nexthop(nhid)
+        except RouteError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.free_ids.append(nhid)
+
+    def bind(self, vip, nhid):
+        """Record that the route of vip now uses nhid"""
+        old = self.vip_nhids.get(vip)
+        self.vip_nhids[vip] = nhid
+        if old is not None:
+            self.release(old)
+
+    def unbind(self, vip):
+        old = self.vip_nhids.pop(vip, None)
+        if old is not None:
+            self.release(old)
+
+    def remove(self, td_name):
+        """Delete the nexthop object of a TrafficDirector that no route uses any more"""
+        nhid = self.td_ids.get(td_name)
+        if nhid is None:
+            return
+        try:
+            self.backend.delete_nexthop(nhid)
+        except RouteError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        del self.td_ids[td_name]
+        self.td_gateways.pop(td_name, None)
+        self.free_ids.append(nhid)
+
+    def ids(self):
+        return set(self.td_ids.values()) | set(self.group_users)
+
+    def restore(self):
+        """Recreate every known object, the kernel flushes them with their interface"""
+        for td_name, node_ip in self.td_gateways.items():
+            self.backend.replace_nexthop(self.td_ids[td_name], node_ip)
+        for members, group_id in self.groups.items():
+            self.backend.replace_nexthop_group(group_id, sorted(members))
+
+class RouteTableManager:
+    """Kernel routing tables holding the VIP routes of each TrafficDirector.
+
+    Every TrafficDirector owns a table looked up by a policy rule at
+    TD_RULE_PRIORITY, ahead of the main table. Deleting the TrafficDirector
+    flushes its table, whatever its stored VIPs say. VIPs announced by several
+    TrafficDirectors keep their multipath route in the main table, and so do
+    the VIPs of TrafficDirectors beyond the first TD_TABLES_MAX.
+
+    IPv4 policy routing cannot chain lookups: a rule names a single table,
+    goto only jumps to another rule and l3mdev picks the table of a VRF
+    device, not of a destination. One shared rule would mean one shared
+    table, so each table brings its own rule, and their number is capped.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.next_id = TD_TABLE_BASE
+        self.free_ids = []
+        self.tables = {}
+
+    def adopt(self, td_name, table):
+        """Take over table from a previous run for td_name"""
+        self.tables[td_name] = table
+        self.next_id = max(self.next_id, table + 1)
+
+    def acquire(self, td_name):
+        """Return the table of td_name, creating it and its rule if needed, None once TD_TABLES_MAX tables exist"""
+        table = self.tables.get(td_name)
+        if table is None:
+            if len(self.tables) >= TD_TABLES_MAX:
+                return None
+            table = self.free_ids.pop() if self.free_ids else self.next_id
+            if table == self.next_id:
+                self.next_id += 1
+            try:
+                self._add_rule(table)
+            except RouteError:
+                self.free_ids.append(table)
+                raise
+            self.tables[td_name] = table
+        return table
+
+    def release(self, td_name):
+        """Flush the table of td_name and delete its rule, returns how many routes it held"""
+        table = self.tables[td_name]
+        flushed = self.backend.flush_table(table)
+        try:
+            self.backend.delete_rule(table)
+        except RouteError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        del self.tables[td_name]
+        self.free_ids.append(table)
+        return flushed
+
+    def restore(self):
+        """Re-add every rule, they are gone if someone flushed the rules"""
+        for table in self.tables.values():
+            self._add_rule(table)
+
+    def _add_rule(self, table):
+        try:
+            self.backend.add_rule(table)
+        except RouteError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def reconcile_routes_for_vips(shard, td_name, routes, logger):
+    """Bring the routes of a TrafficDirector from its stored ones to routes (None for none), returns False if any route failed"""
+    with shard.routes_lock:
+        old = shard.traffic_director_vips.get(td_name)
+        added, removed, changed = diff_vips(old, routes)
+        
+        if added or removed or changed:
+            logger.info(f"Reconciling TrafficDirector {td_name}: {len(added)} to add, {len(removed)} to remove, {len(changed)} to replace")
+        
+        # Move this TrafficDirector's entries in the VIP -> nexthop index
+        for vip in removed | changed:
+            unindex_vip(shard, td_name, vip, old.node_ip)
+        for vip in added | changed:
+            index_vip(shard, td_name, vip, routes.node_ip)
+        
+        index_traffic_director(shard, td_name, routes)
+        if routes:
+            logger.debug("Stored %d VIPs for TrafficDirector %s", len(routes), td_name)
+        
+        affected = added | removed | changed
+        
+        # VIPs whose routes follow the TrafficDirector's nexthop object to its new nodeIp untouched
+        moved = set()
+        if shard.nexthop_manager and routes:
+            # All VIPs of a TrafficDirector share its nodeIp, so a move is one nexthop replace
+            try:
+                if shard.nexthop_manager.set_gateway(td_name, routes.node_ip):
+                    logger.info("nexthop op=replace id=%d via=%s td=%s result=ok", shard.nexthop_manager.td_ids[td_name], int_to_ip(routes.node_ip), td_name)
+                    moved = changed
+            except RouteError as e:
+                logger.error("nexthop op=replace via=%s td=%s result=%s", int_to_ip(routes.node_ip), td_name, errno.errorcode.get(e.errno, e.errno))
+                shard.failed_vips.update(routes.vips)
+                return False
+        
+        if shard.table_manager and routes:
+            had_table = td_name in shard.table_manager.tables
+            try:
+                table = shard.table_manager.acquire(td_name)
+            except RouteError as e:
+                logger.error("table op=add td=%s result=%s", td_name, errno.errorcode.get(e.errno, e.errno))
+                shard.failed_vips.update(routes.vips)
+                return False
+            if table is None:
+                logger.debug("Routes of TrafficDirector %s stay in the main table, %d tables in use", td_name, TD_TABLES_MAX)
+            elif not had_table:
+                # Its routes so far were in the main table, past TD_TABLES_MAX, they all move into the table at once
+                affected |= set(routes.vips)
+        elif shard.table_manager and td_name in shard.table_manager.tables:
+            # One flush removes every route of the deleted TrafficDirector, a stale VIP list leaks none
+            table = shard.table_manager.tables[td_name]
+            flushed = {vip for vip in affected | shard.failed_vips if shard.route_tables.get(vip) == table}
+            try:
+                count = shard.table_manager.release(td_name)
+            except RouteError as e:
+                logger.error("table op=flush table=%d td=%s result=%s", table, td_name, errno.errorcode.get(e.errno, e.errno))
+                shard.failed_vips.update(flushed)
+                return False
+            logger.info("table op=flush table=%d td=%s routes=%d result=ok", table, td_name, count)
+            # The freed table goes to a TrafficDirector left in the main table past TD_TABLES_MAX
+            waiting = next((name for name in shard.traffic_director_vips if name not in shard.table_manager.tables), None)
+            if waiting:
+                shard.work_queue.add(waiting)
+            for vip in flushed:
+                dst = installed_dst(shard, vip)
+                block = vip_block(vip)
+                if AGGREGATE_PREFIX_LEN and dst is not None and shard.prefixes[block][dst][1] == table:
+                    del shard.prefixes[block][dst]
+                    if not shard.prefixes[block]:
+                        del shard.prefixes[block]
+                if shard.nexthop_manager and dst is not None:
+                    shard.nexthop_manager.unbind(dst)
+                forget_vip(shard, vip)
+            # VIPs still announced elsewhere are reinstalled below, the others are done
+            affected -= {vip for vip in flushed if vip not in shard.vip_nexthops}
+        
+        if affected or shard.failed_vips:
+            succeeded = program_vips(shard, affected | shard.failed_vips, logger, moved)
+        else:
+            logger.debug("Routes for TrafficDirector %s already up to date", td_name)
+            succeeded = True
+        
+        # Also after a table flush left nothing to program, the object of a deleted TrafficDirector goes with it
+        if shard.nexthop_manager and not routes and succeeded:
+            shard.nexthop_manager.remove(td_name)
+        return succeeded
+
+def program_vips(shard, vips, logger, moved=()):
+    """Make the route of every VIP in vips match its nexthop set in the index in one backend transaction, returns False if any route failed"""
+    # VIPs taking other nexthops than before, moved ones got them through their nexthop object
+    rerouted = set(moved)
+    try:
+        if AGGREGATE_PREFIX_LEN:
+            succeeded = program_aggregates(shard, vips, rerouted, logger)
+        else:
+            succeeded = program_routes(shard, vips, rerouted, logger)
+    except Exception:
+        # The index already calls for the new routes, the retry must not find them up to date
+        shard.failed_vips.update(vips)
+        raise
+    if shard.conntrack:
+        shard.rerouted_vips.update(rerouted)
+    return succeeded
+
+def apply_ops(shard, ops, logger):
+    """shard.backend.apply(ops), failing every op when the backend cannot apply the batch at all"""
+    try:
+        return shard.backend.apply(ops)
+    except Exception as e:
+        # Netlink dropped the batch or ip could not be started, none of the ops is known to be in
+        logger.error(f"Route backend of netns {shard.netns} failed to apply {len(ops)} route changes: {e}")
+        error = e if isinstance(e, RouteError) else RouteError(getattr(e, 'errno', None) or errno.EIO, str(e))
+        return [error] * len(ops)
+
+def flush_conntrack(shard, logger):
+    """Delete the conntrack entries of the VIPs rerouted since the last call, their flows start over along the new routes.
+
+    Called once routes_lock is released, the other reconciles of the shard go on while the conntrack table is searched.
+    """
+    if not shard.conntrack:
+        return
+    with shard.routes_lock:
+        vips, shard.rerouted_vips = shard.rerouted_vips, set()
+    if not vips:
+        return
+    start = time.monotonic()
+    try:
+        flows = shard.conntrack.flush(vips)
+    except OSError as e:
+        # The routes are right, only flows that were already running keep their entries
+        logger.warning("conntrack op=flush vips=%d netns=%s result=%s", len(vips), shard.netns, errno.errorcode.get(e.errno, e.errno))
+        return
+    conntrack_flushed.inc(flows)
+    logger.info("conntrack op=flush vips=%d flows=%d netns=%s duration=%.1fms result=ok", len(vips), flows, shard.netns, (time.monotonic() - start) * 1000)
+
+def program_routes(shard, vips, rerouted, logger):
+    """program_vips() with one /32 route per VIP, adds the VIPs it gave other nexthops to rerouted"""
+    succeeded = True
+    ops = []
+    targets = []
+    # VIP -> table its route moves out of
+    moved = {}
+    for vip in sorted(vips):
+        target = route_target(shard, vip)
+        table = route_table(shard, vip)
+        old_table = shard.route_tables.get(vip, RT_TABLE_MAIN)
+        if shard.installed_routes.get(vip) == target and old_table == table:
+            # Already routed this way, through another TrafficDirector or the TD's nexthop object
+            shard.failed_vips.discard(vip)
+            continue
+        
+        if not target:
+            ops.append(('delete', vip, (), old_table))
+        elif shard.nexthop_manager:
+            try:
+                ops.append(('replace', vip, shard.nexthop_manager.acquire(target), table))
+            except RouteError as e:
+                shard.failed_vips.add(vip)
+                succeeded = False
+                record_route_op(shard, logger, 'replace', vip, desired_nexthops(shard, vip), e, table=table)
+                continue
+        else:
+            # Replace swaps the whole nexthop set at once, the VIP never loses its route
+            ops.append(('replace', vip, desired_nexthops(shard, vip), table))
+        targets.append(target)
+        if target and old_table != table:
+            moved[vip] = old_table
+    if not ops:
+        return succeeded
+    
+    start = time.monotonic()
+    results = apply_ops(shard, ops, logger)
+    # The ops went out together, each one is accounted its share of the transaction
+    duration = (time.monotonic() - start) / len(ops)
+    
+    cleanups = []
+    for (action, vip, route, table), target, error in zip(ops, targets, results):
+        if error and not (action == 'delete' and error.errno == errno.ESRCH):
+            shard.failed_vips.add(vip)
+            succeeded = False
+            if isinstance(route, int):
+                shard.nexthop_manager.release(route)
+        elif action == 'delete':
+            shard.installed_routes.pop(vip, None)
+            shard.route_tables.pop(vip, None)
+            shard.failed_vips.discard(vip)
+            if shard.nexthop_manager:
+                shard.nexthop_manager.unbind(vip)
+        else:
+            if isinstance(route, int):
+                shard.nexthop_manager.bind(vip, route)
+            if shard.installed_routes.get(vip, target) != target:
+                rerouted.add(vip)
+            shard.installed_routes[vip] = target
+            set_route_table(shard, vip, table)
+            shard.failed_vips.discard(vip)
+            if vip in moved:
+                # The route moved between tables, the old one goes now that the new one is in
+                cleanups.append(('delete', vip, (), moved[vip]))
+        record_route_op(shard, logger, action, vip, desired_nexthops(shard, vip), error, duration, table)
+    
+    if cleanups:
+        start = time.monotonic()
+        results = apply_ops(shard, cleanups, logger)
+        duration = (time.monotonic() - start) / len(cleanups)
+        for (action, vip, _, table), error in zip(cleanups, results):
+            if error and error.errno != errno.ESRCH:
+                # Left in the old table, the next reconcile moves it again
+                set_route_table(shard, vip, table)
+                shard.failed_vips.add(vip)
+                succeeded = False
+                record_route_op(shard, logger, action, vip, (), error, duration, table)
+    return succeeded
+
+def program_aggregates(shard, vips, rerouted, logger):
+    """program_vips() with AGGREGATE_PREFIX_LEN: re-aggregate the blocks of vips and program what differs from their aggregates"""
+    succeeded = True
+    ops, changes = [], []
+    cleanups, cleanup_changes = [], []
+    # Destinations whose new route could not be installed
+    failed = []
+    for block in sorted({vip_block(vip) for vip in vips}):
+        desired = aggregate_block(shard, block)
+        # Recorded ahead of the kernel changes, the route monitor tells our own changes from drift by them
+        installed = shard.prefixes.setdefault(block, {})
+        for dst, old in list(installed.items()):
+            if dst not in desired:
+                del installed[dst]
+                cleanups.append(('delete', dst, (), old[1]))
+                cleanup_changes.append((block, None, old))
+        
+        for dst, route in desired.items():
+            target, table = route
+            old = installed.get(dst)
+            if old == route and all(shard.installed_routes.get(vip) == target for vip in dst_vips(dst)):
+                shard.failed_vips.difference_update(dst_vips(dst))
+                continue
+            node_ips = target
+            if shard.nexthop_manager:
+                try:
+                    node_ips = shard.nexthop_manager.acquire(target)
+                except RouteError as e:
+                    shard.failed_vips.update(dst_vips(dst))
+                    succeeded = False
+                    failed.append(dst)
+                    record_route_op(shard, logger, 'replace', dst, desired_nexthops(shard, dst_prefix(dst)[0]), e, table=table)
+                    continue
+            installed[dst] = route
+            ops.append(('replace', dst, node_ips, table))
+            changes.append((block, route, old))
+            if old and old[1] != table:
+                cleanups.append(('delete', dst, (), old[1]))
+                cleanup_changes.append((block, None, old))
+    
+    released = set(vips)
+    if ops:
+        start = time.monotonic()
+        results = apply_ops(shard, ops, logger)
+        duration = (time.monotonic() - start) / len(ops)
+        
+        for (action, dst, node_ips, table), (block, route, old), error in zip(ops, changes, results):
+            installed = shard.prefixes.setdefault(block, {})
+            if error:
+                if isinstance(node_ips, int):
+                    shard.nexthop_manager.release(node_ips)
+                # The kernel keeps the route it had
+                if old:
+                    installed[dst] = old
+                else:
+                    installed.pop(dst, None)
+                shard.failed_vips.update(dst_vips(dst))
+                succeeded = False
+                failed.append(dst)
+            else:
+                if isinstance(node_ips, int):
+                    shard.nexthop_manager.bind(dst, node_ips)
+                # Re-split or merged aggregates keep the nexthops of their VIPs
+                rerouted.update(vip for vip in dst_vips(dst) if shard.installed_routes.get(vip, route[0]) != route[0])
+                install_route(shard, dst, *route)
+            record_route_op(shard, logger, action, dst, desired_nexthops(shard, dst_prefix(dst)[0]), error, duration, table)
+    
+    # Re-split or merged aggregates go once the routes replacing them are in, an old
+    # route still carrying VIPs whose new route failed stays until the next attempt
+    deletes, delete_changes = [], []
+    for op, change in zip(cleanups, cleanup_changes):
+        dst = op[1]
+        if any(prefixes_overlap(dst, failed_dst) for failed_dst in failed):
+            block, _, old = change
+            shard.prefixes.setdefault(block, {}).setdefault(dst, old)
+            continue
+        deletes.append(op)
+        delete_changes.append(change)
+    if deletes:
+        start = time.monotonic()
+        results = apply_ops(shard, deletes, logger)
+        duration = (time.monotonic() - start) / len(deletes)
+        
+        for (action, dst, node_ips, table), (block, route, old), error in zip(deletes, delete_changes, results):
+            installed = shard.prefixes.setdefault(block, {})
+            if error and error.errno != errno.ESRCH:
+                # Still in the kernel, deleted again by the next reconcile of the block
+                installed[dst] = old
+                shard.failed_vips.update(dst_vips(dst))
+                succeeded = False
+            else:
+                if installed.get(dst) == old:
+                    del installed[dst]
+                if dst not in installed and shard.nexthop_manager:
+                    shard.nexthop_manager.unbind(dst)
+                released.update(dst_vips(dst))
+            record_route_op(shard, logger, action, dst, desired_nexthops(shard, dst_prefix(dst)[0]), error, duration, table)
+    
+    # VIPs no longer announced are done once no aggregate routes them
+    for vip in released:
+        if vip not in shard.vip_nexthops and covering_prefix(shard.prefixes.get(vip_block(vip), {}), vip) is None:
+            forget_vip(shard, vip)
+    for block in {vip_block(vip) for vip in vips}:
+        if not shard.prefixes.get(block):
+            shard.prefixes.pop(block, None)
+    return succeeded
+
+def delete_routes_for_vips(shard, td_name, logger):
+    """Delete network routes for a TrafficDirector, returns False if any route failed"""
+    if td_name not in shard.traffic_director_vips:
+        logger.warning(f"No VIPs found for TrafficDirector {td_name}")
+    succeeded = reconcile_routes_for_vips(shard, td_name, None, logger)
+    if succeeded:
+        logger.info(f"Deleted routes for TrafficDirector {td_name}")
+    return succeeded
+
+def retry_failed_vips(shard, logger):
+    """Program the VIPs whose last attempt failed again, returns False if any still fails"""
+    with shard.routes_lock:
+        if not shard.failed_vips:
+            return True
+        logger.info(f"Retrying {len(shard.failed_vips)} failed routes on netns {shard.netns}")
+        return program_vips(shard, set(shard.failed_vips), logger)
+
+def repair_routes(shard, vips, reason, logger):
+    """Reinstall installed routes the kernel no longer holds as programmed, all of them if vips is None"""
+    with shard.routes_lock:
+        if vips is None:
+            if shard.nexthop_manager:
+                try:
+                    shard.nexthop_manager.restore()
+                except RouteError as e:
+                    logger.error("nexthop op=restore result=%s", errno.errorcode.get(e.errno, e.errno))
+            if shard.table_manager:
+                try:
+                    shard.table_manager.restore()
+                except RouteError as e:
+                    logger.error("table op=restore result=%s", errno.errorcode.get(e.errno, e.errno))
+            kernel = shard.backend.dump_route_tables()
+            vips = {
+                vip for vip in shard.installed_routes
+                if kernel.get(shard.route_tables.get(vip, RT_TABLE_MAIN), {}).get(installed_dst(shard, vip)) != desired_nexthops(shard, vip)
+            }
+        drifted = {vip for vip in vips if vip in shard.installed_routes}
+        if not drifted:
+            return
+        
+        logger.warning(f"Repairing {len(drifted)} routes changed outside route-updater ({reason})")
+        route_repairs.inc(len(drifted), reason=reason)
+        for vip in drifted:
+            shard.installed_routes.pop(vip)
+        program_vips(shard, drifted, logger)
+        
+        # Whatever could not be reinstalled is retried through the work queue
+        for td_name in traffic_directors_of(shard, shard.failed_vips):
+            shard.work_queue.add(td_name)
+    flush_conntrack(shard, logger)
+
+class RouteMonitor:
+    """Follow route, link and nexthop notifications in the router namespace and repair drifted routes.
+
+    Routes deleted or rewritten by anyone else are reinstalled as soon as the
+    notification arrives. The kernel flushes IPv4 routes and nexthop objects
+    silently when their interface goes down, so the egress interface coming
+    back up, a deleted nexthop object or table rule of ours or a notification
+    overrun reinstalls everything that differs from a fresh dump.
+    """
+
+    def __init__(self, shard, logger):
+        self.shard = shard
+        self.backend = shard.backend
+        self.logger = logger
+        self.link_up = True
+        self.sock = _in_netns(shard.netns, lambda: _netlink_socket(RTMGRP_LINK | RTMGRP_IPV4_ROUTE | RTMGRP_IPV4_RULE))
+        try:
+            self.sock.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, RTNLGRP_NEXTHOP)
+        except OSError as e:
+            # Kernels without nexthop objects have no such group
+            logger.debug("No nexthop notifications: %s", e)
+
+    def on_readable(self):
+        """Drain the pending notifications, called by the event loop when the socket is readable"""
+        drifted = set()
+        full_repair = None
+        while True:
+            try:
+                messages = _split_messages(self.sock.recv(NETLINK_RCVBUF))
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # Notifications were dropped, only a dump tells what changed
+                full_repair = "overrun"
                 continue
+            
+            for msg_type, _, data, offset, end in messages:
+                if msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+                    drifted.update(self._drifted_route(msg_type, data, offset, end))
+                elif msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    full_repair = self._link_event(msg_type, data, offset, end) or full_repair
+                elif msg_type == RTM_DELNEXTHOP and self.shard.nexthop_manager:
+                    attrs = _parse_rtattrs(data, offset + 8, end)
+                    if NHA_ID in attrs and struct.unpack("=I", attrs[NHA_ID])[0] in self.shard.nexthop_manager.ids():
+                        full_repair = "nexthop_deleted"
+                elif msg_type == RTM_DELRULE and self.shard.table_manager:
+                    if self.backend.parse_rule(data, offset, end) in self.shard.table_manager.tables.values():
+                        full_repair = "rule_deleted"
+        
+        if full_repair:
+            self._repair(None, full_repair)
+        elif drifted:
+            self._repair(drifted, "route_changed")
+
+    def _repair(self, vips, reason):
+        """Run repair_routes on the shard's threads, the event loop never waits for the kernel"""
+        future = asyncio.get_running_loop().run_in_executor(self.shard.executor, repair_routes, self.shard, vips, reason, self.logger)
+        future.add_done_callback(self._repair_done)
+
+    def _repair_done(self, future):
+        if not future.cancelled() and future.exception():
+            self.logger.error(f"Route repair on netns {self.shard.netns} failed: {future.exception()}")
+
+    def _drifted_route(self, msg_type, data, offset, end):
+        """Return the VIPs a notification leaves routed otherwise than desired"""
+        route = self.backend.parse_route(data, offset, end)
+        if not route:
+            return ()
+        dst, _, gateways, table = route
+        network = dst_prefix(dst)[0]
+        if AGGREGATE_PREFIX_LEN:
+            # Only the aggregates on record count, re-split and merged ones are taken off it before they go
+            recorded = self.shard.prefixes.get(vip_block(network), {}).get(dst)
+            if not recorded or recorded[1] != table:
+                return ()
+            vips = [vip for vip in dst_vips(dst) if vip in self.shard.installed_routes]
+        elif dst in self.shard.installed_routes and table == route_table(self.shard, dst):
+            vips = [dst]
+        else:
+            # Outside the table the VIP belongs in, like the old route of a move between tables
+            return ()
+        if msg_type == RTM_NEWROUTE and gateways == desired_nexthops(self.shard, network):
+            return ()
+        # Our own changes are seen too, repair_routes skips what is right by then
+        return vips
+
+    def _link_event(self, msg_type, data, offset, end):
+        """Track the egress interface, returns a repair reason when its routes must be reinstalled"""
+        _, _, ifindex, flags, _ = struct.unpack_from("=BxHiII", data, offset)
+        attrs = _parse_rtattrs(data, offset + 16, end)
+        name = attrs.get(IFLA_IFNAME, b"").rstrip(b"\0").decode()
+        if ifindex != self.backend.ifindex and name != self.backend.interface:
+            return None
+        
+        if msg_type == RTM_DELLINK:
+            self.logger.warning(f"Egress interface {self.backend.interface} was deleted")
+            self.link_up = False
+            return None
+        if ifindex != self.backend.ifindex:
+            self.logger.warning(f"Egress interface {name} was recreated with ifindex {ifindex}")
+            with self.backend.lock:
+                self.backend.ifindex = ifindex
+            self.link_up = False
+        
+        # Losing the carrier flushes the nexthop objects on the interface like taking it down
+        up = flags & (IFF_UP | IFF_LOWER_UP) == IFF_UP | IFF_LOWER_UP
+        if up == self.link_up:
+            return None
+        self.link_up = up
+        if not up:
+            self.logger.warning(f"Egress interface {self.backend.interface} went down, its routes are flushed")
+            return None
+        self.logger.info(f"Egress interface {self.backend.interface} is up again")
+        return "link_up"
+
+def start_route_monitor(shard, logger):
+    """Subscribe to the notifications of the shard's router namespace, read by the event loop"""
+    monitor = RouteMonitor(shard, logger)
+    monitor.sock.setblocking(False)
+    asyncio.get_running_loop().add_reader(monitor.sock, monitor.on_readable)
+    logger.info(f"Monitoring routes of {shard.interface} in netns {shard.netns}")
+
+def _checksum(data):
+    """Internet checksum of data, RFC 1071"""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+class NexthopProber:
+    """Probe the nodeIps of a shard from its router namespace, BFD style, and route around the silent ones.
+
+    Every PROBE_INTERVAL each nodeIp gets an ICMP echo request, or a UDP
+    datagram to an echo responder on PROBE_PORT. A nodeIp that answers none
+    of PROBE_MULTIPLIER probes in a row is taken out of the multipath routes,
+    and put back once it answered every probe for PROBE_HOLD_DOWN seconds.
+    The verdicts reach shard.unreachable_nodes on the shard's threads, under
+    routes_lock like every other input of the routes.
+    """
+
+    def __init__(self, shard, logger):
+        self.shard = shard
+        self.logger = logger
+        if PROBE_PROTOCOL == 'icmp':
+            self.sock = _in_netns(shard.netns, lambda: socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP))
+        else:
+            self.sock = _in_netns(shard.netns, lambda: socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        # Raw ICMP sockets see every echo reply of the namespace, ours carry this identifier
+        self.ident = random.getrandbits(16)
+        self.sequence = 0
+        # nodeIp -> when it last answered, or was first probed, and when the previous probes went out
+        self.last_reply = {}
+        self.sent = 0.0
+        # Unreachable nodeIp -> start of its current run of answers
+        self.answering_since = {}
+        # The prober's own view of the unreachable nodeIps, and the nodeIps it changed for since it was last handed over
+        self.unreachable = set()
+        self.changed = set()
+        self.updating = False
+
+    def _packet(self, node_ip):
+        self.sequence = (self.sequence + 1) & 0xffff
+        if PROBE_PROTOCOL == 'udp':
+            # Echoed from whatever source address the node picks, the nodeIp travels along
+            return struct.pack("!HHI", self.ident, self.sequence, node_ip)
+        header = struct.pack("!BBHHH", ICMP_ECHO, 0, 0, self.ident, self.sequence)
+        payload = struct.pack("!d", time.monotonic())
+        return header[:2] + struct.pack("!H", _checksum(header + payload)) + header[4:] + payload
+
+    def _answered(self, data, address):
+        """Return the nodeIp data from address answers a probe of, None if it is no answer to ours"""
+        if PROBE_PROTOCOL == 'udp':
+            if len(data) < 8:
+                return None
+            ident, _, node_ip = struct.unpack_from("!HHI", data)
+            return node_ip if ident == self.ident else None
+        # Raw sockets hand over the IP header too
+        offset = (data[0] & 0x0f) * 4
+        if len(data) < offset + 8:
+            return None
+        icmp_type, _, _, ident, _ = struct.unpack_from("!BBHHH", data, offset)
+        return ip_to_int(address) if icmp_type == ICMP_ECHOREPLY and ident == self.ident else None
+
+    def on_readable(self):
+        """Take in the pending answers, called by the event loop when the socket is readable"""
+        now = time.monotonic()
+        while True:
+            try:
+                data, (address, _) = self.sock.recvfrom(512)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.logger.debug("Probe receive on netns %s failed: %s", self.shard.netns, e)
+                break
+            node_ip = self._answered(data, address)
+            if node_ip not in self.last_reply:
+                continue
+            self.last_reply[node_ip] = now
+            if node_ip in self.unreachable:
+                self.answering_since.setdefault(node_ip, now)
+
+    async def run(self):
+        """Probe every PROBE_INTERVAL for ever"""
+        while True:
+            self.probe()
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    def probe(self):
+        """Send one probe to every nodeIp and withdraw or restore the ones whose state changed"""
+        now = time.monotonic()
+        node_ips = set(self.shard.node_traffic_directors)
+        for node_ip in self.last_reply.keys() - node_ips:
+            # No TrafficDirector routes via it any more
+            del self.last_reply[node_ip]
+            self.answering_since.pop(node_ip, None)
+            if node_ip in self.unreachable:
+                self.unreachable.discard(node_ip)
+                self.changed.add(node_ip)
+        
+        withdrawn, restored = set(), set()
+        for node_ip in node_ips:
+            # A new nodeIp counts as answering until it misses its first probes
+            last_reply = self.last_reply.setdefault(node_ip, now)
+            if last_reply < self.sent:
+                # Any unanswered probe starts the run of answers of an unreachable nodeIp over
+                self.answering_since.pop(node_ip, None)
+            if now - last_reply > PROBE_INTERVAL * PROBE_MULTIPLIER:
+                if node_ip not in self.unreachable:
+                    withdrawn.add(node_ip)
+            elif node_ip in self.answering_since and now - self.answering_since[node_ip] >= PROBE_HOLD_DOWN:
+                del self.answering_since[node_ip]
+                restored.add(node_ip)
+            try:
+                self.sock.sendto(self._packet(node_ip), (int_to_ip(node_ip), int(PROBE_PORT or 0)))
+            except OSError as e:
+                # Counts as a probe left unanswered
+                self.logger.debug("Probe of %s from netns %s failed: %s", int_to_ip(node_ip), self.shard.netns, e)
+        self.sent = now
+        
+        if withdrawn:
+            self.unreachable.update(withdrawn)
+            probe_transitions.inc(len(withdrawn), action='withdraw')
+            self.logger.warning(f"nodeIps {', '.join(map(int_to_ip, sorted(withdrawn)))} stopped answering probes from netns {self.shard.netns}, withdrawing them")
+        if restored:
+            self.unreachable.difference_update(restored)
+            probe_transitions.inc(len(restored), action='restore')
+            self.logger.info(f"nodeIps {', '.join(map(int_to_ip, sorted(restored)))} answered probes from netns {self.shard.netns} for {PROBE_HOLD_DOWN:g}s, restoring them")
+        self.changed |= withdrawn | restored
+        self._hand_over()
+
+    def _hand_over(self):
+        """Pass the unreachable nodeIps to the shard's threads, one handover at a time so they land in order"""
+        if self.updating or not self.changed:
+            return
+        self.updating = True
+        changed, self.changed = self.changed, set()
+        # On the shard's threads like route repairs, the event loop never waits for routes_lock or the kernel
+        future = asyncio.get_running_loop().run_in_executor(
+            self.shard.executor, update_unreachable_nodes, self.shard, set(self.unreachable), changed, self.logger
+        )
+        future.add_done_callback(self._handed_over)
+
+    def _handed_over(self, future):
+        self.updating = False
+        if not future.cancelled() and future.exception():
+            self.logger.error(f"Rerouting around probed nodeIps on netns {self.shard.netns} failed: {future.exception()}")
+        # Verdicts reached meanwhile follow right away
+        self._hand_over()
+
+def update_unreachable_nodes(shard, unreachable, changed, logger):
+    """Make unreachable the nodeIps shard routes around, then reroute the VIPs of the changed ones"""
+    with shard.routes_lock:
+        shard.unreachable_nodes = unreachable
+    reroute_nodes(shard, changed, logger)
+
+def start_nexthop_prober(shard, logger):
+    """Start probing the nodeIps of shard from its router namespace, returns the probing task"""
+    prober = NexthopProber(shard, logger)
+    prober.sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    loop.add_reader(prober.sock, prober.on_readable)
+    logger.info(
+        f"Probing nodeIps from netns {shard.netns} over {PROBE_PROTOCOL} every {PROBE_INTERVAL * 1000:g}ms, "
+        f"detection after {PROBE_MULTIPLIER} misses, hold-down {PROBE_HOLD_DOWN:g}s"
+    )
+    return loop.create_task(prober.run(), name=f"probe-{shard.netns}")
+
+class EventRecorder:
+    """Append every TrafficDirector list and raw watch event to a JSONL file, one timestamped record per line.
+
+    route-updater-bench.py --replay feeds a recording back through the reconciler.
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        logger.info(f"Recording TrafficDirector events to {path}")
+
+    def record(self, event_type, **fields):
+        line = json.dumps({'ts': round(time.time(), 6), 'type': event_type, **fields}, separators=(',', ':'))
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                # Flushed line by line, a crash loses nothing that was processed
+                self.file.write(line + "\n")
+                self.file.flush()
+            except OSError as e:
+                # Stop recording rather than break the watch
+                self.logger.error(f"Recording to {self.path} failed, recording stopped: {e}")
+                self.file.close()
+                self.file = None
+
+def list_traffic_directors(custom_api):
+    """List all TrafficDirectors, returns (items, resourceVersion of the list)"""
+    result = custom_api.list_namespaced_custom_object(
+        group=CRD_GROUP,
+        version=CRD_VERSION,
+        namespace=NAMESPACE,
+        plural=CRD_PLURAL
+    )
+    items, resource_version = result.get('items', []), result['metadata']['resourceVersion']
+    if recorder:
+        recorder.record('LIST', resourceVersion=resource_version, items=items)
+    return items, resource_version
+
+def load_traffic_directors(custom_api, logger):
+    """List TrafficDirectors into the object cache, returns the list resourceVersion"""
+    items, resource_version = list_traffic_directors(custom_api)
+    
+    # Desired state straight from the API server, the stored maps are rebuilt from it
+    traffic_director_objects.clear()
+    traffic_director_fingerprints.clear()
+    for item in items:
+        td_name = f"{item['metadata']['namespace']}/{item['metadata']['name']}"
+        traffic_director_objects[td_name] = item
+        traffic_director_fingerprints[td_name] = route_fingerprint(item)
+    
+    logger.info(f"Listed {len(items)} TrafficDirectors at resourceVersion {resource_version}")
+    return resource_version
+
+def sync_traffic_directors(custom_api, logger):
+    """Converge the kernel routes of every shard with the listed TrafficDirectors, returns the list resourceVersion"""
+    start = time.monotonic()
+    resource_version = load_traffic_directors(custom_api, logger)
+    sync_shards(logger)
+    sync_duration.set(time.monotonic() - start)
+    return resource_version
+
+def sync_shards(logger):
+    """Converge the kernel routes of every shard with the cached TrafficDirectors"""
+    for shard in shards:
+        sync_shard(shard, logger)
+
+def sync_shard(shard, logger):
+    """Converge the kernel routes of shard with its TrafficDirectors in one batch"""
+    start = time.monotonic()
+    installed = shard.backend.dump_route_tables()
+    rule_tables = shard.backend.dump_rules()
+    
+    with shard.routes_lock:
+        shard.traffic_director_vips.clear()
+        shard.vip_nexthops.clear()
+        shard.node_traffic_directors.clear()
+        shard.block_vips.clear()
+        shard.targets.clear()
+        # The watch may be updating the cache meanwhile, its events are queued for the workers
+        for td_name, item in list(traffic_director_objects.items()):
+            if not shard.selects(item):
+                continue
+            routes = extract_vips(td_name, item, logger)
+            if not routes:
+                continue
+            index_traffic_director(shard, td_name, routes)
+            for vip in routes.vips:
+                index_vip(shard, td_name, vip, routes.node_ip)
+        
+        shard.installed_routes.clear()
+        shard.route_tables.clear()
+        shard.prefixes.clear()
+        shard.failed_vips.clear()
+        shard.table_manager = sync_route_tables(shard, installed, logger) if TD_TABLES else None
+        nexthops = shard.backend.dump_nexthops()
+        route_nhids = {}
+        if NEXTHOP_OBJECTS:
+            route_nhids = shard.backend.dump_route_nexthops()
+            sync_nexthop_objects(shard, nexthops, route_nhids, logger)
+        
+        desired = desired_routes(shard)
+        ops = []
+        for dst, (target, table) in desired.items():
+            if shard.nexthop_manager:
+                try:
+                    nhid = shard.nexthop_manager.acquire(target)
+                except RouteError as e:
+                    shard.failed_vips.update(dst_vips(dst))
+                    record_route_op(shard, logger, 'replace', dst, desired_nexthops(shard, dst_prefix(dst)[0]), e, table=table)
+                    continue
+                if route_nhids.get(table, {}).get(dst) == nhid:
+                    # Already through the object it gets, which was taken over with the right gateways
+                    shard.nexthop_manager.bind(dst, nhid)
+                    install_route(shard, dst, target, table)
+                else:
+                    ops.append(('replace', dst, nhid, table))
+            elif not nexthops and installed.get(table, {}).get(dst) == target:
+                install_route(shard, dst, target, table)
+            else:
+                # Routes may still point at objects of a run with nexthop objects on, those are all rewritten inline
+                ops.append(('replace', dst, target, table))
+        # Whatever sits in another table than it belongs in goes, with the tables nobody owns any more
+        ops += [('delete', dst, (), table) for table, routes in installed.items() for dst in routes if desired.get(dst, (None, None))[1] != table]
+        
+        results = apply_ops(shard, ops, logger) if ops else []
+        for (action, dst, node_ips, table), error in zip(ops, results):
+            if error and not (action == 'delete' and error.errno == errno.ESRCH):
+                shard.failed_vips.update(dst_vips(dst))
+                if shard.nexthop_manager and action == 'replace':
+                    shard.nexthop_manager.release(node_ips)
+                elif action == 'delete' and AGGREGATE_PREFIX_LEN:
+                    # Retried from where it is left
+                    shard.prefixes.setdefault(vip_block(dst_prefix(dst)[0]), {})[dst] = ((), table)
+                elif action == 'delete':
+                    set_route_table(shard, dst, table)
+                record_route_op(shard, logger, action, dst, desired_nexthops(shard, dst_prefix(dst)[0]), error, table=table)
+            elif action == 'replace':
+                if shard.nexthop_manager:
+                    shard.nexthop_manager.bind(dst, node_ips)
+                install_route(shard, dst, *desired[dst])
+        
+        # Rules of tables no TrafficDirector owns, the tables were emptied above
+        owned = set(shard.table_manager.tables.values()) if shard.table_manager else set()
+        for table in sorted(rule_tables - owned):
+            try:
+                shard.backend.delete_rule(table)
+            except RouteError as e:
+                if e.errno != errno.ENOENT:
+                    logger.warning("table op=delete_rule table=%d result=%s", table, errno.errorcode.get(e.errno, e.errno))
+        
+        # Routes have moved onto the objects in use or inline nexthops, the previous run's other objects are unused now
+        in_use = set()
+        if shard.nexthop_manager:
+            shard.nexthop_manager.drop_unused_groups()
+            in_use = shard.nexthop_manager.ids()
+        for nhid in sorted(set(nexthops) - in_use, reverse=True):
+            try:
+                shard.backend.delete_nexthop(nhid)
+            except RouteError as e:
+                if e.errno != errno.ENOENT:
+                    logger.warning("nexthop op=delete id=%d result=%s", nhid, errno.errorcode.get(e.errno, e.errno))
+        
+        # Retry whatever the batch could not program through the normal work queue
+        for td_name in traffic_directors_of(shard, shard.failed_vips):
+            shard.work_queue.add(td_name)
+    
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"Synced {len(shard.traffic_director_vips)} TrafficDirectors on netns {shard.netns}: "
+        f"{len(desired)} routes desired, {sum(map(len, installed.values()))} installed, "
+        f"{results.count(None)} changes applied, {len(shard.failed_vips)} failed, converged in {elapsed * 1000:.1f} ms"
+    )
+
+def sync_route_tables(shard, installed, logger):
+    """Give every stored TrafficDirector a table, the one already holding most of its VIPs if possible"""
+    manager = RouteTableManager(shard.backend)
+    vip_tables = {vip: table for table, routes in installed.items() if table != RT_TABLE_MAIN for dst in routes for vip in dst_vips(dst)}
+    
+    adopted = set()
+    for td_name, routes in shard.traffic_director_vips.items():
+        if len(adopted) >= TD_TABLES_MAX:
+            break
+        counts = collections.Counter(vip_tables[vip] for vip in routes.vips if vip in vip_tables)
+        for table, _ in counts.most_common():
+            if table not in adopted:
+                manager.adopt(td_name, table)
+                adopted.add(table)
+                break
+    
+    for td_name in shard.traffic_director_vips:
+        try:
+            manager.acquire(td_name)
+        except RouteError as e:
+            logger.error("table op=add td=%s result=%s", td_name, errno.errorcode.get(e.errno, e.errno))
+    if len(shard.traffic_director_vips) > len(manager.tables):
+        logger.warning(
+            f"{len(shard.traffic_director_vips) - len(manager.tables)} TrafficDirectors keep their routes in the main table, "
+            f"ROUTE_UPDATER_TD_TABLES_MAX allows {TD_TABLES_MAX} tables"
+        )
+    return manager
+
+def sync_nexthop_objects(shard, nexthops, route_nhids, logger):
+    """Give every stored TrafficDirector a nexthop object, taking over the one its routes use if it still has the right gateway"""
+    # New ids start above the previous run's, routes can be replaced onto new objects while the old ones are in place
+    manager = shard.nexthop_manager = NexthopManager(shard.backend, max(nexthops, default=NEXTHOP_ID_BASE - 1) + 1)
+    
+    # A route through a group counts for every member object
+    vip_nhids = collections.defaultdict(list)
+    for routes in route_nhids.values():
+        for dst, nhid in routes.items():
+            members = nexthops.get(nhid)
+            for vip in dst_vips(dst):
+                vip_nhids[vip].extend(members if isinstance(members, tuple) else (nhid,))
+    
+    adopted = set()
+    for td_name, routes in shard.traffic_director_vips.items():
+        counts = collections.Counter(nhid for vip in routes.vips for nhid in vip_nhids.get(vip, ()))
+        for nhid, _ in counts.most_common():
+            if nhid not in adopted and nexthops.get(nhid) == routes.node_ip:
+                manager.adopt(td_name, nhid, routes.node_ip)
+                adopted.add(nhid)
+                break
+    # Groups over taken over objects only are used again as they are
+    for nhid, members in nexthops.items():
+        if isinstance(members, tuple) and members and adopted.issuperset(members) and frozenset(members) not in manager.groups:
+            manager.adopt_group(nhid, members)
+    if adopted:
+        logger.info(f"Took over {len(adopted)} nexthop objects and {len(manager.groups)} groups of the previous run on netns {shard.netns}")
+    
+    for td_name, routes in shard.traffic_director_vips.items():
+        try:
+            shard.nexthop_manager.set_gateway(td_name, routes.node_ip)
+        except RouteError as e:
+            logger.error("nexthop op=replace via=%s td=%s result=%s", int_to_ip(routes.node_ip), td_name, errno.errorcode.get(e.errno, e.errno))
+
+def relist_traffic_directors(custom_api, logger):
+    """Relist TrafficDirectors into the object cache and queue the ones that changed, returns the list resourceVersion"""
+    items, resource_version = list_traffic_directors(custom_api)
+    logger.info(f"Listed {len(items)} TrafficDirectors at resourceVersion {resource_version}")
+    
+    listed = {}
+    for item in items:
+        listed[f"{item['metadata']['namespace']}/{item['metadata']['name']}"] = item
+    
+    for td_name in set(traffic_director_objects) | set(listed):
+        item = listed.get(td_name)
+        if item is None:
+            logger.info(f"Resource {td_name} was deleted while not watching")
+            traffic_director_objects.pop(td_name, None)
+            traffic_director_fingerprints.pop(td_name, None)
+        else:
+            traffic_director_objects[td_name] = item
+            if not fingerprint_changed(td_name, item):
+                continue
+        queue_traffic_director(td_name)
+    
+    return resource_version
+
+def watch_traffic_directors(custom_api, resource_version, logger):
+    """Watch TrafficDirectors forever, resuming from the last seen resourceVersion"""
+    retry_delay = WATCH_RETRY_DELAY
+    
+    while True:
+        logger.info(f"Starting watch on {CRD_PLURAL} in namespace {NAMESPACE} from resourceVersion {resource_version}")
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                custom_api.list_namespaced_custom_object,
+                group=CRD_GROUP,
+                version=CRD_VERSION,
+                namespace=NAMESPACE,
+                plural=CRD_PLURAL,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=WATCH_TIMEOUT_SECONDS
+            ):
+                retry_delay = WATCH_RETRY_DELAY
+                resource_version = event['raw_object']['metadata']['resourceVersion']
+                if recorder:
+                    recorder.record(event['type'], object=event['raw_object'])
+                if event['type'] == 'BOOKMARK':
+                    events_received.inc(type='BOOKMARK')
+                    continue
                 
+                try:
+                    process_event(event, logger)
+                except Exception as e:
+                    logger.error(f"Error processing event: {e}")
+                    continue
+            
+            # Server side timeout, resume from where we left off
+            watch_reconnects.inc(reason="timeout")
+            logger.info(f"Watch timed out, resuming from resourceVersion {resource_version}")
+            
+        except ApiException as e:
+            if e.status == 410:
+                # Our resourceVersion is too old to resume from, fall back to list and diff
+                watch_reconnects.inc(reason="gone")
+                logger.warning(f"Watch resourceVersion {resource_version} expired, relisting")
+                resource_version = None
+                while resource_version is None:
+                    try:
+                        resource_version = relist_traffic_directors(custom_api, logger)
+                    except Exception as relist_error:
+                        logger.error(f"Relist failed, retrying in {retry_delay}s: {relist_error}")
+                        time.sleep(retry_delay)
+                        retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+                continue
+            watch_reconnects.inc(reason="error")
+            logger.error(f"Watch failed, reconnecting in {retry_delay}s: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+        except Exception as e:
+            # Connection reset, API server restart and the like
+            watch_reconnects.inc(reason="error")
+            logger.error(f"Watch connection lost, reconnecting in {retry_delay}s: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+        finally:
+            w.stop()
+
+def node_readiness(node):
+    """Return (InternalIPs, Ready, last Ready transition) of a Node, a Node without a Ready condition counts as Ready"""
+    status = node.status
+    node_ips = set()
+    for address in (status.addresses if status else None) or []:
+        if address.type == 'InternalIP':
+            try:
+                node_ips.add(ip_to_int(address.address))
+            except OSError:
+                # IPv6, no IPv4 route points at it
+                pass
+    for condition in (status.conditions if status else None) or []:
+        if condition.type == 'Ready':
+            return node_ips, condition.status == 'True', condition.last_transition_time
+    return node_ips, True, None
+
+def update_node(name, node, logger):
+    """Track the readiness of Node name, None once deleted, and reroute the nodeIps that went down or came back"""
+    global down_nodes
+    if node is None:
+        # A deleted Node forwards nothing any more, a Node registering with its nodeIp again restores them
+        node_ips, ready, since = node_addresses.pop(name, set()), False, None
+    else:
+        node_ips, ready, since = node_readiness(node)
+        node_addresses[name] = node_ips
+    changed = node_ips & down_nodes if ready else node_ips - down_nodes
+    if not changed:
+        return
+    
+    # A new set rather than an update, the shards read the one they were given under their routes_lock
+    if ready:
+        down_nodes = down_nodes - changed
+        logger.info(f"Node {name} is Ready, restoring nodeIps {', '.join(map(int_to_ip, sorted(changed)))}")
+    else:
+        down_nodes = down_nodes | changed
+        logger.warning(f"Node {name} is {'deleted' if node is None else 'not Ready'}, withdrawing nodeIps {', '.join(map(int_to_ip, sorted(changed)))}")
+    for shard in shards:
+        update_down_nodes(shard, down_nodes, changed, logger)
+    if since:
+        # From the API server's clock, skew can make it slightly off
+        latency = (datetime.datetime.now(datetime.timezone.utc) - since).total_seconds()
+        node_failover_latency.observe(max(latency, 0.0), action='restore' if ready else 'withdraw')
+
+def update_down_nodes(shard, down, changed, logger):
+    """Make down the nodeIps of Nodes shard routes around, then reroute the VIPs of the changed ones"""
+    with shard.routes_lock:
+        shard.down_nodes = down
+    reroute_nodes(shard, changed, logger)
+
+def reroute_nodes(shard, node_ips, logger):
+    """Reprogram the VIPs of the TrafficDirectors on node_ips after those nodes went down or came back"""
+    with shard.routes_lock:
+        td_names = {td_name for node_ip in node_ips for td_name in shard.node_traffic_directors.get(node_ip, ())}
+        # Only VIPs announced from several nodes change, program_vips() skips the others
+        vips = {vip for td_name in td_names for vip in shard.traffic_director_vips[td_name].vips}
+        if vips:
+            program_vips(shard, vips, logger)
+        
+        # Whatever could not be rerouted is retried through the work queue
+        for td_name in traffic_directors_of(shard, shard.failed_vips):
+            shard.work_queue.add(td_name)
+    flush_conntrack(shard, logger)
+
+def load_nodes(core_api, logger):
+    """List Nodes into the readiness cache, rerouting the nodeIps whose readiness changed, returns the list resourceVersion"""
+    nodes = core_api.list_node()
+    listed = set()
+    for node in nodes.items:
+        listed.add(node.metadata.name)
+        update_node(node.metadata.name, node, logger)
+    for name in set(node_addresses) - listed:
+        update_node(name, None, logger)
+    logger.info(f"Listed {len(listed)} Nodes at resourceVersion {nodes.metadata.resource_version}, {len(down_nodes)} nodeIps down")
+    return nodes.metadata.resource_version
+
+def watch_nodes(core_api, resource_version, logger):
+    """Watch Node readiness forever, resuming from the last seen resourceVersion"""
+    retry_delay = WATCH_RETRY_DELAY
+    
+    while True:
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                core_api.list_node,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=WATCH_TIMEOUT_SECONDS
+            ):
+                retry_delay = WATCH_RETRY_DELAY
+                resource_version = event['raw_object']['metadata']['resourceVersion']
+                if event['type'] == 'BOOKMARK':
+                    continue
+                try:
+                    name = event['raw_object']['metadata']['name']
+                    update_node(name, None if event['type'] == 'DELETED' else event['object'], logger)
+                except Exception as e:
+                    logger.error(f"Error processing Node event: {e}")
+            watch_reconnects.inc(reason="node_timeout")
+            
+        except ApiException as e:
+            if e.status == 410:
+                watch_reconnects.inc(reason="node_gone")
+                logger.warning(f"Node watch resourceVersion {resource_version} expired, relisting")
+                resource_version = None
+                while resource_version is None:
+                    try:
+                        resource_version = load_nodes(core_api, logger)
+                    except Exception as relist_error:
+                        logger.error(f"Node relist failed, retrying in {retry_delay}s: {relist_error}")
+                        time.sleep(retry_delay)
+                        retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+                continue
+            watch_reconnects.inc(reason="node_error")
+            logger.error(f"Node watch failed, reconnecting in {retry_delay}s: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+        except Exception as e:
+            watch_reconnects.inc(reason="node_error")
+            logger.error(f"Node watch connection lost, reconnecting in {retry_delay}s: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCH_MAX_RETRY_DELAY)
+        finally:
+            w.stop()
+
+class LeaderElector:
+    """Leader election on a coordination.k8s.io Lease, following client-go's leaderelection.
+
+    A standby only trusts a lease it has seen unchanged for a full lease
+    duration on its own clock, so clock skew between replicas does not
+    matter. The leader gives up after failing to renew for the renew
+    deadline, before any standby can consider the lease expired.
+    """
+
+    def __init__(self, coordination_api, name, namespace, identity, logger):
+        self.api = coordination_api
+        self.name = name
+        self.namespace = namespace
+        self.identity = identity
+        self.logger = logger
+        self.observed = None
+        self.observed_at = 0.0
+        self.leading = False
+        self.released = False
+
+    def try_acquire_or_renew(self):
+        """Take or renew the lease, returns True while we hold it"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            lease = self.api.read_namespaced_lease(self.name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            spec = client.V1LeaseSpec(
+                holder_identity=self.identity,
+                lease_duration_seconds=LEASE_DURATION_SECONDS,
+                acquire_time=now,
+                renew_time=now,
+                lease_transitions=0
+            )
+            try:
+                self.api.create_namespaced_lease(self.namespace, client.V1Lease(metadata=client.V1ObjectMeta(name=self.name), spec=spec))
+            except ApiException as e:
+                if e.status == 409:
+                    # Another replica created it first
+                    return False
+                raise
+            return True
+        
+        spec = lease.spec
+        record = (spec.holder_identity, spec.renew_time)
+        if record != self.observed:
+            self.observed = record
+            self.observed_at = time.monotonic()
+        
+        if spec.holder_identity and spec.holder_identity != self.identity:
+            duration = spec.lease_duration_seconds or LEASE_DURATION_SECONDS
+            if time.monotonic() < self.observed_at + duration:
+                return False
+            self.logger.warning(f"Lease {self.namespace}/{self.name} of {spec.holder_identity} expired, taking over")
+        
+        if spec.holder_identity != self.identity:
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.holder_identity = self.identity
+        spec.lease_duration_seconds = LEASE_DURATION_SECONDS
+        spec.renew_time = now
+        try:
+            # The resourceVersion of the read makes this a compare-and-swap
+            self.api.replace_namespaced_lease(self.name, self.namespace, lease)
+        except ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        self.observed = (spec.holder_identity, spec.renew_time)
+        self.observed_at = time.monotonic()
+        return True
+
+    def _attempt(self):
+        try:
+            return self.try_acquire_or_renew()
+        except Exception as e:
+            self.logger.error(f"Lease {self.namespace}/{self.name} update failed: {e}")
+            return False
+
+    def acquire(self):
+        """Block until we hold the lease"""
+        self.logger.info(f"Waiting for lease {self.namespace}/{self.name} as {self.identity}")
+        while not self._attempt():
+            time.sleep(LEASE_RETRY_PERIOD * random.uniform(1.0, 1.2))
+        self.leading = True
+        self.logger.info(f"Acquired lease {self.namespace}/{self.name}, leading")
+
+    def renew(self):
+        """Renew the lease until that fails for longer than the renew deadline, then return"""
+        renewed_at = time.monotonic()
+        while True:
+            time.sleep(LEASE_RETRY_PERIOD)
+            if self.released:
+                return
+            if self._attempt():
+                renewed_at = time.monotonic()
+            elif time.monotonic() - renewed_at > LEASE_RENEW_DEADLINE:
+                self.leading = False
+                leader.set(0)
+                self.logger.error(f"Could not renew lease {self.namespace}/{self.name} for {LEASE_RENEW_DEADLINE}s, lost leadership")
+                return
+
+    def release(self):
+        """Hand the lease over right away on a clean shutdown"""
+        self.released = True
+        try:
+            lease = self.api.read_namespaced_lease(self.name, self.namespace)
+            if lease.spec.holder_identity != self.identity:
+                return
+            lease.spec.holder_identity = None
+            lease.spec.renew_time = None
+            self.api.replace_namespaced_lease(self.name, self.namespace, lease)
+            self.leading = False
+            leader.set(0)
+            self.logger.info(f"Released lease {self.namespace}/{self.name}")
+        except Exception as e:
+            self.logger.warning(f"Could not release lease {self.namespace}/{self.name}: {e}")
+
+class LostLeadership(Exception):
+    """The lease could not be renewed, another replica may be writing routes by now"""
+
+async def run(logger):
+    """Start every component on the event loop and watch until cancelled"""
+    global elector, recorder
+    shards.extend(parse_shards(SHARDS))
+    leader.set(0)
+    if RECORD_FILE:
+        recorder = EventRecorder(RECORD_FILE, logger)
+    
+    # Expose metrics first so a slow startup is visible too
+    await start_metrics_server(METRICS_PORT, logger)
+    
+    # Open a route backend in every router namespace
+    for shard in shards:
+        shard.open(logger)
+        logger.info(f"Shard netns {shard.netns} dev {shard.interface} routes TrafficDirectors matching {shard.selector or 'everything'!r}")
+    
+    # Load kubernetes config
+    try:
+        config.load_incluster_config()
+        logger.info("Loaded in-cluster config")
+    except config.ConfigException:
+        config.load_kube_config()
+        logger.info("Loaded local kube config")
+    
+    # Create API clients
+    api_extensions = client.ApiextensionsV1Api()
+    custom_api = client.CustomObjectsApi()
+    core_api = client.CoreV1Api()
+    
+    # Wait for CRD to exist
+    await run_in_thread(wait_for_crd, api_extensions, logger)
+    
+    if not LEADER_ELECTION:
+        # Converge routes left over from a previous run before watching, around Nodes already down
+        node_version = await run_in_thread(load_nodes, core_api, logger) if NODE_WATCH else None
+        resource_version = await run_in_thread(sync_traffic_directors, custom_api, logger)
+        start_route_writers(logger)
+        
+        # The kubernetes client only streams blocking, so the watch reads on a
+        # thread of its own and hands events straight to the shard queues
+        watching = [run_in_thread(watch_traffic_directors, custom_api, resource_version, logger)]
+        if NODE_WATCH:
+            watching.append(run_in_thread(watch_nodes, core_api, node_version, logger))
+        await asyncio.gather(*watching)
+        return
+    
+    # A standby keeps its cache warm from the watch, events queue up for the
+    # workers but nothing touches the kernel until we lead
+    resource_version = await run_in_thread(load_traffic_directors, custom_api, logger)
+    watching = run_in_thread(watch_traffic_directors, custom_api, resource_version, logger)
+    
+    elector = LeaderElector(client.CoordinationV1Api(), LEASE_NAME, NAMESPACE, LEASE_IDENTITY, logger)
+    await run_in_thread(elector.acquire)
+    
+    # Node readiness reroutes on its own, only the leader follows it
+    node_version = await run_in_thread(load_nodes, core_api, logger) if NODE_WATCH else None
+    start = time.monotonic()
+    await run_in_thread(sync_shards, logger)
+    sync_duration.set(time.monotonic() - start)
+    start_route_writers(logger)
+    
+    renewing = run_in_thread(elector.renew)
+    if NODE_WATCH:
+        watching = asyncio.gather(watching, run_in_thread(watch_nodes, core_api, node_version, logger))
+    done, _ = await asyncio.wait([watching, renewing], return_when=asyncio.FIRST_COMPLETED)
+    if renewing in done:
+        # Stop writing before a standby may take over, the restart comes back as a standby
+        raise LostLeadership(f"Lost lease {NAMESPACE}/{LEASE_NAME}")
+    await watching
+
+def start_route_writers(logger):
+    """Start what writes routes: the route monitors and the reconcile workers of every shard"""
+    leader.set(1)
+    for shard in shards:
+        # Reinstall routes removed behind our back from now on
+        if shard.backend.monitored:
+            start_route_monitor(shard, logger)
+        
+        # Reconcile on worker tasks so slow route operations never stall the watch
+        route_workers.extend(start_workers(shard, logger))
+        
+        # Route around nodeIps that stop answering long before their Node turns NotReady
+        if PROBE_PROTOCOL:
+            route_workers.append(start_nexthop_prober(shard, logger))
+
+def main():
+    """Main function"""
+    print("Entering main function", flush=True)
+    logger = setup_logging()
+    logger.info("Route updater started")
+    print("Logger setup complete", flush=True)
+    
+    try:
+        asyncio.run(run(logger))
     except KeyboardInterrupt:
+        for shard in shards:
+            shard.work_queue.shutdown()
+        if elector and elector.leading:
+            elector.release()
         logger.info("Route updater stopped by user")
     except Exception as e:
         logger.error(f"Fatal error: {e}")
@@ -0,0 +1,996 @@
+"""
+Route Updater Unit Tests
+
+This module contains unit tests for route-updater.py. Route programming
+runs against the dry-run backend, which keeps the kernel routes, nexthop
+objects and policy rules in memory, so the tests need neither a cluster
+nor a router namespace.
+"""
+
+import asyncio
+import errno
+import importlib.util
+import io
+import os
+import threading
+import types
+
+import pytest
+
+ROUTE_UPDATER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "route-updater.py")
+
+# The script name has a dash, so it is loaded from its path rather than imported
+spec = importlib.util.spec_from_file_location("route_updater", ROUTE_UPDATER_PATH)
+ru = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ru)
+
+LOGGER = ru.logging.getLogger("test")
+
+
+def vip(address):
+    return ru.ip_to_int(address)
+
+
+def traffic_director(name, vips, node_ip, generation=1, labels=None):
+    """Build a TrafficDirector object as the API server returns it"""
+    metadata = {'namespace': 'opsramp-sdn', 'name': name, 'generation': generation}
+    if labels is not None:
+        metadata['labels'] = labels
+    return {
+        'metadata': metadata,
+        'spec': {'gateways': [{'namespace': f'ns{index}', 'vip': address} for index, address in enumerate(vips)]},
+        'status': {'nodeIp': node_ip},
+    }
+
+
+def apply(shard, name, vips, node_ip, labels=None):
+    """Store TrafficDirector name announcing vips via node_ip and reconcile it on shard, returns False on failure"""
+    ru.traffic_director_objects[f"opsramp-sdn/{name}"] = traffic_director(name, vips, node_ip, labels=labels)
+    return ru.reconcile_traffic_director(shard, f"opsramp-sdn/{name}", LOGGER)
+
+
+def delete(shard, name):
+    """Drop TrafficDirector name and reconcile it on shard, returns False on failure"""
+    ru.traffic_director_objects.pop(f"opsramp-sdn/{name}", None)
+    return ru.reconcile_traffic_director(shard, f"opsramp-sdn/{name}", LOGGER)
+
+
+def kernel(shard):
+    """The routes of the dry-run backend as {table: {destination: gateways}}"""
+    return {
+        table: {ru.dst_to_str(dst): ",".join(map(ru.int_to_ip, gateways)) for dst, gateways in routes.items()}
+        for table, routes in shard.backend.dump_route_tables().items()
+    }
+
+
+def record_batches(shard, monkeypatch):
+    """Record the op batches shard applies, returns the list they are appended to"""
+    backend_apply = shard.backend.apply
+    batches = []
+
+    def recording_apply(ops):
+        batches.append([(action, ru.dst_to_str(dst)) for action, dst, _, _ in ops])
+        return backend_apply(ops)
+
+    monkeypatch.setattr(shard.backend, 'apply', recording_apply)
+    return batches
+
+
+@pytest.fixture
+def shard(monkeypatch):
+    """A shard programming the dry-run backend, with the TrafficDirector cache and node state empty"""
+    monkeypatch.setattr(ru, 'traffic_director_objects', {})
+    monkeypatch.setattr(ru, 'traffic_director_fingerprints', {})
+    monkeypatch.setattr(ru, 'down_nodes', set())
+    router = ru.RouterShard("n1", "lana_1")
+    router.backend = ru.DryRunRouteBackend(router.netns, router.interface, LOGGER)
+    monkeypatch.setattr(ru, 'shards', [router])
+    return router
+
+
+class TestWorkQueue:
+    """Test cases for the keyed work queue"""
+
+    def test_add_coalesces_pending_keys(self):
+        """A key added twice before it is taken is queued once"""
+        queue = ru.WorkQueue()
+        queue.add('a')
+        queue.add('a')
+        queue.add('b')
+        assert len(queue) == 2
+
+    def test_get_returns_keys_in_order(self):
+        """Keys come out in the order they were first added"""
+        queue = ru.WorkQueue()
+        for key in ('a', 'b', 'a', 'c'):
+            queue.add(key)
+
+        async def take():
+            return [await queue.get() for _ in range(3)]
+
+        assert asyncio.run(take()) == ['a', 'b', 'c']
+
+    def test_key_added_while_processing_is_requeued_on_done(self):
+        """A key is never handed out twice at once, an add during processing requeues it once on done()"""
+        queue = ru.WorkQueue()
+        queue.add('a')
+
+        async def take():
+            return await queue.get()
+
+        assert asyncio.run(take()) == 'a'
+        queue.add('a')
+        queue.add('a')
+        assert len(queue) == 0
+        queue.done('a')
+        assert len(queue) == 1
+        assert asyncio.run(take()) == 'a'
+        queue.done('a')
+        assert len(queue) == 0
+
+    def test_done_without_add_does_not_requeue(self):
+        """Finishing a key nobody added again leaves the queue empty"""
+        queue = ru.WorkQueue()
+        queue.add('a')
+        asyncio.run(queue.get())
+        queue.done('a')
+        assert len(queue) == 0
+
+    def test_rate_limited_backoff_doubles_up_to_max(self):
+        """Consecutive failures double the delay up to max_delay, forget() resets it"""
+        queue = ru.WorkQueue(base_delay=1, max_delay=5)
+        assert [queue.add_rate_limited('a') for _ in range(5)] == [1, 2, 4, 5, 5]
+        queue.forget('a')
+        assert queue.add_rate_limited('a') == 1
+
+    def test_rate_limited_key_comes_back_after_its_delay(self):
+        """A requeued key is handed out again once its backoff expired"""
+        queue = ru.WorkQueue(base_delay=0.01, max_delay=0.01)
+
+        async def retry():
+            queue.add('a')
+            key = await queue.get()
+            queue.add_rate_limited(key)
+            queue.done(key)
+            return await asyncio.wait_for(queue.get(), 1)
+
+        assert asyncio.run(retry()) == 'a'
+
+    def test_rate_limited_key_already_pending_is_not_duplicated(self):
+        """A backoff expiring for a key that was added meanwhile does not queue it twice"""
+        queue = ru.WorkQueue(base_delay=0.01, max_delay=0.01)
+
+        async def retry():
+            queue.add_rate_limited('a')
+            queue.add('a')
+            await asyncio.sleep(0.02)
+            key = await queue.get()
+            return key, len(queue)
+
+        assert asyncio.run(retry()) == ('a', 0)
+
+    def test_add_from_another_thread_wakes_get(self):
+        """Keys added from other threads wake a waiting worker"""
+        queue = ru.WorkQueue()
+
+        async def wait():
+            getter = asyncio.create_task(queue.get())
+            await asyncio.sleep(0.01)
+            threading.Thread(target=queue.add, args=('a',)).start()
+            return await asyncio.wait_for(getter, 1)
+
+        assert asyncio.run(wait()) == 'a'
+
+    def test_shutdown_releases_workers(self):
+        """get() returns None once the queue shuts down, later adds are dropped"""
+        queue = ru.WorkQueue()
+        queue.shutdown()
+        queue.add('a')
+        assert len(queue) == 0
+        assert asyncio.run(queue.get()) is None
+
+
+class TestBackendFailures:
+    """Test cases for retrying route changes the backend failed as a whole"""
+
+    @pytest.mark.parametrize("error", [
+        OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS)),
+        FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), "ip"),
+    ])
+    @pytest.mark.parametrize("prefix_len", [0, 24])
+    def test_failed_batch_is_reprogrammed_by_the_retry(self, shard, monkeypatch, error, prefix_len):
+        """A batch the backend raised on fails all its VIPs, the retry programs them instead of finding nothing to do"""
+        monkeypatch.setattr(ru, 'AGGREGATE_PREFIX_LEN', prefix_len)
+        backend_apply = shard.backend.apply
+        batches = []
+
+        def failing_apply(ops):
+            batches.append(ops)
+            if len(batches) == 1:
+                raise error
+            return backend_apply(ops)
+
+        monkeypatch.setattr(shard.backend, 'apply', failing_apply)
+        assert not apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert shard.failed_vips == {vip('10.20.0.1'), vip('10.20.0.2')}
+        assert kernel(shard) == {}
+
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+        assert not shard.failed_vips
+
+    def test_failed_delete_is_retried(self, shard, monkeypatch):
+        """Routes of a deleted TrafficDirector whose batch failed are deleted by the retry"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        backend_apply = shard.backend.apply
+        batches = []
+
+        def failing_apply(ops):
+            batches.append(ops)
+            if len(batches) == 1:
+                raise OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS))
+            return backend_apply(ops)
+
+        monkeypatch.setattr(shard.backend, 'apply', failing_apply)
+        assert not delete(shard, 'a')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2'}}
+        assert delete(shard, 'a')
+        assert kernel(shard) == {}
+
+
+class TestFingerprint:
+    """Test cases for skipping watch events that cannot change routes"""
+
+    @pytest.fixture(autouse=True)
+    def fingerprints(self, monkeypatch):
+        monkeypatch.setattr(ru, 'traffic_director_fingerprints', {})
+        monkeypatch.setattr(ru, 'traffic_director_objects', {})
+        monkeypatch.setattr(ru, 'shards', [])
+
+    def test_route_fingerprint_ignores_gateway_order_and_namespaces(self):
+        """The fingerprint covers the nodeIp, the set of VIPs and the labels only"""
+        first = traffic_director('a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        second = traffic_director('a', ['10.20.0.2', '10.20.0.1'], '10.0.0.2', generation=2)
+        second['spec']['gateways'][0]['namespace'] = 'other'
+        assert ru.route_fingerprint(first)[3] == ru.route_fingerprint(second)[3]
+
+    def test_first_sight_is_a_change(self):
+        """A TrafficDirector seen for the first time always changes routes"""
+        assert ru.fingerprint_changed('opsramp-sdn/a', traffic_director('a', ['10.20.0.1'], '10.0.0.2'))
+
+    def test_same_generation_and_node_is_skipped(self):
+        """Status-only churn with the same generation, nodeIp and labels is skipped"""
+        item = traffic_director('a', ['10.20.0.1'], '10.0.0.2')
+        ru.fingerprint_changed('opsramp-sdn/a', item)
+        assert not ru.fingerprint_changed('opsramp-sdn/a', traffic_director('a', ['10.20.0.1'], '10.0.0.2'))
+
+    def test_generation_bump_without_route_change_is_skipped(self):
+        """A new generation with the same VIPs compares equal by fingerprint"""
+        ru.fingerprint_changed('opsramp-sdn/a', traffic_director('a', ['10.20.0.1'], '10.0.0.2'))
+        assert not ru.fingerprint_changed('opsramp-sdn/a', traffic_director('a', ['10.20.0.1'], '10.0.0.2', generation=2))
+
+    @pytest.mark.parametrize("changed", [
+        traffic_director('a', ['10.20.0.1'], '10.0.0.3'),
+        traffic_director('a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2', generation=2),
+        traffic_director('a', ['10.20.0.1'], '10.0.0.2', labels={'router': 'edge-1'}),
+    ])
+    def test_route_relevant_changes_are_not_skipped(self, changed):
+        """A new nodeIp, other VIPs or other labels change routes"""
+        ru.fingerprint_changed('opsramp-sdn/a', traffic_director('a', ['10.20.0.1'], '10.0.0.2'))
+        assert ru.fingerprint_changed('opsramp-sdn/a', changed)
+
+    def test_process_event_skips_but_records_the_latest_object(self):
+        """A skipped event still becomes the cached state, a deletion forgets the fingerprint"""
+        skipped = ru.events_skipped.value()
+        first = traffic_director('a', ['10.20.0.1'], '10.0.0.2')
+        ru.process_event({'type': 'ADDED', 'object': first}, LOGGER)
+        second = traffic_director('a', ['10.20.0.1'], '10.0.0.2')
+        second['status']['phase'] = 'Ready'
+        ru.process_event({'type': 'MODIFIED', 'object': second}, LOGGER)
+        assert ru.events_skipped.value() == skipped + 1
+        assert ru.traffic_director_objects['opsramp-sdn/a'] is second
+
+        ru.process_event({'type': 'DELETED', 'object': second}, LOGGER)
+        assert 'opsramp-sdn/a' not in ru.traffic_director_fingerprints
+        assert 'opsramp-sdn/a' not in ru.traffic_director_objects
+
+
+class TestParseSelector:
+    """Test cases for shard label selectors"""
+
+    def test_equality_based_terms(self):
+        """All supported operators parse into requirements"""
+        assert ru.parse_selector("a=b, c==d,e!=f,g,!h") == [
+            ('a', '=', 'b'), ('c', '=', 'd'), ('e', '!=', 'f'), ('g', 'exists', None), ('h', '!', None),
+        ]
+
+    def test_empty_selector(self):
+        """An empty selector has no requirements"""
+        assert ru.parse_selector("") == []
+        assert ru.parse_selector(" , ") == []
+
+    def test_prefixed_keys_and_empty_values(self):
+        """Keys may carry a DNS prefix, values may be empty"""
+        assert ru.parse_selector("example.com/router=edge-1,zone=") == [
+            ('example.com/router', '=', 'edge-1'), ('zone', '=', ''),
+        ]
+
+    @pytest.mark.parametrize("selector", [
+        "env in (a,b)",
+        "env notin (a)",
+        "a=b=c",
+        "a>1",
+        "=b",
+        "!",
+        "a!=b c",
+        "x/",
+    ])
+    def test_unsupported_terms_raise(self, selector):
+        """Set-based and malformed terms are rejected"""
+        with pytest.raises(ValueError):
+            ru.parse_selector(selector)
+
+    def test_bad_selector_fails_the_shard_spec(self):
+        """A shard with an unsupported selector is rejected like a malformed spec"""
+        with pytest.raises(ValueError):
+            ru.parse_shards("n1:lana_1:env in (a,b)")
+
+    def test_shard_selects_by_labels(self):
+        """A shard routes the TrafficDirectors its requirements match"""
+        shard = ru.RouterShard("n1", "lana_1", "router=edge-1,!canary")
+        assert shard.selects(traffic_director('a', [], '10.0.0.1', labels={'router': 'edge-1'}))
+        assert not shard.selects(traffic_director('b', [], '10.0.0.1', labels={'router': 'edge-2'}))
+        assert not shard.selects(traffic_director('c', [], '10.0.0.1', labels={'router': 'edge-1', 'canary': 'true'}))
+        assert not shard.selects(traffic_director('d', [], '10.0.0.1'))
+
+
+class TestIpErrors:
+    """Test cases for mapping the errors ip prints to errnos"""
+
+    @pytest.mark.parametrize("message, code", [
+        ("RTNETLINK answers: No such process\n", errno.ESRCH),
+        ("RTNETLINK answers: File exists\n", errno.EEXIST),
+        ("RTNETLINK answers: Network is unreachable\n", errno.ENETUNREACH),
+        ("Error: Nexthop id does not exist.\n", errno.EINVAL),
+        ("Error: ipv4: FIB table does not exist.\nDump terminated\n", errno.ENOENT),
+        ("", errno.EINVAL),
+    ])
+    def test_ip_error_errno(self, message, code):
+        """The errno comes from the RTNETLINK message, extended acks map to EINVAL"""
+        assert ru._ip_error(message).errno == code
+
+
+class TestIpBatch:
+    """Test cases for attributing the errors of ip -batch to the ops they belong to"""
+
+    @staticmethod
+    def batch_backend(stderr_lines, lines=0):
+        """An IpBatchRouteBackend whose ip process reports stderr_lines"""
+
+        class Process:
+            stdin = io.StringIO()
+            stderr = iter(stderr_lines)
+
+            def poll(self):
+                return None
+
+            def kill(self):
+                pass
+
+            def wait(self):
+                pass
+
+        backend = ru.IpBatchRouteBackend.__new__(ru.IpBatchRouteBackend)
+        backend.netns = "n1"
+        backend.logger = LOGGER
+        backend.lock = threading.Lock()
+        backend.process = Process()
+        backend.lines = lines
+        return backend
+
+    def test_batch_errors_go_to_their_ops(self):
+        """Each error report lands on the op of the line ip names, the others succeed"""
+        backend = self.batch_backend([
+            "RTNETLINK answers: No such process\n",
+            "Command failed -:2\n",
+            "Error: Nexthop id does not exist.\n",
+            "Command failed -:3\n",
+            "RTNETLINK answers: Invalid argument\n",
+            "Command failed -:5\n",
+        ])
+        results = backend._batch([['route', 'del', f'10.20.0.{i}/32'] for i in range(4)])
+        assert results[0] is None and results[3] is None
+        assert results[1].errno == errno.ESRCH
+        assert results[2].errno == errno.EINVAL
+        assert backend.process.stdin.getvalue().endswith(ru.IP_BATCH_SENTINEL + "\n")
+
+    def test_batch_line_numbers_continue_across_windows(self):
+        """ip numbers lines over the life of the process, not per window"""
+        backend = self.batch_backend([
+            "RTNETLINK answers: File exists\n",
+            "Command failed -:12\n",
+            "RTNETLINK answers: Invalid argument\n",
+            "Command failed -:13\n",
+        ], lines=10)
+        results = backend._batch([['route', 'add', '10.20.0.1/32'], ['route', 'add', '10.20.0.2/32']])
+        assert results[0] is None
+        assert results[1].errno == errno.EEXIST
+
+    def test_batch_process_exit_fails_the_rest(self):
+        """Ops ip did not report on before exiting fail with EIO, reported ones keep their error"""
+        backend = self.batch_backend([
+            "RTNETLINK answers: File exists\n",
+            "Command failed -:1\n",
+        ])
+        results = backend._batch([['route', 'add', '10.20.0.1/32'], ['route', 'add', '10.20.0.2/32']])
+        assert results[0].errno == errno.EEXIST
+        assert results[1].errno == errno.EIO
+        assert backend.process is None
+
+
+class TestAggregation:
+    """Test cases for covering the VIPs of a block with the fewest prefixes"""
+
+    @pytest.fixture(autouse=True)
+    def aggregate_prefix(self, monkeypatch):
+        monkeypatch.setattr(ru, 'AGGREGATE_PREFIX_LEN', 24)
+        monkeypatch.setattr(ru, 'down_nodes', set())
+
+    @staticmethod
+    def shard_with(announcers):
+        """A shard indexing {TrafficDirector name: (nodeIp, VIPs)}"""
+        shard = ru.RouterShard("n1", "lana_1")
+        for td_name, (node_ip, vips) in announcers.items():
+            for address in vips:
+                ru.index_vip(shard, td_name, vip(address), vip(node_ip))
+        return shard
+
+    @staticmethod
+    def readable(prefixes):
+        return {ru.dst_to_str(dst): tuple(map(ru.int_to_ip, route[0])) for dst, route in prefixes.items()}
+
+    def test_aggregate_whole_prefix(self):
+        """Every address of a prefix taking the same route becomes that prefix"""
+        members = [(vip('10.20.0.0') + offset, 'r') for offset in range(8)]
+        prefixes = {}
+        ru._aggregate(members, 0, len(members), vip('10.20.0.0'), 24, prefixes)
+        assert prefixes == {(vip('10.20.0.0'), 29): 'r'}
+
+    def test_aggregate_never_routes_addresses_outside_the_vips(self):
+        """A gap splits the prefix, and no resulting prefix covers the missing address"""
+        members = [(vip('10.20.0.0') + offset, 'r') for offset in range(8) if offset != 5]
+        prefixes = {}
+        ru._aggregate(members, 0, len(members), vip('10.20.0.0'), 24, prefixes)
+        assert prefixes == {(vip('10.20.0.0'), 30): 'r', vip('10.20.0.4'): 'r', (vip('10.20.0.6'), 31): 'r'}
+        covered = {address for dst in prefixes for address in ru.dst_vips(dst)}
+        assert covered == {member[0] for member in members}
+
+    def test_aggregate_splits_on_different_routes(self):
+        """VIPs taking other routes never share a prefix"""
+        members = [(vip('10.20.0.0') + offset, 'r' if offset < 2 else 's') for offset in range(4)]
+        prefixes = {}
+        ru._aggregate(members, 0, len(members), vip('10.20.0.0'), 24, prefixes)
+        assert prefixes == {(vip('10.20.0.0'), 31): 'r', (vip('10.20.0.2'), 31): 's'}
+
+    def test_aggregate_block_by_nexthops(self):
+        """aggregate_block() groups the VIPs of a block by their nexthop set"""
+        shard = self.shard_with({
+            'a': ('10.0.0.2', [f'10.20.0.{i}' for i in range(4)]),
+            'b': ('10.0.0.3', ['10.20.0.4', '10.20.0.5', '10.20.0.9']),
+            'c': ('10.0.0.4', ['10.20.0.9']),
+        })
+        prefixes = ru.aggregate_block(shard, ru.vip_block(vip('10.20.0.0')))
+        assert self.readable(prefixes) == {
+            '10.20.0.0/30': ('10.0.0.2',),
+            '10.20.0.4/31': ('10.0.0.3',),
+            '10.20.0.9/32': ('10.0.0.3', '10.0.0.4'),
+        }
+
+    def test_aggregate_block_keeps_blocks_apart(self):
+        """VIPs of another block are left to that block"""
+        shard = self.shard_with({'a': ('10.0.0.2', ['10.20.0.255', '10.20.1.0'])})
+        assert self.readable(ru.aggregate_block(shard, ru.vip_block(vip('10.20.0.0')))) == {'10.20.0.255/32': ('10.0.0.2',)}
+        assert self.readable(ru.aggregate_block(shard, ru.vip_block(vip('10.20.1.0')))) == {'10.20.1.0/32': ('10.0.0.2',)}
+
+    def test_covering_prefix(self):
+        """covering_prefix() finds the /32 or the aggregate routing a VIP"""
+        prefixes = {(vip('10.20.0.0'), 30): 'r', vip('10.20.0.4'): 'r', (vip('10.20.0.128'), 25): 's'}
+        assert ru.covering_prefix(prefixes, vip('10.20.0.2')) == (vip('10.20.0.0'), 30)
+        assert ru.covering_prefix(prefixes, vip('10.20.0.4')) == vip('10.20.0.4')
+        assert ru.covering_prefix(prefixes, vip('10.20.0.200')) == (vip('10.20.0.128'), 25)
+        assert ru.covering_prefix(prefixes, vip('10.20.0.5')) is None
+
+    def test_prefixes_overlap(self):
+        """Route destinations overlap when one covers the other"""
+        assert ru.prefixes_overlap((vip('10.20.0.0'), 29), vip('10.20.0.5'))
+        assert ru.prefixes_overlap((vip('10.20.0.4'), 30), (vip('10.20.0.0'), 29))
+        assert not ru.prefixes_overlap((vip('10.20.0.0'), 30), (vip('10.20.0.4'), 30))
+        assert not ru.prefixes_overlap(vip('10.20.0.1'), vip('10.20.0.2'))
+
+    def test_reconcile_programs_aggregates(self, shard):
+        """Routes follow the aggregates as VIPs come and go, never routing an address that is not a VIP"""
+        assert apply(shard, 'a', [f'10.20.0.{i}' for i in range(4)], '10.0.0.2')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.0/30': '10.0.0.2'}}
+
+        assert apply(shard, 'a', ['10.20.0.0', '10.20.0.1', '10.20.0.3'], '10.0.0.2')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.0/31': '10.0.0.2', '10.20.0.3/32': '10.0.0.2'}}
+
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.2')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.0/30': '10.0.0.2'}}
+
+        assert delete(shard, 'a')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.2'}}
+        assert shard.installed_routes == {vip('10.20.0.2'): (vip('10.0.0.2'),)}
+
+
+class TestReconcile:
+    """Test cases for reconciling the routes of a TrafficDirector by diff"""
+
+    def routes(self, vips, node_ip):
+        return ru.extract_vips('opsramp-sdn/a', traffic_director('a', vips, node_ip), LOGGER)
+
+    def test_diff_vips(self):
+        """VIPs are added, removed, or changed when the nodeIp moves"""
+        old = self.routes(['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert ru.diff_vips(None, old) == ({vip('10.20.0.1'), vip('10.20.0.2')}, set(), set())
+        assert ru.diff_vips(old, None) == (set(), {vip('10.20.0.1'), vip('10.20.0.2')}, set())
+        assert ru.diff_vips(old, self.routes(['10.20.0.2', '10.20.0.3'], '10.0.0.2')) == ({vip('10.20.0.3')}, {vip('10.20.0.1')}, set())
+        assert ru.diff_vips(old, self.routes(['10.20.0.2', '10.20.0.3'], '10.0.0.3')) == ({vip('10.20.0.3')}, {vip('10.20.0.1')}, {vip('10.20.0.2')})
+
+    def test_only_the_difference_is_programmed(self, shard, monkeypatch):
+        """A reconcile touches the routes of the VIPs that changed and nothing else"""
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert batches == [[('replace', '10.20.0.1/32'), ('replace', '10.20.0.2/32')]]
+
+        assert apply(shard, 'a', ['10.20.0.2', '10.20.0.3'], '10.0.0.2')
+        assert batches[1:] == [[('delete', '10.20.0.1/32'), ('replace', '10.20.0.3/32')]]
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.2', '10.20.0.3/32': '10.0.0.2'}}
+
+        assert apply(shard, 'a', ['10.20.0.2', '10.20.0.3'], '10.0.0.2')
+        assert len(batches) == 2
+
+    def test_node_move_replaces_every_route(self, shard, monkeypatch):
+        """A new nodeIp replaces the routes in place, they are never deleted first"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.3')
+        assert batches == [[('replace', '10.20.0.1/32'), ('replace', '10.20.0.2/32')]]
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.3', '10.20.0.2/32': '10.0.0.3'}}
+
+    def test_delete_removes_every_route(self, shard):
+        """Deleting a TrafficDirector deletes its routes and forgets its state"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert delete(shard, 'a')
+        assert kernel(shard) == {}
+        assert not shard.traffic_director_vips and not shard.vip_nexthops and not shard.installed_routes
+
+    def test_failed_route_is_retried_alone(self, shard, monkeypatch):
+        """A route the kernel rejects fails its VIP only, the next reconcile retries it"""
+        replace_route = shard.backend.replace_route
+
+        def rejecting_replace(dst, node_ips, table=ru.RT_TABLE_MAIN):
+            if dst == vip('10.20.0.2'):
+                raise ru.RouteError(errno.ENETUNREACH, os.strerror(errno.ENETUNREACH))
+            replace_route(dst, node_ips, table)
+
+        monkeypatch.setattr(shard.backend, 'replace_route', rejecting_replace)
+        assert not apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert shard.failed_vips == {vip('10.20.0.2')}
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2'}}
+
+        monkeypatch.setattr(shard.backend, 'replace_route', replace_route)
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert batches == [[('replace', '10.20.0.2/32')]]
+        assert not shard.failed_vips
+
+
+class TestMultipath:
+    """Test cases for VIPs announced by several TrafficDirectors"""
+
+    def test_shared_vip_gets_one_multipath_route(self, shard):
+        """A VIP announced from several nodes is one route over all of them"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+
+    def test_withdrawn_announcer_leaves_the_others(self, shard):
+        """Deleting one announcer shrinks the route instead of deleting it"""
+        assert apply(shard, 'a', ['10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        assert delete(shard, 'a')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.3'}}
+        assert delete(shard, 'b')
+        assert kernel(shard) == {}
+
+    def test_announcers_on_one_node_share_its_gateway(self, shard, monkeypatch):
+        """A second TrafficDirector on the same node leaves the route as it is"""
+        assert apply(shard, 'a', ['10.20.0.2'], '10.0.0.2')
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.2')
+        assert batches == []
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.2'}}
+
+
+class TestNexthopObjects:
+    """Test cases for routing VIPs through kernel nexthop objects"""
+
+    @pytest.fixture(autouse=True)
+    def nexthop_objects(self, shard, monkeypatch):
+        monkeypatch.setattr(ru, 'NEXTHOP_OBJECTS', True)
+        ru.sync_shard(shard, LOGGER)
+
+    @staticmethod
+    def restart(shard):
+        """A shard of a new run over the routes and objects shard left in the kernel"""
+        restarted = ru.RouterShard(shard.netns, shard.interface)
+        restarted.backend = shard.backend
+        ru.shards[:] = [restarted]
+        return restarted
+
+    def test_node_move_is_one_nexthop_replace(self, shard, monkeypatch):
+        """Moving a TrafficDirector updates its nexthop object and no route"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        nhid = shard.nexthop_manager.td_ids['opsramp-sdn/a']
+        assert shard.backend.dump_route_nexthops() == {ru.RT_TABLE_MAIN: {vip('10.20.0.1'): nhid, vip('10.20.0.2'): nhid}}
+
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.3')
+        assert batches == []
+        assert shard.backend.dump_nexthops() == {nhid: vip('10.0.0.3')}
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.3', '10.20.0.2/32': '10.0.0.3'}}
+
+    def test_shared_vip_uses_a_group(self, shard):
+        """A VIP of several TrafficDirectors goes through a group of their objects, deleted with its last user"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+        assert len(shard.backend.dump_nexthops()) == 3
+
+        assert delete(shard, 'b')
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+        assert shard.backend.dump_nexthops() == {shard.nexthop_manager.td_ids['opsramp-sdn/a']: vip('10.0.0.2')}
+
+    def test_restart_keeps_routes_on_their_objects(self, shard, monkeypatch):
+        """A restart takes over the objects and groups in use, without touching a route"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        nexthops = shard.backend.dump_nexthops()
+        route_nhids = shard.backend.dump_route_nexthops()
+
+        restarted = self.restart(shard)
+        batches = record_batches(restarted, monkeypatch)
+        ru.sync_shard(restarted, LOGGER)
+        assert batches == []
+        assert shard.backend.dump_nexthops() == nexthops
+        assert shard.backend.dump_route_nexthops() == route_nhids
+
+        # The objects taken over move their routes like the ones created by this run
+        assert apply(restarted, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.4')
+        assert batches == []
+        assert kernel(restarted) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.4', '10.20.0.2/32': '10.0.0.3,10.0.0.4'}}
+
+    def test_restart_replaces_only_what_changed_meanwhile(self, shard, monkeypatch):
+        """Routes of a TrafficDirector that moved while route-updater was down get a new object, the old objects go"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        assert apply(shard, 'c', ['10.20.0.3'], '10.0.0.4')
+        kept = shard.nexthop_manager.td_ids['opsramp-sdn/a']
+        ru.traffic_director_objects['opsramp-sdn/b'] = traffic_director('b', ['10.20.0.2'], '10.0.0.5')
+        del ru.traffic_director_objects['opsramp-sdn/c']
+
+        restarted = self.restart(shard)
+        batches = record_batches(restarted, monkeypatch)
+        ru.sync_shard(restarted, LOGGER)
+        assert batches == [[('replace', '10.20.0.2/32'), ('delete', '10.20.0.3/32')]]
+        assert kernel(restarted) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.5'}}
+        assert restarted.nexthop_manager.td_ids['opsramp-sdn/a'] == kept
+        assert set(shard.backend.dump_nexthops()) == restarted.nexthop_manager.ids()
+
+
+class TestStartupSync:
+    """Test cases for converging the kernel routes with the TrafficDirectors at startup"""
+
+    def test_sync_programs_the_cached_traffic_directors(self, shard):
+        """A first sync installs the routes of every cached TrafficDirector the shard selects"""
+        ru.traffic_director_objects['opsramp-sdn/a'] = traffic_director('a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        ru.traffic_director_objects['opsramp-sdn/b'] = traffic_director('b', ['10.20.0.2'], '10.0.0.3')
+        ru.sync_shard(shard, LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+        assert set(shard.traffic_director_vips) == {'opsramp-sdn/a', 'opsramp-sdn/b'}
+
+    def test_sync_is_idempotent(self, shard, monkeypatch):
+        """A second sync over the same state changes nothing and ends up with the same index"""
+        ru.traffic_director_objects['opsramp-sdn/a'] = traffic_director('a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        ru.sync_shard(shard, LOGGER)
+        installed = dict(shard.installed_routes)
+        batches = record_batches(shard, monkeypatch)
+        ru.sync_shard(shard, LOGGER)
+        assert batches == []
+        assert shard.installed_routes == installed
+
+    def test_sync_cleans_up_stale_routes(self, shard, monkeypatch):
+        """Routes of TrafficDirectors gone while route-updater was down are deleted, rewritten ones fixed"""
+        shard.backend.replace_route(vip('10.20.0.1'), (vip('10.0.0.9'),))
+        shard.backend.replace_route(vip('10.20.0.9'), (vip('10.0.0.2'),))
+        shard.backend.replace_route(vip('10.20.0.2'), (vip('10.0.0.2'),))
+        ru.traffic_director_objects['opsramp-sdn/a'] = traffic_director('a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        batches = record_batches(shard, monkeypatch)
+        ru.sync_shard(shard, LOGGER)
+        assert batches == [[('replace', '10.20.0.1/32'), ('delete', '10.20.0.9/32')]]
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+
+    def test_sync_retries_failures_through_the_work_queue(self, shard, monkeypatch):
+        """VIPs the sync could not program are queued under their TrafficDirector"""
+        replace_route = shard.backend.replace_route
+
+        def rejecting_replace(dst, node_ips, table=ru.RT_TABLE_MAIN):
+            if dst == vip('10.20.0.2'):
+                raise ru.RouteError(errno.ENETUNREACH, os.strerror(errno.ENETUNREACH))
+            replace_route(dst, node_ips, table)
+
+        monkeypatch.setattr(shard.backend, 'replace_route', rejecting_replace)
+        ru.traffic_director_objects['opsramp-sdn/a'] = traffic_director('a', ['10.20.0.1'], '10.0.0.2')
+        ru.traffic_director_objects['opsramp-sdn/b'] = traffic_director('b', ['10.20.0.2'], '10.0.0.2')
+        ru.sync_shard(shard, LOGGER)
+        assert shard.failed_vips == {vip('10.20.0.2')}
+        assert len(shard.work_queue) == 1
+        assert asyncio.run(shard.work_queue.get()) == 'opsramp-sdn/b'
+
+        monkeypatch.setattr(shard.backend, 'replace_route', replace_route)
+        assert ru.reconcile_traffic_director(shard, 'opsramp-sdn/b', LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+
+
+class TestTrafficDirectorTables:
+    """Test cases for routing each TrafficDirector through its own table"""
+
+    @pytest.fixture(autouse=True)
+    def td_tables(self, shard, monkeypatch):
+        monkeypatch.setattr(ru, 'TD_TABLES', True)
+        ru.sync_shard(shard, LOGGER)
+
+    def test_routes_go_into_the_traffic_director_table(self, shard):
+        """Each TrafficDirector gets a table behind a rule, shared VIPs stay in the main table"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        table = shard.table_manager.tables['opsramp-sdn/a']
+        assert shard.backend.dump_rules() == {table, shard.table_manager.tables['opsramp-sdn/b']}
+        assert kernel(shard) == {table: {'10.20.0.1/32': '10.0.0.2'}, ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+
+    def test_delete_flushes_the_table(self, shard):
+        """Deleting a TrafficDirector flushes its table, routes route-updater has no record of included"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        table = shard.table_manager.tables['opsramp-sdn/a']
+        shard.backend.replace_route(vip('10.20.0.9'), (vip('10.0.0.2'),), table)
+        assert delete(shard, 'a')
+        assert kernel(shard) == {}
+        assert shard.backend.dump_rules() == set()
+        assert not shard.installed_routes and not shard.route_tables
+
+    def test_flush_removes_the_nexthop_object(self, shard, monkeypatch):
+        """The nexthop object of a flushed TrafficDirector goes with its table"""
+        monkeypatch.setattr(ru, 'NEXTHOP_OBJECTS', True)
+        ru.sync_shard(shard, LOGGER)
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        assert shard.backend.dump_nexthops()
+        assert delete(shard, 'a')
+        assert shard.backend.dump_nexthops() == {}
+        assert kernel(shard) == {}
+
+    def test_failed_flush_is_retried(self, shard, monkeypatch):
+        """A table that could not be flushed is flushed by the retry of the deleted TrafficDirector"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        flush_table = shard.backend.flush_table
+
+        def failing_flush(table):
+            raise ru.RouteError(errno.EBUSY, os.strerror(errno.EBUSY))
+
+        monkeypatch.setattr(shard.backend, 'flush_table', failing_flush)
+        assert not delete(shard, 'a')
+        monkeypatch.setattr(shard.backend, 'flush_table', flush_table)
+        assert delete(shard, 'a')
+        assert kernel(shard) == {}
+        assert shard.backend.dump_rules() == set()
+
+    def test_freed_table_goes_to_a_traffic_director_past_the_cap(self, shard, monkeypatch):
+        """Past TD_TABLES_MAX routes stay in the main table until a deleted TrafficDirector frees its table"""
+        monkeypatch.setattr(ru, 'TD_TABLES_MAX', 1)
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+        table = shard.table_manager.tables['opsramp-sdn/a']
+        assert kernel(shard) == {table: {'10.20.0.1/32': '10.0.0.2'}, ru.RT_TABLE_MAIN: {'10.20.0.2/32': '10.0.0.3'}}
+
+        assert delete(shard, 'a')
+        assert asyncio.run(shard.work_queue.get()) == 'opsramp-sdn/b'
+        assert ru.reconcile_traffic_director(shard, 'opsramp-sdn/b', LOGGER)
+        table = shard.table_manager.tables['opsramp-sdn/b']
+        assert kernel(shard) == {table: {'10.20.0.2/32': '10.0.0.3'}}
+        assert shard.backend.dump_rules() == {table}
+
+
+class TestRepair:
+    """Test cases for reinstalling routes changed outside route-updater"""
+
+    def test_deleted_route_is_reinstalled(self, shard):
+        """A route removed by someone else comes back, the others are left alone"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        shard.backend.delete_route(vip('10.20.0.1'))
+        ru.repair_routes(shard, {vip('10.20.0.1')}, 'deleted', LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+
+    def test_resync_finds_drifted_routes(self, shard, monkeypatch):
+        """A full resync compares every installed route with the kernel and repairs only the ones that differ"""
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2', '10.20.0.3'], '10.0.0.2')
+        shard.backend.delete_route(vip('10.20.0.1'))
+        shard.backend.replace_route(vip('10.20.0.2'), (vip('10.0.0.9'),))
+        batches = record_batches(shard, monkeypatch)
+        ru.repair_routes(shard, None, 'link', LOGGER)
+        assert batches == [[('replace', '10.20.0.1/32'), ('replace', '10.20.0.2/32')]]
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {f'10.20.0.{i}/32': '10.0.0.2' for i in (1, 2, 3)}}
+
+    def test_unknown_vips_are_not_repaired(self, shard, monkeypatch):
+        """Routes route-updater never installed are none of its business"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        batches = record_batches(shard, monkeypatch)
+        ru.repair_routes(shard, {vip('10.20.0.9')}, 'deleted', LOGGER)
+        assert batches == []
+
+    def test_resync_restores_nexthop_objects(self, shard, monkeypatch):
+        """Nexthop objects flushed with their interface are recreated before their routes are reinstalled"""
+        monkeypatch.setattr(ru, 'NEXTHOP_OBJECTS', True)
+        ru.sync_shard(shard, LOGGER)
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        nexthops = shard.backend.dump_nexthops()
+        # The kernel removes the objects of a link that goes down, and the routes through them
+        shard.backend.delete_route(vip('10.20.0.1'))
+        for nhid in nexthops:
+            shard.backend.delete_nexthop(nhid)
+        ru.repair_routes(shard, None, 'link', LOGGER)
+        assert shard.backend.dump_nexthops() == nexthops
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2'}}
+
+    def test_failed_repair_is_queued(self, shard, monkeypatch):
+        """A route that cannot be reinstalled is retried through the work queue of its TrafficDirector"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2')
+        shard.backend.delete_route(vip('10.20.0.1'))
+
+        def rejecting_replace(dst, node_ips, table=ru.RT_TABLE_MAIN):
+            raise ru.RouteError(errno.ENETUNREACH, os.strerror(errno.ENETUNREACH))
+
+        monkeypatch.setattr(shard.backend, 'replace_route', rejecting_replace)
+        ru.repair_routes(shard, {vip('10.20.0.1')}, 'deleted', LOGGER)
+        assert shard.failed_vips == {vip('10.20.0.1')}
+        assert asyncio.run(shard.work_queue.get()) == 'opsramp-sdn/a'
+
+
+class TestShardSelection:
+    """Test cases for TrafficDirectors a shard does not select"""
+
+    @pytest.fixture(autouse=True)
+    def selector(self, shard):
+        shard.requirements = ru.parse_selector("router=edge-1")
+
+    def test_other_shards_traffic_directors_are_ignored(self, shard, monkeypatch, caplog):
+        """Events of TrafficDirectors the shard never routed leave it alone"""
+        batches = record_batches(shard, monkeypatch)
+        assert apply(shard, 'z', ['10.20.0.9'], '10.0.0.2', labels={'router': 'edge-2'})
+        assert delete(shard, 'z')
+        assert batches == [] and kernel(shard) == {}
+        assert "No VIPs found" not in caplog.text
+
+    def test_relabeled_traffic_director_leaves_the_shard(self, shard):
+        """A TrafficDirector whose labels no longer match loses its routes on this shard"""
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2', labels={'router': 'edge-1'})
+        assert apply(shard, 'a', ['10.20.0.1'], '10.0.0.2', labels={'router': 'edge-2'})
+        assert kernel(shard) == {}
+        assert 'opsramp-sdn/a' not in shard.traffic_director_vips
+
+    def test_failed_vips_are_retried_without_deleting_others(self, shard, monkeypatch, caplog):
+        """An event of another shard's TrafficDirector retries the failed VIPs, without a delete of that TrafficDirector"""
+        replace_route = shard.backend.replace_route
+
+        def rejecting_replace(dst, node_ips, table=ru.RT_TABLE_MAIN):
+            raise ru.RouteError(errno.ENETUNREACH, os.strerror(errno.ENETUNREACH))
+
+        monkeypatch.setattr(shard.backend, 'replace_route', rejecting_replace)
+        assert not apply(shard, 'a', ['10.20.0.1'], '10.0.0.2', labels={'router': 'edge-1'})
+        monkeypatch.setattr(shard.backend, 'replace_route', replace_route)
+
+        assert apply(shard, 'z', ['10.20.0.9'], '10.0.0.2', labels={'router': 'edge-2'})
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2'}}
+        assert not shard.failed_vips
+        assert "No VIPs found" not in caplog.text
+
+
+def node(name, address, ready):
+    """Build a Node as the kubernetes client returns it"""
+    return types.SimpleNamespace(
+        metadata=types.SimpleNamespace(name=name),
+        status=types.SimpleNamespace(
+            addresses=[types.SimpleNamespace(type='InternalIP', address=address)],
+            conditions=[types.SimpleNamespace(type='Ready', status='True' if ready else 'False', last_transition_time=None)],
+        ),
+    )
+
+
+class TestNodeFailover:
+    """Test cases for routing around the nodeIps of Nodes that are not Ready"""
+
+    @pytest.fixture(autouse=True)
+    def nodes(self, shard, monkeypatch):
+        monkeypatch.setattr(ru, 'node_addresses', {})
+        monkeypatch.setattr(ru, 'down_nodes', frozenset())
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+
+    def test_not_ready_node_is_withdrawn(self, shard):
+        """Multipath routes lose the nodeIp of a NotReady Node, routes with no other nodeIp keep it"""
+        ru.update_node('node-2', node('node-2', '10.0.0.2', ready=False), LOGGER)
+        assert shard.down_nodes == {vip('10.0.0.2')}
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.3'}}
+
+        ru.update_node('node-2', node('node-2', '10.0.0.2', ready=True), LOGGER)
+        assert shard.down_nodes == set()
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+
+    def test_deleted_node_is_withdrawn(self, shard):
+        """A deleted Node is withdrawn like a NotReady one"""
+        ru.update_node('node-3', node('node-3', '10.0.0.3', ready=True), LOGGER)
+        ru.update_node('node-3', None, LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+
+    def test_down_set_is_replaced_not_updated(self, shard):
+        """A shard's down set never changes under it, the Node watch hands it a new one under routes_lock"""
+        ru.update_node('node-2', node('node-2', '10.0.0.2', ready=False), LOGGER)
+        handed = shard.down_nodes
+        ru.update_node('node-3', node('node-3', '10.0.0.3', ready=False), LOGGER)
+        assert handed == {vip('10.0.0.2')}
+        assert shard.down_nodes == {vip('10.0.0.2'), vip('10.0.0.3')}
+
+    def test_reroute_follows_later_reconciles(self, shard):
+        """VIPs reconciled while a node is down skip it too"""
+        ru.update_node('node-3', node('node-3', '10.0.0.3', ready=False), LOGGER)
+        assert apply(shard, 'c', ['10.20.0.1'], '10.0.0.3')
+        assert kernel(shard)[ru.RT_TABLE_MAIN]['10.20.0.1/32'] == '10.0.0.2'
+
+
+class TestUnreachableNodes:
+    """Test cases for routing around the nodeIps the prober gets no answer from"""
+
+    @pytest.fixture(autouse=True)
+    def routes(self, shard):
+        assert apply(shard, 'a', ['10.20.0.1', '10.20.0.2'], '10.0.0.2')
+        assert apply(shard, 'b', ['10.20.0.2'], '10.0.0.3')
+
+    def test_unreachable_node_is_withdrawn_and_restored(self, shard):
+        """A probed nodeIp leaves the multipath routes and comes back once it answers again"""
+        ru.update_unreachable_nodes(shard, {vip('10.0.0.3')}, {vip('10.0.0.3')}, LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2'}}
+
+        ru.update_unreachable_nodes(shard, set(), {vip('10.0.0.3')}, LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+
+    def test_route_keeps_its_last_nodes(self, shard):
+        """With every nodeIp of a VIP withdrawn its route stays as it was, there is nowhere better to send it"""
+        ru.update_unreachable_nodes(shard, {vip('10.0.0.2'), vip('10.0.0.3')}, {vip('10.0.0.2'), vip('10.0.0.3')}, LOGGER)
+        assert kernel(shard) == {ru.RT_TABLE_MAIN: {'10.20.0.1/32': '10.0.0.2', '10.20.0.2/32': '10.0.0.2,10.0.0.3'}}
+
+    def test_probe_and_node_verdicts_combine(self, shard, monkeypatch):
+        """A nodeIp stays withdrawn while its Node is down, even once it answers probes again"""
+        monkeypatch.setattr(ru, 'node_addresses', {})
+        monkeypatch.setattr(ru, 'down_nodes', frozenset())
+        ru.update_unreachable_nodes(shard, {vip('10.0.0.3')}, {vip('10.0.0.3')}, LOGGER)
+        ru.update_node('node-3', node('node-3', '10.0.0.3', ready=False), LOGGER)
+        ru.update_unreachable_nodes(shard, set(), {vip('10.0.0.3')}, LOGGER)
+        assert kernel(shard)[ru.RT_TABLE_MAIN]['10.20.0.2/32'] == '10.0.0.2'
+
+        ru.update_node('node-3', node('node-3', '10.0.0.3', ready=True), LOGGER)
+        assert kernel(shard)[ru.RT_TABLE_MAIN]['10.20.0.2/32'] == '10.0.0.2,10.0.0.3'
+
+    def test_reroute_of_unknown_nodes_changes_nothing(self, shard, monkeypatch):
+        """Rerouting nodeIps no TrafficDirector uses applies nothing"""
+        batches = record_batches(shard, monkeypatch)
+        ru.reroute_nodes(shard, {vip('10.0.0.9')}, LOGGER)
+        assert batches == []